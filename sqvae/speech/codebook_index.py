@@ -0,0 +1,202 @@
+"""
+Nearest-code search backends for deterministic quantization.
+
+Both backends search the (weighted) squared Euclidean distance
+    d(z, c) = sum_d w_d * (z_d - c_d)^2,
+where w is either omitted (scalar precision, which does not change the argmin) or given
+per position and dimension (gaussian_4).
+
+An index is built once from a trained checkpoint:
+    python codebook_index.py path/to/model.ckpt-500000.pt --kind ivf --nlist 64 --nprobe 8
+and used by SQEmbedding.encode() when passed to encode.py with index=<path>.
+"""
+import argparse
+
+import torch
+
+
+class CodebookIndex(object):
+    kind = None
+
+    def search(self, z, weight=None):
+        raise NotImplementedError()
+
+    def to(self, device):
+        raise NotImplementedError()
+
+    def state_dict(self):
+        raise NotImplementedError()
+
+    def save(self, path):
+        torch.save(dict(kind=self.kind, state=self.state_dict()), path)
+
+
+class BruteForceIndex(CodebookIndex):
+    """Exact search over every code, processing the queries in chunks."""
+    kind = "exact"
+
+    def __init__(self, codebook, chunk_size=4096):
+        self.codebook = codebook.detach().clone()
+        self.chunk_size = chunk_size
+        self.codebook_sq = torch.sum(self.codebook**2, dim=1)
+
+    def search(self, z, weight=None):
+        indices = []
+        for start in range(0, z.shape[0], self.chunk_size):
+            z_chunk = z[start:start+self.chunk_size]
+            if weight is None or weight.shape[1] == 1:
+                # ||z||^2 is constant per query and does not change the argmin
+                distances = self.codebook_sq - 2 * torch.matmul(z_chunk, self.codebook.t())
+            else:
+                weight_chunk = weight[start:start+self.chunk_size]
+                distances = (torch.matmul(weight_chunk, (self.codebook**2).t())
+                            - 2 * torch.matmul(weight_chunk * z_chunk, self.codebook.t()))
+            indices.append(torch.argmin(distances, dim=1))
+        return torch.cat(indices, dim=0)
+
+    def to(self, device):
+        self.codebook = self.codebook.to(device)
+        self.codebook_sq = self.codebook_sq.to(device)
+        return self
+
+    def state_dict(self):
+        return dict(codebook=self.codebook, chunk_size=self.chunk_size)
+
+    @classmethod
+    def from_state_dict(cls, state):
+        return cls(state["codebook"], state["chunk_size"])
+
+
+class IVFIndex(CodebookIndex):
+    """
+    Inverted-file index: the codebook is clustered with k-means into nlist cells, a query
+    is compared with the centroids and only the codes of the nprobe nearest cells are
+    searched exhaustively.
+    """
+    kind = "ivf"
+
+    def __init__(self, codebook, nlist=64, nprobe=8, niter=25, seed=0, chunk_size=256,
+                 centroids=None, lists=None):
+        self.codebook = codebook.detach().clone()
+        self.nprobe = nprobe
+        self.chunk_size = chunk_size
+        if centroids is None:
+            centroids, assignments = self._kmeans(self.codebook, min(nlist, self.codebook.shape[0]), niter, seed)
+            lists = self._make_lists(assignments, centroids.shape[0])
+        self.centroids = centroids
+        self.lists = lists # (nlist, max_list_len) code indices, padded with -1
+
+    @staticmethod
+    def _kmeans(x, k, niter, seed):
+        generator = torch.Generator().manual_seed(seed)
+        perm = torch.randperm(x.shape[0], generator=generator)[:k].to(x.device)
+        centroids = x[perm].clone()
+        for _ in range(niter):
+            distances = (torch.sum(centroids**2, dim=1)
+                        - 2 * torch.matmul(x, centroids.t()))
+            assignments = torch.argmin(distances, dim=1)
+            counts = torch.bincount(assignments, minlength=k).to(x.dtype)
+            sums = torch.zeros_like(centroids).index_add_(0, assignments, x)
+            nonempty = counts > 0
+            centroids[nonempty] = sums[nonempty] / counts[nonempty].unsqueeze(1)
+        distances = torch.sum(centroids**2, dim=1) - 2 * torch.matmul(x, centroids.t())
+        return centroids, torch.argmin(distances, dim=1)
+
+    @staticmethod
+    def _make_lists(assignments, nlist):
+        counts = torch.bincount(assignments, minlength=nlist)
+        lists = torch.full((nlist, max(int(counts.max()), 1)), -1,
+            dtype=torch.long, device=assignments.device)
+        order = torch.argsort(assignments)
+        starts = torch.cumsum(counts, dim=0) - counts
+        positions = torch.arange(assignments.shape[0], device=assignments.device) - starts[assignments[order]]
+        lists[assignments[order], positions] = order
+        return lists
+
+    def search(self, z, weight=None):
+        if weight is not None and weight.shape[1] == 1:
+            weight = None
+        indices = []
+        for start in range(0, z.shape[0], self.chunk_size):
+            z_chunk = z[start:start+self.chunk_size]
+            weight_chunk = None if weight is None else weight[start:start+self.chunk_size]
+            # Coarse search over the cells
+            dist_cells = self._distance(z_chunk, weight_chunk, self.centroids.unsqueeze(0))
+            cells = torch.topk(dist_cells, min(self.nprobe, self.centroids.shape[0]),
+                dim=1, largest=False)[1]
+            # Fine search over the codes of the probed cells
+            candidates = self.lists[cells].view(z_chunk.shape[0], -1)
+            codes = self.codebook[candidates.clamp(min=0)]
+            dist_codes = self._distance(z_chunk, weight_chunk, codes)
+            dist_codes = dist_codes.masked_fill(candidates < 0, float("inf"))
+            indices.append(torch.gather(candidates, 1, torch.argmin(dist_codes, dim=1, keepdim=True)).squeeze(1))
+        return torch.cat(indices, dim=0)
+
+    @staticmethod
+    def _distance(z, weight, codes):
+        # z: (n, D), codes: (n or 1, m, D) -> (n, m)
+        diff_sq = (z.unsqueeze(1) - codes) ** 2
+        if weight is not None:
+            diff_sq = diff_sq * weight.unsqueeze(1)
+        return torch.sum(diff_sq, dim=2)
+
+    def to(self, device):
+        self.codebook = self.codebook.to(device)
+        self.centroids = self.centroids.to(device)
+        self.lists = self.lists.to(device)
+        return self
+
+    def state_dict(self):
+        return dict(codebook=self.codebook, nprobe=self.nprobe, chunk_size=self.chunk_size,
+            centroids=self.centroids, lists=self.lists)
+
+    @classmethod
+    def from_state_dict(cls, state):
+        return cls(state["codebook"], nprobe=state["nprobe"], chunk_size=state["chunk_size"],
+            centroids=state["centroids"], lists=state["lists"])
+
+
+INDEX_CLASSES = {cls.kind: cls for cls in [BruteForceIndex, IVFIndex]}
+
+
+def build_index(codebook, kind="exact", **kwargs):
+    if kind not in INDEX_CLASSES:
+        raise Exception("Undefined codebook index: {}".format(kind))
+    return INDEX_CLASSES[kind](codebook, **kwargs)
+
+
+def load_index(path, device="cpu"):
+    saved = torch.load(path, map_location="cpu")
+    return INDEX_CLASSES[saved["kind"]].from_state_dict(saved["state"]).to(device)
+
+
+def load_codebook(path, key="codebook.embedding"):
+    # Codebook parameter from a training checkpoint (see train.save_checkpoint)
+    checkpoint = torch.load(path, map_location="cpu")
+    state = checkpoint["encoder"] if "encoder" in checkpoint else checkpoint
+    if key not in state:
+        raise Exception("Cannot find '{}' in {}".format(key, path))
+    return state[key]
+
+
+def arg_parse():
+    parser = argparse.ArgumentParser(description="codebook_index.py")
+    parser.add_argument("checkpoint", help="training checkpoint (model.ckpt-*.pt)")
+    parser.add_argument("-o", "--out", default="", help="output path (default: <checkpoint>.index.pt)")
+    parser.add_argument("--key", default="codebook.embedding", help="name of the codebook parameter")
+    parser.add_argument("--kind", default="ivf", choices=list(INDEX_CLASSES), help="index type")
+    parser.add_argument("--nlist", type=int, default=64, help="number of IVF cells")
+    parser.add_argument("--nprobe", type=int, default=8, help="number of probed IVF cells")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = arg_parse()
+    codebook = load_codebook(args.checkpoint, args.key)
+    if args.kind == "ivf":
+        index = build_index(codebook, args.kind, nlist=args.nlist, nprobe=args.nprobe)
+    else:
+        index = build_index(codebook, args.kind)
+    out = args.out if args.out != "" else args.checkpoint + ".index.pt"
+    index.save(out)
+    print("Saved {} index of {} codes: {}".format(args.kind, codebook.shape[0], out))
@@ -9,6 +9,7 @@ from tqdm import tqdm
 import torch
 
 from model import Encoder
+from codebook_index import load_index
 
 
 @hydra.main(config_path="config/encode.yaml")
@@ -33,6 +34,9 @@ def encode_dataset(cfg):
     checkpoint_path = utils.to_absolute_path(cfg.checkpoint)
     checkpoint = torch.load(checkpoint_path, map_location=lambda storage, loc: storage)
     encoder.load_state_dict(checkpoint["encoder"])
+    if cfg.index:
+        print("Load codebook index from: {}:".format(cfg.index))
+        encoder.codebook.index = load_index(utils.to_absolute_path(cfg.index), device)
 
     encoder.eval()
 
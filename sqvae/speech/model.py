@@ -3,9 +3,11 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torch.distributions import Categorical
 
+from step_profiler import StepProfiler
+
 
 class Encoder(nn.Module):
-    def __init__(self, param_var_q, in_channels, channels, n_embeddings, embedding_dim, jitter=0.0):
+    def __init__(self, param_var_q, in_channels, channels, n_embeddings, embedding_dim, jitter=0.0, topk=0):
         super(Encoder, self).__init__()
         self.param_var_q = param_var_q
         self.embedding_dim = embedding_dim
@@ -42,11 +44,13 @@ class Encoder(nn.Module):
         log_var_q_scalar.fill_(10.0).log_()
         self.register_parameter("log_var_q_scalar", nn.Parameter(log_var_q_scalar))
 
-        self.codebook = SQEmbedding(param_var_q, n_embeddings, embedding_dim)
+        self.codebook = SQEmbedding(param_var_q, n_embeddings, embedding_dim, topk)
         self.jitter = Jitter(jitter)
+        self.profiler = StepProfiler() # Replaced by the profiler of train.py (disabled by default)
 
     def forward(self, mels, temperature):
-        z = self.encoder(mels)
+        with self.profiler.phase("encoder"):
+            z = self.encoder(mels)
         z = z.transpose(1, 2)
         if self.param_var_q == "gaussian_1":
             log_var_q = self.log_var_q_scalar
@@ -55,7 +59,8 @@ class Encoder(nn.Module):
         else:
             raise Exception("Undefined param_var_q")
         z = z[:, :, :self.embedding_dim]
-        z, loss, perplexity = self.codebook(z, log_var_q, temperature)
+        with self.profiler.phase("quantizer"):
+            z, loss, perplexity = self.codebook(z, log_var_q, temperature)
         z = self.jitter(z)
         return z, loss, perplexity
 
@@ -96,10 +101,31 @@ class Jitter(nn.Module):
         return x
 
 
+def weighted_distances(x, embedding, precision):
+    # sum_d precision_d * (x_d - e_d)^2 expanded into matmuls, so that no
+    # (N, D, M) tensor is materialized
+    if precision.size(1) == 1:
+        distances = (torch.sum(x ** 2, dim=1, keepdim=True)
+                     + torch.sum(embedding ** 2, dim=1)
+                     - 2 * torch.matmul(x, embedding.t()))
+        return precision * distances
+    distances = (torch.sum(precision * x ** 2, dim=1, keepdim=True)
+                 - 2 * torch.matmul(precision * x, embedding.t())
+                 + torch.matmul(precision, (embedding ** 2).t()))
+    return distances
+
+
+def weighted_distances_broadcast(x, embedding, precision):
+    # Reference implementation of weighted_distances (materializes N x D x M)
+    return torch.sum(precision.unsqueeze(2) * (embedding.t().unsqueeze(0) - x.unsqueeze(2)) ** 2, dim=1)
+
+
 class SQEmbedding(nn.Module):
-    def __init__(self, param_var_q, n_embeddings, embedding_dim):
+    def __init__(self, param_var_q, n_embeddings, embedding_dim, topk=0):
         super(SQEmbedding, self).__init__()
         self.param_var_q = param_var_q
+        self.topk = topk  # sample among the topk nearest codes only (0: all codes)
+        self.index = None  # search backend for encode() (see codebook_index.py)
 
         embedding = torch.Tensor(n_embeddings, embedding_dim)
         embedding.normal_()
@@ -117,13 +143,13 @@ class SQEmbedding(nn.Module):
         else:
             raise Exception("Undefined param_var_q")
 
-        x_flat = x_flat.unsqueeze(2)
-        log_var_flat = log_var_q_flat.unsqueeze(2)
-        embedding = self.embedding.t().unsqueeze(0)
-        precision_flat = torch.exp(-log_var_flat)
-        distances = 0.5 * torch.sum(precision_flat * ((embedding - x_flat) ** 2), dim=1)
-
-        indices = torch.argmin(distances.float(), dim=-1)
+        precision_flat = torch.exp(-log_var_q_flat)
+        if self.index is not None:
+            weight = precision_flat if self.param_var_q == "gaussian_4" else None
+            indices = self.index.search(x_flat.float(), None if weight is None else weight.float())
+        else:
+            distances = 0.5 * weighted_distances(x_flat, self.embedding, precision_flat)
+            indices = torch.argmin(distances.float(), dim=-1)
         quantized = F.embedding(indices, self.embedding)
         quantized = quantized.view_as(x)
         return quantized, indices
@@ -141,21 +167,26 @@ class SQEmbedding(nn.Module):
         else:
             raise Exception("Undefined param_var_q")
 
-        x_flat = x_flat.unsqueeze(2)
-        log_var_flat = log_var_q_flat.unsqueeze(2)
-        embedding = self.embedding.t().unsqueeze(0)
-        precision_flat = torch.exp(-log_var_flat)
-        distances = 0.5 * torch.sum(precision_flat * (embedding - x_flat) ** 2, dim=1)
+        precision_flat = torch.exp(-log_var_q_flat)
+        distances = 0.5 * weighted_distances(x_flat, self.embedding, precision_flat)
 
         indices = torch.argmin(distances.float(), dim=-1)
 
         logits = -distances
 
-        encodings = self._gumbel_softmax(logits, tau=temperature, dim=-1)
-        quantized = torch.matmul(encodings, self.embedding)
+        if self.topk > 0:
+            # Truncate the distribution to the topk nearest codes and gather them
+            # instead of a dense (N, M) x (M, D) matmul
+            logits, indices_topk = torch.topk(logits, min(self.topk, M), dim=-1)
+            encodings = self._gumbel_softmax(logits, tau=temperature, dim=-1)
+            embedding_topk = F.embedding(indices_topk, self.embedding)
+            quantized = torch.bmm(encodings.unsqueeze(1), embedding_topk).squeeze(1)
+        else:
+            encodings = self._gumbel_softmax(logits, tau=temperature, dim=-1)
+            quantized = torch.matmul(encodings, self.embedding)
         quantized = quantized.view_as(x)
 
-        logits = logits.view(batch_size, sample_size, M)
+        logits = logits.view(batch_size, sample_size, -1)
         probabilities = torch.softmax(logits, dim=-1)
         log_probabilities = torch.log_softmax(logits, dim=-1)
 
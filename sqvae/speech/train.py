@@ -13,6 +13,7 @@ from torch.utils.tensorboard import SummaryWriter
 
 from dataset import SpeechDataset
 from model import Encoder, Decoder
+from step_profiler import StepProfiler
 
 
 def mse_loss_arelbo(input, target):
@@ -83,29 +84,42 @@ def train_model(cfg):
         pin_memory=True,
         drop_last=True)
 
+    profile = cfg.training.profile
+    profiler = StepProfiler(
+        utils.to_absolute_path(profile.path) if profile.path else "", profile.interval, device,
+        utils.to_absolute_path(profile.trace_dir) if profile.trace_dir else "",
+        profile.trace_start, profile.trace_steps)
+    encoder.profiler = profiler
+
     n_epochs = cfg.training.n_steps // len(dataloader) + 1
     start_epoch = global_step // len(dataloader) + 1
 
     for epoch in range(start_epoch, n_epochs + 1):
         average_recon_loss = average_kl = average_perplexity = 0
 
-        for i, (mels, speakers) in enumerate(tqdm(dataloader), 1):
+        for i, (mels, speakers) in profiler.iterate(enumerate(tqdm(dataloader), 1)):
             mels, speakers = mels.to(device), speakers.to(device)
 
             optimizer.zero_grad()
 
             temperature = cfg.training.temperature.init * math.exp(-cfg.training.temperature.decay * global_step)
-            z, kl, perplexity = encoder(mels, temperature)
-            output = decoder(z, speakers)
-            recon_loss = mse_loss_arelbo(output.transpose(1, 2), mels[:, :, 1:-1])
-            loss = recon_loss + kl
-
-            with amp.scale_loss(loss, optimizer) as scaled_loss:
-                scaled_loss.backward()
-
-            torch.nn.utils.clip_grad_norm_(amp.master_params(optimizer), 1)
-            optimizer.step()
+            with profiler.phase("forward"):
+                z, kl, perplexity = encoder(mels, temperature)
+                with profiler.phase("decoder"):
+                    output = decoder(z, speakers)
+                with profiler.phase("loss"):
+                    recon_loss = mse_loss_arelbo(output.transpose(1, 2), mels[:, :, 1:-1])
+                    loss = recon_loss + kl
+
+            with profiler.phase("backward"):
+                with amp.scale_loss(loss, optimizer) as scaled_loss:
+                    scaled_loss.backward()
+
+            with profiler.phase("optimizer"):
+                torch.nn.utils.clip_grad_norm_(amp.master_params(optimizer), 1)
+                optimizer.step()
             scheduler.step()
+            profiler.step_end()
 
             average_recon_loss += (recon_loss.item() - average_recon_loss) / i
             average_kl += (kl.item() - average_kl) / i
@@ -125,6 +139,8 @@ def train_model(cfg):
         print("epoch:{}, recon loss:{:.2E}, kl:{:.2E}, perplexity:{:.3f}"
               .format(epoch, average_recon_loss, average_kl, average_perplexity))
 
+    profiler.close()
+
 
 if __name__ == "__main__":
     train_model()
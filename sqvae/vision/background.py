@@ -0,0 +1,134 @@
+"""
+Background work of the training loop: checkpoints are serialized by a writer thread and
+reconstruction grids are rendered by a worker process, so that training continues meanwhile.
+With background=False both run synchronously in the caller.
+"""
+import os
+import queue
+import threading
+import traceback
+import multiprocessing
+
+import numpy as np
+import torch
+
+
+def snapshot(obj):
+    # Host copy of the tensors of a (nested) state_dict, taken before training updates them
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((key, snapshot(value)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(value) for value in obj)
+    return obj
+
+
+def save_atomic(obj, path):
+    # The file is complete or absent, even if the process dies while writing
+    torch.save(obj, path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+
+class CheckpointWriter(object):
+    def __init__(self, background=True):
+        self.background = background
+        self.error = None
+        if background:
+            self.queue = queue.Queue()
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def save(self, state, path):
+        if not self.background:
+            save_atomic(state, path)
+            return
+        self._raise()
+        self.queue.put((snapshot(state), path))
+
+    def flush(self):
+        # Wait until every queued checkpoint is on disk
+        if self.background:
+            self.queue.join()
+            self._raise()
+
+    def _run(self):
+        while True:
+            state, path = self.queue.get()
+            try:
+                save_atomic(state, path)
+            except Exception as error:
+                self.error = error
+            finally:
+                self.queue.task_done()
+
+    def _raise(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+
+## Rendering
+
+def render_continuous(x, x_tilde, filename, nrows, ncols):
+    from util import plot_images
+    plot_images(np.concatenate([x, x_tilde], 0), filename+".png", nrows=nrows, ncols=ncols)
+
+
+def render_discrete(label_tilde, y_long, imsize, filename, nrows, ncols):
+    from util import plot_images, idx_to_onehot, generate_label
+    label_real = idx_to_onehot(y_long)
+    label_batch_predict = generate_label(label_tilde[:,:19,:,:], imsize)
+    label_batch_real = generate_label(label_real, imsize)
+    images = torch.cat([label_batch_real, label_batch_predict], 0).numpy()
+    plot_images(images, filename+".png", nrows=nrows, ncols=ncols)
+
+
+RENDER_FUNCTIONS = {
+    "continuous": render_continuous,
+    "discrete": render_discrete,
+}
+
+
+def _render_loop(tasks):
+    import matplotlib
+    matplotlib.use("Agg")
+    while True:
+        task = tasks.get()
+        try:
+            if task is None:
+                break
+            kind, args = task
+            RENDER_FUNCTIONS[kind](*args)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            tasks.task_done()
+
+
+class ReconstructionRenderer(object):
+    def __init__(self, background=True):
+        self.background = background
+        self.process = None
+
+    def render(self, kind, *args):
+        # args are host (CPU) tensors/arrays
+        if not self.background:
+            RENDER_FUNCTIONS[kind](*args)
+            return
+        if self.process is None:
+            context = multiprocessing.get_context("spawn")
+            self.tasks = context.JoinableQueue()
+            self.process = context.Process(target=_render_loop, args=(self.tasks,), daemon=True)
+            self.process.start()
+        self.tasks.put((kind, args))
+
+    def flush(self):
+        if self.process is not None:
+            self.tasks.join()
+
+    def close(self):
+        if self.process is not None:
+            self.tasks.put(None)
+            self.process.join()
+            self.process = None
@@ -0,0 +1,629 @@
+"""
+Micro-benchmarks and equivalence checks for the vision SQ-VAE components.
+
+Usage:
+    python benchmark.py distance [--n 4096] [--dim 64] [--size 512] [--tol 1e-4] [--tol64 1e-10]
+    python benchmark.py fused [--bs 32] [--res 32] [--size 512] [--param_var_qs gaussian_1 gaussian_4 vmf]
+                              [--chunk_sizes 0 4096] [--tol 1e-5] [--tol_grad 1e-4]
+    python benchmark.py topk [--ks 8 16 32 64] [--temperature 0.2]
+    python benchmark.py index [--size 16384] [--nlist 128] [--nprobes 1 4 8 16] [--checkpoint best.pt]
+    python benchmark.py reconstruct [--config celebamask_vmf.yaml] [--bs 32]
+    python benchmark.py bessel [--orders 0 0.5 1 9 31] [--tol 1e-10] [--tol_grad 1e-8]
+    python benchmark.py vmf_loss [--config celebamask_vmf.yaml] [--bs 32]
+    python benchmark.py perceptual [--config microdoppler_gauss_1_64x64_perceptual.yaml] [--bs 16]
+    python benchmark.py vgg_startup --store vgg16_relu2_2
+    python benchmark.py metrics [--config cifar10_gauss_1.yaml] [--steps 50]
+    python benchmark.py loader [--dataset CIFAR10] [--path_dataset /dataset_path] [--bs 32] [--nworker 2]
+    python benchmark.py shards [--users 8] [--images 128] [--size 64] [--bs 32] [--nworker 2]
+"""
+import os
+import time
+import argparse
+import importlib.util
+import multiprocessing
+
+import torch
+
+from quantizer import calc_weighted_distance, calc_weighted_distance_broadcast
+from quantizer import GaussianVectorQuantizer, VmfVectorQuantizer
+from codebook_index import build_index, load_codebook
+from model import GaussianSQVAE, VmfSQVAE
+from bessel import ive as ive_torch
+from util import MetricAccumulator, get_loader, to_input
+
+
+def get_device(name=""):
+    if name == "":
+        name = "cuda" if torch.cuda.is_available() else "cpu"
+    return torch.device(name)
+
+
+def synchronize(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def timeit(fn, device, repeat=10, warmup=2):
+    for _ in range(warmup):
+        fn()
+    synchronize(device)
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    synchronize(device)
+    return (time.perf_counter() - start_time) / repeat
+
+
+def peak_memory(fn, device):
+    if device.type != "cuda":
+        fn()
+        return float("nan")
+    torch.cuda.empty_cache()
+    torch.cuda.reset_peak_memory_stats(device)
+    base = torch.cuda.memory_allocated(device)
+    fn()
+    synchronize(device)
+    return (torch.cuda.max_memory_allocated(device) - base) / 2**20
+
+
+def report(name, seconds, memory=float("nan"), **extra):
+    line = "{:<28s} {:9.3f} ms  {:9.1f} MiB".format(name, seconds * 1e3, memory)
+    for key, value in extra.items():
+        line += "  {}: {:.3e}".format(key, value)
+    print(line)
+
+
+def rel_diff(reference, value):
+    # Max absolute difference relative to the largest reference magnitude
+    return ((reference - value).abs().max() / reference.abs().max().clamp(min=1e-12)).item()
+
+
+## Benchmarks
+
+def bench_distance(args):
+    # Codebook distances of the quantizers (matmul forms) vs the N x D x K broadcast, computed
+    # in float64; each implementation is checked in float32 (--tol) and float64 (--tol64)
+    device = get_device(args.device)
+    torch.manual_seed(0)
+    z = torch.randn(args.n, args.dim, device=device, dtype=torch.float64)
+    codebook = torch.randn(args.size, args.dim, device=device, dtype=torch.float64)
+    z_norm = torch.nn.functional.normalize(z, p=2.0, dim=1)
+    codebook_norm = torch.nn.functional.normalize(codebook, p=2.0, dim=1)
+    weight = torch.rand(args.n, args.dim, device=device, dtype=torch.float64) + 0.5 # gaussian_4
+    weight_scalar = torch.rand(args.n, 1, device=device, dtype=torch.float64) + 0.5 # gaussian_1-3
+    kappa = torch.tensor([20.0], device=device, dtype=torch.float64) # vmf
+
+    # Speech SQEmbedding uses its own copy of the distance
+    path_speech = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "speech", "model.py")
+    spec = importlib.util.spec_from_file_location("speech_model", path_speech)
+    speech_model = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(speech_model)
+
+    quantizer_4 = GaussianVectorQuantizer(args.size, args.dim, param_var_q="gaussian_4")
+    quantizer_1 = GaussianVectorQuantizer(args.size, args.dim, param_var_q="gaussian_1")
+    quantizer_vmf = VmfVectorQuantizer(args.size, args.dim)
+    inputs = dict(
+        weighted=(z, codebook, weight),
+        scalar=(z, codebook, weight_scalar),
+        vmf=(z_norm, codebook_norm, kappa))
+    impls = [
+        ("vision/broadcast", "weighted", calc_weighted_distance_broadcast),
+        ("vision/matmul", "weighted", calc_weighted_distance),
+        ("vision/gaussian_4", "weighted", quantizer_4._calc_distance_bw_enc_codes),
+        ("vision/gaussian_1", "scalar", quantizer_1._calc_distance_bw_enc_codes),
+        ("vision/vmf", "vmf", quantizer_vmf._calc_distance_bw_enc_codes),
+        ("speech/broadcast", "weighted", speech_model.weighted_distances_broadcast),
+        ("speech/matmul", "weighted", speech_model.weighted_distances),
+        ("speech/matmul scalar", "scalar", speech_model.weighted_distances),
+    ]
+    with torch.no_grad():
+        references = {
+            "weighted": calc_weighted_distance_broadcast(z, codebook, weight),
+            "scalar": calc_weighted_distance_broadcast(z, codebook, weight_scalar.expand_as(z)),
+            "vmf": -kappa * torch.sum(z_norm.unsqueeze(2) * codebook_norm.t().unsqueeze(0), dim=1),
+        }
+        for dtype, tol in [(torch.float32, args.tol), (torch.float64, args.tol64)]:
+            for name, kind, fn in impls:
+                reference = references[kind]
+                x, c, w = [tensor.to(dtype) for tensor in inputs[kind]]
+                distances = fn(x, c, w)
+                err = ((distances.double() - reference).abs().max() / reference.abs().max()).item()
+                agree = (distances.argmin(1) == reference.argmin(1)).float().mean().item()
+                seconds = timeit(lambda: fn(x, c, w), device, args.repeat)
+                memory = peak_memory(lambda: fn(x, c, w), device)
+                name = "{} {}".format(name, str(dtype).replace("torch.float", "fp"))
+                report(name, seconds, memory, rel_err=err, argmin_agree=agree)
+                assert err < tol, "{} deviates from the reference".format(name)
+
+
+def make_quantizer_inputs(args, device, param_var_q=None):
+    # Encoder output, quantizer parameter and codebook with the shapes used by SQVAE
+    if param_var_q is None:
+        param_var_q = args.param_var_q
+    torch.manual_seed(0)
+    z = torch.randn(args.bs, args.dim, args.res, args.res, device=device)
+    if param_var_q == "vmf":
+        quantizer = VmfVectorQuantizer(args.size, args.dim, args.temperature)
+        z = torch.nn.functional.normalize(z, p=2.0, dim=1)
+        log_param_q = torch.tensor([3.0], device=device)
+    else:
+        quantizer = GaussianVectorQuantizer(args.size, args.dim, args.temperature, param_var_q)
+        shape_var = {
+            "gaussian_1": (1,), "gaussian_2": (args.bs, 1, 1, 1),
+            "gaussian_3": (args.bs, 1, args.res, args.res), "gaussian_4": z.shape}[param_var_q]
+        log_param_q = torch.randn(shape_var, device=device) * 0.1 - 3.0
+    z.requires_grad_(True)
+    log_param_q.requires_grad_(True)
+    codebook = torch.randn(args.size, args.dim, device=device, requires_grad=True)
+    return quantizer, z, log_param_q, codebook
+
+
+def bench_fused(args):
+    # Training step of the quantizer: standard autograd vs FusedStochasticQuantize, for each
+    # quantizer and tile size; outputs (--tol) and gradients (--tol_grad) must match
+    device = get_device(args.device)
+    for param_var_q in args.param_var_qs:
+        quantizer, z, log_param_q, codebook = make_quantizer_inputs(args, device, param_var_q)
+        inputs = [z, log_param_q, codebook]
+
+        def step(fused):
+            quantizer.fused = fused
+            torch.manual_seed(1)
+            z_q, loss, perplexity = quantizer(z, log_param_q.exp(), codebook, True)
+            total = loss + (z_q * torch.linspace(-1, 1, z_q.numel(), device=device).view_as(z_q)).sum()
+            grads = torch.autograd.grad(total, inputs)
+            return z_q.detach(), loss.detach(), perplexity.detach(), grads
+
+        for chunk_size in args.chunk_sizes:
+            quantizer.chunk_size = chunk_size
+            results = {}
+            for fused in [False, True]:
+                name = "{} chunk={} {}".format(param_var_q, chunk_size, "fused" if fused else "standard")
+                results[fused] = step(fused)
+                seconds = timeit(lambda: step(fused), device, args.repeat)
+                memory = peak_memory(lambda: step(fused), device)
+                report(name, seconds, memory)
+            standard, fused = results[False], results[True]
+            # Same Gumbel noise on both paths, so the outputs agree up to rounding
+            for i, name in enumerate(["z_to_decoder", "loss", "perplexity"]):
+                err = rel_diff(standard[i], fused[i])
+                print("{:<14s} max rel diff: {:.3e}".format(name, err))
+                assert err < args.tol, "fused {} deviates ({}, chunk_size={})".format(
+                    name, param_var_q, chunk_size)
+            for name, g_standard, g_fused in zip(["grad_z", "grad_param_q", "grad_codebook"], standard[3], fused[3]):
+                err = rel_diff(g_standard, g_fused)
+                print("{:<14s} max rel diff: {:.3e}".format(name, err))
+                assert err < args.tol_grad, "fused {} deviates ({}, chunk_size={})".format(
+                    name, param_var_q, chunk_size)
+
+
+def bench_topk(args):
+    # Top-k sparse Gumbel-softmax vs the dense quantizer (training step)
+    device = get_device(args.device)
+    quantizer, z, log_param_q, codebook = make_quantizer_inputs(args, device)
+
+    def step(topk):
+        quantizer.topk = topk
+        torch.manual_seed(1)
+        z_q, loss, perplexity = quantizer(z, log_param_q.exp(), codebook, True)
+        (loss + z_q.sum()).backward()
+        return loss.item(), perplexity.item()
+
+    loss_dense, perplexity_dense = step(0)
+    for topk in [0] + args.ks:
+        loss, perplexity = step(topk)
+        seconds = timeit(lambda: step(topk), device, args.repeat)
+        memory = peak_memory(lambda: step(topk), device)
+        throughput = args.bs * args.res * args.res / seconds
+        report("dense" if topk == 0 else "topk={}".format(topk), seconds, memory,
+            positions_per_sec=throughput,
+            loss_drift=(loss - loss_dense) / abs(loss_dense),
+            perplexity_drift=(perplexity - perplexity_dense) / perplexity_dense)
+
+
+def bench_index(args):
+    # Recall@1 and latency of the approximate (IVF) codebook search against the exact one
+    device = get_device(args.device)
+    torch.manual_seed(0)
+    if args.checkpoint != "":
+        codebook = load_codebook(args.checkpoint).to(device)
+    else:
+        codebook = torch.randn(args.size, args.dim, device=device)
+    # Queries are perturbed codes, as encoder outputs concentrate around the codebook
+    queries = codebook[torch.randint(codebook.shape[0], (args.n,), device=device)]
+    queries = queries + args.noise * queries.std() * torch.randn_like(queries)
+
+    exact = build_index(codebook, "exact")
+    indices_exact = exact.search(queries)
+    report("exact", timeit(lambda: exact.search(queries), device, args.repeat),
+        codes=codebook.shape[0])
+    start_time = time.perf_counter()
+    ivf = build_index(codebook, "ivf", nlist=args.nlist)
+    print("IVF build time: {:.3f} sec".format(time.perf_counter() - start_time))
+    for nprobe in args.nprobes:
+        ivf.nprobe = nprobe
+        recall = (ivf.search(queries) == indices_exact).float().mean().item()
+        report("ivf nprobe={}".format(nprobe), timeit(lambda: ivf.search(queries), device, args.repeat),
+            recall_at_1=recall)
+
+
+def make_model(args, device):
+    # Model built from a yaml file in configs/ and an input batch of the dataset shape
+    from main import load_config
+    cfgs, flgs = load_config(argparse.Namespace(
+        config_file=args.config, seed=0, save=False, dbg=False, device=str(device), threads=0))
+    model = eval("{}(cfgs, flgs)".format(cfgs.model.name)).to(device)
+    if args.checkpoint != "":
+        model.load_state_dict(torch.load(args.checkpoint, map_location=device))
+    model.eval()
+    torch.manual_seed(0)
+    _, height, width = cfgs.dataset.shape
+    if cfgs.model.param_var_q == "vmf":
+        x = torch.randint(cfgs.network.num_class, (args.bs, height, width), device=device).float()
+    else:
+        x = torch.rand((args.bs,) + tuple(cfgs.dataset.shape), device=device)
+    return model, x
+
+
+def bench_reconstruct(args):
+    # SQVAE.reconstruct() vs forward(x, False, True), which also computes the losses
+    device = get_device(args.device)
+    model, x = make_model(args, device)
+
+    def forward():
+        with torch.no_grad():
+            return model(x, False, True)[0]
+
+    err = (model.reconstruct(x) - forward()).abs().max().item()
+    for name, fn in [("forward", forward), ("reconstruct", lambda: model.reconstruct(x))]:
+        seconds = timeit(fn, device, args.repeat)
+        memory = peak_memory(fn, device)
+        report(name, seconds, memory, images_per_sec=args.bs / seconds)
+    print("max abs diff: {:.3e}".format(err))
+
+
+def bench_bessel(args):
+    # Pure-torch ive vs scipy.special.ive (values, gradients and the latency of a training step)
+    import scipy.special
+    from third_party.ive import ive as ive_scipy
+    device = get_device(args.device)
+    z = torch.cat([torch.logspace(-6, 4, args.n, dtype=torch.float64), torch.tensor([0.0], dtype=torch.float64)])
+    for v in args.orders:
+        reference = torch.from_numpy(scipy.special.ive(v, z.numpy()))
+        # d/dz ive(v, z) = ive(v-1, z) - ive(v, z) * (v + z) / z
+        reference_grad = (torch.from_numpy(scipy.special.ive(v - 1, z.numpy()))
+                        - reference * (v + z) / z)[:-1]
+        z_device = z.to(device).requires_grad_(True)
+        output = ive_torch(v, z_device)
+        grad = torch.autograd.grad(output.sum(), z_device)[0][:-1].cpu()
+        err = ((output.detach().cpu() - reference).abs() / reference.abs().clamp(min=1e-300)).max().item()
+        err_grad = ((grad - reference_grad).abs() / reference_grad.abs().clamp(min=1e-300)).max().item()
+        assert err < args.tol, "ive({}, z) deviates from scipy".format(v)
+        assert err_grad < args.tol_grad, "gradient of ive({}, z) deviates from scipy".format(v)
+
+        # Single-element call as in VmfSQVAE._log_normalization
+        kappa = torch.tensor([100.0], device=device, requires_grad=True)
+        step_torch = lambda: ive_torch(v, kappa).log().backward()
+        step_scipy = lambda: ive_scipy(v, kappa).log().backward()
+        report("torch v={}".format(v), timeit(step_torch, device, args.repeat), rel_err=err, rel_err_grad=err_grad)
+        report("scipy v={}".format(v), timeit(step_scipy, device, args.repeat))
+
+
+def vmf_loss_onehot(model, x_reconst, x, loss_latent):
+    # Former VmfSQVAE._calc_loss (one-hot selection on the channel-last output), as reference
+    num_channels = x_reconst.shape[1]
+    x_shape = x.shape
+    x = x.view(-1, 1)
+    x_reconst_viewed = x_reconst.permute(0, 2, 3, 1).contiguous().view(-1, num_channels)
+    x_reconst_normed = torch.nn.functional.normalize(x_reconst_viewed, p=2.0, dim=-1)
+    x_one_hot = (torch.nn.functional.one_hot(x.to(torch.int).long(), num_classes=num_channels)
+                .type_as(x))[:,0,:]
+    x_reconst_selected = (x_one_hot * x_reconst_normed).sum(-1).view(x_shape)
+    kappa_inv = model.log_kappa_inv.exp().add(1e-9)
+    loss_reconst = (- 1./kappa_inv * x_reconst_selected.sum((1,2)).mean()
+                    - model.dim_x * model._log_normalization(kappa_inv))
+    idx_estimated = torch.argmax(x_reconst_normed, dim=-1, keepdim=True)
+    acc = torch.isclose(x.to(int), idx_estimated).sum() / idx_estimated.numel()
+    return dict(all=loss_reconst + loss_latent, acc=acc)
+
+
+def bench_vmf_loss(args):
+    # Gather-based vMF reconstruction loss vs the one-hot selection (forward + backward)
+    device = get_device(args.device)
+    model, x = make_model(args, device)
+    num_channels = int(2 * model._VmfSQVAE__m)
+    x_reconst = torch.rand(x.shape[0], num_channels, x.shape[1], x.shape[2],
+        device=device, requires_grad=True)
+
+    def step(fn):
+        loss = fn(x_reconst, x, 0.)
+        grad = torch.autograd.grad(loss["all"], x_reconst)[0]
+        return loss["all"].detach(), loss["acc"], grad
+
+    results = {}
+    for name, fn in [("onehot", lambda *a: vmf_loss_onehot(model, *a)), ("gather", model._calc_loss)]:
+        results[name] = step(fn)
+        seconds = timeit(lambda: step(fn), device, args.repeat)
+        memory = peak_memory(lambda: step(fn), device)
+        report(name, seconds, memory, images_per_sec=x.shape[0] / seconds)
+    for i, name in enumerate(["loss", "acc", "grad"]):
+        diff = (results["onehot"][i].float() - results["gather"][i].float()).abs().max().item()
+        print("{:<14s} max abs diff: {:.3e}".format(name, diff))
+
+
+class PerceptualLossPrefixes(torch.nn.Module):
+    # Former PerceptualLoss (one VGG prefix per layer, constants allocated per call), as reference
+    def __init__(self, loss):
+        super(PerceptualLossPrefixes, self).__init__()
+        self.layers = loss.layers
+        self.weights = loss.weights
+        modules = list(loss.trunk.children())
+        self.feature_extractors = torch.nn.ModuleDict({
+            layer: torch.nn.Sequential(*modules[:loss.layer_name_mapping[layer]+1]) for layer in loss.layers})
+
+    def forward(self, pred, target):
+        if pred.size(1) == 1:
+            pred = pred.repeat(1, 3, 1, 1)
+        if target.size(1) == 1:
+            target = target.repeat(1, 3, 1, 1)
+        mean = torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1).to(pred.device)
+        std = torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1).to(pred.device)
+        pred = (pred - mean) / std
+        target = (target - mean) / std
+        total_loss = 0.0
+        for i, layer in enumerate(self.layers):
+            layer_loss = torch.nn.functional.mse_loss(
+                self.feature_extractors[layer](pred), self.feature_extractors[layer](target))
+            total_loss += self.weights[i] * layer_loss
+        return total_loss
+
+
+def bench_perceptual(args):
+    # Training step with the single-trunk PerceptualLoss vs one VGG prefix per layer
+    device = get_device(args.device)
+    model, x = make_model(args, device)
+    model.train()
+    loss_fn = model.perceptual_loss_fn
+    single_trunk = loss_fn.perceptual_loss
+    prefixes = PerceptualLossPrefixes(single_trunk).to(device)
+
+    def step():
+        torch.manual_seed(1)
+        model.zero_grad()
+        loss = model(x, True)[2]
+        loss["all"].backward()
+        return loss["perceptual_loss"].item()
+
+    results = {}
+    for name, module in [("prefixes", prefixes), ("single-trunk", single_trunk)]:
+        loss_fn.perceptual_loss = module
+        results[name] = step()
+        seconds = timeit(step, device, args.repeat)
+        memory = peak_memory(step, device)
+        report(name, seconds, memory, images_per_sec=x.shape[0] / seconds)
+    loss_fn.perceptual_loss = single_trunk
+    print("perceptual loss diff: {:.3e}".format(abs(results["prefixes"] - results["single-trunk"])))
+
+
+def resident_memory():
+    # Resident set size of the current process in MiB (Linux)
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return float("nan")
+
+
+def _vgg_startup(weight_store, queue):
+    from perceptual_loss import MicroDopplerPerceptualLoss
+    memory = resident_memory()
+    start_time = time.perf_counter()
+    MicroDopplerPerceptualLoss(weight_store=weight_store)
+    queue.put((time.perf_counter() - start_time, resident_memory() - memory))
+
+
+def bench_vgg_startup(args):
+    # Construction of the perceptual loss from the torchvision weights vs the local store,
+    # each in a fresh process
+    context = multiprocessing.get_context("spawn")
+    for name, weight_store in [("torchvision", ""), ("store", args.store)]:
+        queue = context.Queue()
+        process = context.Process(target=_vgg_startup, args=(weight_store, queue))
+        process.start()
+        seconds, memory = queue.get()
+        process.join()
+        report(name, seconds, memory)
+
+
+def bench_metrics(args):
+    # Training steps with per-step .item() metric reads vs the on-device MetricAccumulator
+    device = get_device(args.device)
+    model, x = make_model(args, device)
+    model.train()
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+
+    def epoch(accumulate):
+        metrics = MetricAccumulator(device)
+        values = {}
+        for _ in range(args.steps):
+            _, _, loss = model(x, True, False)
+            optimizer.zero_grad()
+            loss["all"].backward()
+            optimizer.step()
+            step_metrics = {key: value for key, value in loss.items() if key != "all"}
+            if accumulate:
+                metrics.update(loss=loss["all"], **step_metrics)
+            else:
+                values.setdefault("loss", []).append(loss["all"].item())
+                for key, value in step_metrics.items():
+                    values.setdefault(key, []).append(value.item())
+        if accumulate:
+            return metrics.result()
+        return {key: sum(value) / len(value) for key, value in values.items()}
+
+    for name, accumulate in [("item per step", False), ("accumulator", True)]:
+        seconds = timeit(lambda: epoch(accumulate), device, max(1, args.repeat // 5), warmup=1)
+        report(name, seconds / args.steps, steps_per_sec=args.steps / seconds)
+
+
+def bench_loader(args):
+    # One shuffled training epoch (batches converted to float on the device) through the
+    # per-item DataLoader vs the in-memory TensorLoader
+    device = get_device(args.device)
+    for name, in_memory in [("DataLoader", False), ("TensorLoader", True)]:
+        loader = get_loader(args.dataset, args.path_dataset, args.bs, args.nworker, in_memory=in_memory)[0]
+        checksum = 0.
+        start_time = time.perf_counter()
+        for x, _ in loader:
+            checksum += to_input(x, device).sum().item()
+        seconds = time.perf_counter() - start_time
+        report(name, seconds, images_per_sec=len(loader.dataset) / seconds)
+        print("  checksum: {:.6e}".format(checksum))
+
+
+def make_microdoppler_corpus(root, num_users, num_images, resolution=256):
+    # Synthetic ID_* folder layout of random RGB spectrogram PNGs
+    import numpy as np
+    from PIL import Image
+    rng = np.random.RandomState(0)
+    for user in range(1, num_users + 1):
+        user_path = os.path.join(root, "ID_{}".format(user))
+        os.makedirs(user_path, exist_ok=True)
+        for i in range(num_images):
+            image = rng.randint(0, 256, (resolution, resolution, 3), dtype=np.uint8)
+            Image.fromarray(image).save(os.path.join(user_path, "{:05d}.png".format(i)))
+
+
+def bench_shards(args):
+    # One shuffled training epoch from the ID_* folders vs from tar shards of a synthetic corpus
+    import tempfile
+    from util import get_loader_microdoppler
+    from shard_dataset import convert_microdoppler
+    device = get_device(args.device)
+    target_size = (args.size, args.size)
+    with tempfile.TemporaryDirectory() as tmp:
+        root = os.path.join(tmp, "dataset")
+        shard_path = os.path.join(tmp, "shards")
+        make_microdoppler_corpus(root, args.users, args.images)
+        convert_microdoppler(root, shard_path, args.size, args.samples_per_shard, args.nworker)
+        for name, shards in [("folders", ""), ("shards", shard_path)]:
+            loader = get_loader_microdoppler(root, args.bs, args.nworker, target_size, shard_path=shards)[0]
+            num_images = 0
+            start_time = time.perf_counter()
+            for x, _ in loader:
+                num_images += to_input(x, device).shape[0]
+            seconds = time.perf_counter() - start_time
+            report(name, seconds, images_per_sec=num_images / seconds)
+
+
+def add_quantizer_args(p, flg_variants=False):
+    p.add_argument("--bs", type=int, default=32, help="batch size")
+    p.add_argument("--res", type=int, default=32, help="latent resolution")
+    p.add_argument("--dim", type=int, default=64, help="code dimension")
+    p.add_argument("--size", type=int, default=512, help="codebook size")
+    if flg_variants:
+        p.add_argument("--param_var_qs", nargs="+", default=["gaussian_1", "gaussian_4", "vmf"],
+            help="quantizers to check (gaussian_1-4, vmf)")
+        p.add_argument("--chunk_sizes", type=int, nargs="+", default=[0, 4096],
+            help="quantization.chunk_size values to check (0: no tiling)")
+    else:
+        p.add_argument("--param_var_q", default="gaussian_1", help="gaussian_1-4 or vmf")
+    p.add_argument("--temperature", type=float, default=0.5, help="Gumbel-softmax temperature")
+
+
+def arg_parse():
+    parser = argparse.ArgumentParser(description="benchmark.py")
+    parser.add_argument("--device", default="", help="cuda or cpu (default: cuda if available)")
+    parser.add_argument("--repeat", type=int, default=10, help="timed repetitions")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    p = subparsers.add_parser("distance", help="codebook distances of the quantizers (vision and speech)")
+    p.add_argument("--n", type=int, default=4096, help="number of latent positions")
+    p.add_argument("--dim", type=int, default=64, help="code dimension")
+    p.add_argument("--size", type=int, default=512, help="codebook size")
+    p.add_argument("--tol", type=float, default=1e-4, help="max relative error in float32")
+    p.add_argument("--tol64", type=float, default=1e-10, help="max relative error in float64")
+    p.set_defaults(func=bench_distance)
+
+    p = subparsers.add_parser("fused", help="fused stochastic quantizer vs standard autograd")
+    add_quantizer_args(p, flg_variants=True)
+    p.add_argument("--tol", type=float, default=1e-5, help="max relative error of the outputs")
+    p.add_argument("--tol_grad", type=float, default=1e-4, help="max relative error of the gradients")
+    p.set_defaults(func=bench_fused)
+
+    p = subparsers.add_parser("topk", help="top-k sparse quantization vs dense")
+    add_quantizer_args(p)
+    p.add_argument("--ks", type=int, nargs="+", default=[8, 16, 32, 64], help="values of k")
+    p.set_defaults(func=bench_topk, temperature=0.2)
+
+    p = subparsers.add_parser("index", help="approximate vs exact nearest-code search")
+    p.add_argument("--checkpoint", default="", help="take the codebook from a checkpoint")
+    p.add_argument("--size", type=int, default=16384, help="codebook size (random codebook)")
+    p.add_argument("--dim", type=int, default=64, help="code dimension (random codebook)")
+    p.add_argument("--n", type=int, default=8192, help="number of queries")
+    p.add_argument("--noise", type=float, default=0.3, help="relative perturbation of the queries")
+    p.add_argument("--nlist", type=int, default=128, help="number of IVF cells")
+    p.add_argument("--nprobes", type=int, nargs="+", default=[1, 4, 8, 16], help="probed cells")
+    p.set_defaults(func=bench_index)
+
+    p = subparsers.add_parser("reconstruct", help="inference API vs forward with losses")
+    p.add_argument("--config", default="celebamask_vmf.yaml", help="yaml file in configs/")
+    p.add_argument("--checkpoint", default="", help="model weights (default: random)")
+    p.add_argument("--bs", type=int, default=32, help="batch size")
+    p.set_defaults(func=bench_reconstruct)
+
+    p = subparsers.add_parser("bessel", help="pure-torch ive vs scipy")
+    p.add_argument("--orders", type=float, nargs="+", default=[0, 0.5, 1, 9, 31], help="orders v")
+    p.add_argument("--n", type=int, default=10000, help="number of z values in [1e-6, 1e4]")
+    p.add_argument("--tol", type=float, default=1e-10, help="max relative error of the values")
+    # The reference gradient ive(v-1, z) - ive(v, z) * (v + z) / z loses about log10(z) digits
+    # to cancellation at large z, hence the looser tolerance
+    p.add_argument("--tol_grad", type=float, default=1e-8, help="max relative error of the gradients")
+    p.set_defaults(func=bench_bessel)
+
+    p = subparsers.add_parser("vmf_loss", help="gather-based vMF reconstruction loss vs one-hot")
+    p.add_argument("--config", default="celebamask_vmf.yaml", help="yaml file in configs/")
+    p.add_argument("--checkpoint", default="", help="model weights (default: random)")
+    p.add_argument("--bs", type=int, default=32, help="batch size")
+    p.set_defaults(func=bench_vmf_loss)
+
+    p = subparsers.add_parser("perceptual", help="single-trunk perceptual loss vs per-layer VGG prefixes")
+    p.add_argument("--config", default="microdoppler_gauss_1_64x64_perceptual.yaml", help="yaml file in configs/")
+    p.add_argument("--checkpoint", default="", help="model weights (default: random)")
+    p.add_argument("--bs", type=int, default=16, help="batch size")
+    p.set_defaults(func=bench_perceptual)
+
+    p = subparsers.add_parser("vgg_startup", help="perceptual loss start-up: torchvision vs local weight store")
+    p.add_argument("--store", required=True, help="directory made by vgg_store.py")
+    p.set_defaults(func=bench_vgg_startup)
+
+    p = subparsers.add_parser("metrics", help="on-device metric accumulation vs per-step .item()")
+    p.add_argument("--config", default="cifar10_gauss_1.yaml", help="yaml file in configs/")
+    p.add_argument("--checkpoint", default="", help="model weights (default: random)")
+    p.add_argument("--bs", type=int, default=32, help="batch size")
+    p.add_argument("--steps", type=int, default=50, help="training steps per timed epoch")
+    p.set_defaults(func=bench_metrics)
+
+    p = subparsers.add_parser("loader", help="training epoch: per-item DataLoader vs in-memory TensorLoader")
+    p.add_argument("--dataset", default="CIFAR10", choices=["MNIST", "FashionMNIST", "CIFAR10"], help="dataset")
+    p.add_argument("--path_dataset", default="/dataset_path", help="dataset directory (downloaded if missing)")
+    p.add_argument("--bs", type=int, default=32, help="batch size")
+    p.add_argument("--nworker", type=int, default=2, help="DataLoader workers")
+    p.set_defaults(func=bench_loader)
+
+    p = subparsers.add_parser("shards", help="training epoch: ID_* folders vs tar shards (synthetic corpus)")
+    p.add_argument("--users", type=int, default=8, help="number of ID_* folders")
+    p.add_argument("--images", type=int, default=128, help="images per folder")
+    p.add_argument("--size", type=int, default=64, choices=[64, 256], help="training resolution")
+    p.add_argument("--samples_per_shard", type=int, default=256, help="samples per tar shard")
+    p.add_argument("--bs", type=int, default=32, help="batch size")
+    p.add_argument("--nworker", type=int, default=2, help="DataLoader workers")
+    p.set_defaults(func=bench_shards)
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = arg_parse()
+    args.func(args)
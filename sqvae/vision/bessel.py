@@ -0,0 +1,64 @@
+"""
+Exponentially scaled modified Bessel function of the first kind, ive(v, z) = I_v(z) * exp(-z),
+in pure torch (on the device of z, differentiable w.r.t. z) for a scalar order v >= 0 and z >= 0.
+
+Two expansions are used, switching at Z(v) = max(30, v^2 / 2):
+  - z < Z(v): the power series
+        I_v(z) = sum_k (z/2)^(2k+v) / (k! Gamma(k+v+1)),
+    summed in log space with logsumexp, truncated after ceil(Z/2 + 8 sqrt(Z) + 20) terms
+    (the terms peak around k = z/2 and decay faster than a Gaussian of width sqrt(z)).
+  - z >= Z(v): the Hankel asymptotic expansion
+        ive(v, z) = 1 / sqrt(2 pi z) * sum_k (-1)^k a_k(v) / z^k,
+        a_k(v) = prod_{j=1..k} (4v^2 - (2j-1)^2) / (k! 8^k),
+    truncated after 20 terms. For z >= v^2 / 2 the k-th term is bounded by 1/k!.
+Both are evaluated in float64; the relative error w.r.t. scipy.special.ive is below 1e-10
+(checked by 'python benchmark.py bessel'). Each branch only sees the inputs clamped to its
+own domain, so the unused branch produces no inf/NaN gradients.
+"""
+import math
+
+import torch
+
+
+NUM_TERMS_ASYMPTOTIC = 20
+
+
+def _threshold(v):
+    return max(30.0, v * v / 2.0)
+
+
+def _log_ive_series(v, z, threshold):
+    num_terms = int(math.ceil(threshold / 2 + 8 * math.sqrt(threshold) + 20))
+    k = torch.arange(num_terms, dtype=z.dtype, device=z.device)
+    log_terms = ((2 * k + v) * torch.log(z / 2).unsqueeze(-1)
+                - torch.lgamma(k + 1) - torch.lgamma(k + v + 1))
+    return torch.logsumexp(log_terms, dim=-1) - z
+
+
+def _log_ive_asymptotic(v, z):
+    coeff = 1.0
+    total = torch.ones_like(z)
+    z_inv = 1. / z
+    z_inv_k = torch.ones_like(z)
+    for k in range(1, NUM_TERMS_ASYMPTOTIC):
+        coeff *= -(4 * v * v - (2 * k - 1) ** 2) / (k * 8.0)
+        z_inv_k = z_inv_k * z_inv
+        total = total + coeff * z_inv_k
+    return torch.log(total) - 0.5 * torch.log(2 * math.pi * z)
+
+
+def log_ive(v, z, eps=1e-30):
+    v = float(v)
+    assert v >= 0, "v must be >= 0, it is {}".format(v)
+    dtype = z.dtype
+    z = z.double()
+    threshold = _threshold(v)
+    z_small = z.clamp(min=eps, max=threshold)
+    z_large = z.clamp(min=threshold)
+    output = torch.where(z < threshold,
+        _log_ive_series(v, z_small, threshold), _log_ive_asymptotic(v, z_large))
+    return output.to(dtype)
+
+
+def ive(v, z):
+    return log_ive(v, z).exp()
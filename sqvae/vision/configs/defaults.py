@@ -5,11 +5,19 @@ _C.path = "/checkpoint_path" # To be set in advance
 _C.path_dataset = "/dataset_path" # To be set in advance
 _C.nworker = 2
 _C.list_dir_for_copy = ['', 'networks/'] # []
+_C.device = "" # "cuda" or "cpu" ("": cuda if available)
+_C.num_threads = 0 # Intra-op CPU threads (0: torch default)
 
 
 _C.dataset = CN(new_allowed=True)
+_C.dataset.cache = False # MicroDoppler: read the splits from a packed uint8 cache (image_cache.py)
+_C.dataset.cache_path = "" # Packed image cache directory ("": <path>/image_cache)
+_C.dataset.shards = "" # MicroDoppler: directory of tar shards made by shard_dataset.py ("": image folders)
+_C.dataset.shuffle_buffer = 1000 # Samples in the shuffle buffer of the shard stream
+_C.dataset.in_memory = True # MNIST/FashionMNIST/CIFAR10: batches from one in-memory uint8 tensor (util.TensorLoader)
 
 _C.model = CN(new_allowed=True)
+_C.model.ive_backend = "torch" # Bessel function of the vMF normalizer: "torch" (bessel.py) or "scipy" (third_party/ive.py)
 
 _C.network = CN(new_allowed=True)
 
@@ -17,15 +25,35 @@ _C.train = CN(new_allowed=True)
 _C.train.bs = 32
 _C.train.lr = 0.001
 _C.train.epoch_max = 100
+_C.train.background_io = True # Write checkpoints in a background thread and render reconstructions in a worker process
+_C.train.log_interval = 0 # Print the running training metrics every log_interval steps (0: once per epoch)
+_C.train.checkpoint_interval = 0 # Also save the full training state (state.pt) every checkpoint_interval steps (0: at the end of epochs only)
 
 _C.quantization = CN(new_allowed=True)
 _C.quantization.temperature = CN(new_allowed=True)
 _C.quantization.temperature.init = 1.0
 _C.quantization.temperature.decay = 0.00001
 _C.quantization.temperature.min = 0.0
+_C.quantization.chunk_size = 0 # Latent positions per quantization tile (0: no tiling)
+_C.quantization.fused = False # Recompute the softmax terms in backward instead of storing them
+_C.quantization.topk = 0 # Sample among the topk nearest codes only (0: all codes)
 
 _C.test = CN(new_allowed=True)
 _C.test.bs = 50
+_C.test.skip_stochastic = False # Validate with deterministic quantization only (no stochastic pass)
+
+_C.perceptual = CN(new_allowed=True)
+_C.perceptual.weights = "" # Local VGG trunk made by vgg_store.py ("": download the torchvision weights)
+_C.perceptual.cache = False # Precompute the VGG features of the training images (with flags.perceptual_loss)
+_C.perceptual.cache_path = "" # Feature cache directory ("": <path>/perceptual_cache)
+_C.perceptual.cache_fp16 = True # Store the cached features in float16
+
+_C.profile = CN(new_allowed=True)
+_C.profile.path = "" # JSONL file of per-phase step timings in the run directory ("": disabled)
+_C.profile.interval = 100 # Steps averaged in each JSONL record
+_C.profile.trace_dir = "" # torch.profiler trace directory in the run directory ("": disabled)
+_C.profile.trace_start = 10 # Steps before the traced window
+_C.profile.trace_steps = 5 # Steps in the traced window
 
 _C.flags = CN(new_allowed=True)
 _C.flags.arelbo = True
@@ -3,10 +3,40 @@ import torch
 import numpy as np
 from PIL import Image
 from torch.utils.data import Dataset
-import glob
+
+from dataset_manifest import get_manifest
+
+IMAGE_PATTERNS = ['*.png', '*.jpg', '*.jpeg']
+
+
+def microdoppler_splits(manifest, train_ratio=0.7, val_ratio=0.15):
+    """
+    按用户划分数据集 (避免数据泄露)，结果保存在manifest中
+
+    返回: (用户文件夹列表, {'train'/'val'/'test': 用户列表})
+    """
+    # 查找所有用户文件夹 (ID_1, ID_2, ..., ID_31)
+    user_folders = sorted(name for name in manifest.scan()["dirs"] if name.startswith('ID_'))
+    saved = manifest.extra.get("splits")
+    if saved is not None and saved["users"] == user_folders and saved["ratios"] == [train_ratio, val_ratio]:
+        return user_folders, saved
+
+    # 固定随机种子 (与 np.random.seed(42) 后的 permutation 相同，但不改变全局随机状态)
+    user_indices = np.random.RandomState(42).permutation(len(user_folders))
+    train_user_end = int(train_ratio * len(user_folders))
+    val_user_end = int((train_ratio + val_ratio) * len(user_folders))
+    splits = dict(
+        users=user_folders, ratios=[train_ratio, val_ratio],
+        train=[user_folders[i] for i in user_indices[:train_user_end]],
+        val=[user_folders[i] for i in user_indices[train_user_end:val_user_end]],
+        test=[user_folders[i] for i in user_indices[val_user_end:]])
+    manifest.set_extra("splits", splits)
+    return user_folders, splits
+
 
 class MicroDopplerDataset(Dataset):
-    def __init__(self, root, transform=None, split='train', train_ratio=0.7, val_ratio=0.15):
+    def __init__(self, root, transform=None, split='train', train_ratio=0.7, val_ratio=0.15, manifest_path=None,
+                 num_channels=3):
         """
         微多普勒数据集加载器
         
@@ -16,56 +46,44 @@ class MicroDopplerDataset(Dataset):
             split (str): 'train', 'val', 或 'test'
             train_ratio (float): 训练集比例
             val_ratio (float): 验证集比例
+            manifest_path (str, optional): 文件清单路径 (默认见 dataset_manifest.py)
+            num_channels (int): 3 (RGB) 或 1 (灰度频谱图，不复制为RGB)
         """
         self.root = root
         self.transform = transform
         self.split = split
-        
-        # 查找所有用户文件夹 (ID_1, ID_2, ..., ID_31)
-        user_folders = []
-        for item in os.listdir(root):
-            item_path = os.path.join(root, item)
-            if os.path.isdir(item_path) and item.startswith('ID_'):
-                user_folders.append(item)
+        self.image_mode = 'L' if num_channels == 1 else 'RGB'
 
-        user_folders = sorted(user_folders)  # ID_1, ID_2, ..., ID_31
+        # 文件清单：各划分共享，目录未变化时不重新扫描
+        manifest = get_manifest(root, manifest_path)
+        user_folders, splits = microdoppler_splits(manifest, train_ratio, val_ratio)
         self.id_to_label = {folder: i for i, folder in enumerate(user_folders)}
+        selected_users = splits[split if split in ('train', 'val') else 'test']
 
-        # 按用户划分数据集 (避免数据泄露)
-        np.random.seed(42)  # 固定随机种子
-        user_indices = np.random.permutation(len(user_folders))
-        train_user_end = int(train_ratio * len(user_folders))
-        val_user_end = int((train_ratio + val_ratio) * len(user_folders))
-
-        if split == 'train':
-            selected_users = [user_folders[i] for i in user_indices[:train_user_end]]
-        elif split == 'val':
-            selected_users = [user_folders[i] for i in user_indices[train_user_end:val_user_end]]
-        else:  # test
-            selected_users = [user_folders[i] for i in user_indices[val_user_end:]]
-
-        # 收集选定用户的所有图像
+        # 收集选定用户的所有图像及标签
         self.image_paths = []
+        self.labels = []
+        rel_paths = []
         for user in selected_users:
             user_path = os.path.join(root, user)
-            for ext in ['*.png', '*.jpg', '*.jpeg']:
-                self.image_paths.extend(glob.glob(os.path.join(user_path, ext)))
+            names = manifest.files(user, IMAGE_PATTERNS)
+            self.image_paths.extend(os.path.join(user_path, name) for name in names)
+            rel_paths.extend(os.path.join(user, name) for name in names)
+            self.labels.extend([self.id_to_label[user]] * len(names))
+        # 图像文件mtime的哈希：同名覆盖的图像也会使派生缓存失效 (image_cache.py)
+        self.source_digest = manifest.digest(rel_paths)
+        manifest.save()
 
         print(f"{split.upper()} 集: {len(selected_users)} 用户, {len(self.image_paths)} 图像")
-        print(f"用户列表: {selected_users}")
     
     def __len__(self):
         return len(self.image_paths)
     
     def __getitem__(self, index):
         image_path = self.image_paths[index]
-        image = Image.open(image_path).convert('RGB')
+        image = Image.open(image_path).convert(self.image_mode)
             
         if self.transform:
             image = self.transform(image)
         
-        # 提取用户ID作为标签
-        user_id = os.path.basename(os.path.dirname(image_path))
-        label = self.id_to_label[user_id]
-        
-        return image, label
+        return image, self.labels[index]
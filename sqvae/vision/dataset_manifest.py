@@ -0,0 +1,123 @@
+"""
+Persisted listing of dataset directories, so that datasets do not rescan them at every start.
+
+For each scanned directory (relative to the root), the manifest holds its mtime, its files
+with their mtimes (in directory order) and its subdirectories. It is validated incrementally:
+a directory is only listed again when its mtime changed (a file was added, removed or
+renamed); otherwise its files are only stat'ed (once per process), which updates the mtimes
+of files rewritten in place under the same name. Caches derived from the listed files can
+include Manifest.digest() in their key to be rebuilt after such changes. The manifest is stored in
+~/.cache/sqvae/manifests/ (outside the root, which may be read-only, and whose mtime it
+must not change) and memoized per process, so that the train/val/test datasets of a root
+share it.
+Datasets may store derived data (e.g. a split assignment) in Manifest.extra.
+"""
+import os
+import json
+import fnmatch
+import hashlib
+
+
+MANIFEST_DIR = os.path.expanduser("~/.cache/sqvae/manifests")
+_MANIFESTS = {}
+
+
+def default_manifest_path(root):
+    root_hash = hashlib.sha1(os.path.abspath(root).encode()).hexdigest()[:16]
+    return os.path.join(MANIFEST_DIR, root_hash + ".json")
+
+
+class Manifest(object):
+    def __init__(self, root, path=None):
+        self.root = os.path.abspath(root)
+        self.path = default_manifest_path(root) if path is None else path
+        self.entries = {}
+        self.extra = {}
+        self.checked = set() # Directories whose file mtimes were validated in this process
+        self.dirty = False
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                data = json.load(f)
+            if data.get("root") == self.root:
+                self.entries = data["entries"]
+                self.extra = data.get("extra", {})
+
+    def scan(self, rel=""):
+        # Entry {"mtime", "files": [[name, mtime], ...], "dirs": [name, ...]} of a directory
+        path = os.path.join(self.root, rel)
+        mtime = os.stat(path).st_mtime
+        entry = self.entries.get(rel)
+        if entry is not None and entry["mtime"] == mtime and self._check_files(rel, entry):
+            self.checked.add(rel)
+            return entry
+        files, dirs = [], []
+        with os.scandir(path) as it:
+            for item in it:
+                if item.is_dir():
+                    dirs.append(item.name)
+                elif item.is_file():
+                    files.append([item.name, item.stat().st_mtime])
+        entry = dict(mtime=mtime, files=files, dirs=dirs)
+        self.entries[rel] = entry
+        self.checked.add(rel)
+        self.dirty = True
+        return entry
+
+    def _check_files(self, rel, entry):
+        # Updates the mtimes of the files modified since the last scan; False if one is gone
+        if rel in self.checked:
+            return True
+        path = os.path.join(self.root, rel)
+        for item in entry["files"]:
+            try:
+                mtime = os.stat(os.path.join(path, item[0])).st_mtime
+            except FileNotFoundError:
+                return False
+            if item[1] != mtime:
+                item[1] = mtime
+                self.dirty = True
+        return True
+
+    def files(self, rel="", patterns=("*",)):
+        # Names of the files of a directory matching the patterns, grouped by pattern
+        # in directory order (the order of glob.glob for each pattern)
+        names = [name for name, _ in self.scan(rel)["files"] if not name.startswith(".")]
+        return [name for pattern in patterns for name in names if fnmatch.fnmatchcase(name, pattern)]
+
+    def digest(self, paths):
+        # Hash of the mtimes of files (relative to the root); changes when one is rewritten
+        listings = {}
+        stamps = []
+        for path in paths:
+            rel, name = os.path.split(path)
+            if rel not in listings:
+                listings[rel] = dict(self.scan(rel)["files"])
+            stamps.append([path, listings[rel][name]])
+        return hashlib.sha1(json.dumps(stamps).encode()).hexdigest()
+
+    def set_extra(self, key, value):
+        if self.extra.get(key) != value:
+            self.extra[key] = value
+            self.dirty = True
+
+    def save(self):
+        # Atomic write; a manifest that cannot be written only costs a rescan next time
+        if not self.dirty:
+            return
+        tmp_path = "{}.{}.tmp".format(self.path, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(tmp_path, "w") as f:
+                json.dump(dict(root=self.root, entries=self.entries, extra=self.extra), f)
+            os.replace(tmp_path, self.path)
+        except OSError as error:
+            print("Could not save the dataset manifest {}: {}".format(self.path, error))
+        self.dirty = False
+
+
+def get_manifest(root, path=None):
+    # Manifest of root, shared by the datasets of this process
+    key = (os.path.abspath(root), path)
+    if key not in _MANIFESTS:
+        _MANIFESTS[key] = Manifest(root, path)
+    return _MANIFESTS[key]
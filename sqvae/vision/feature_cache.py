@@ -0,0 +1,165 @@
+"""
+Memory-mapped cache of the VGG features of the training images for the perceptual loss.
+
+The features of each tapped layer are stored in <path>/<layer>.npy (N x C x H x W, float16 or
+float32) and indexed by dataset item; <path>/meta.json holds the cache key. The key covers the
+image transform (e.g. the resize), the dataset root, the image shape (so the number of
+channels), the layer list and the number of items, and the cache is rebuilt when it does
+not match. The cache is built offline with
+    python feature_cache.py -c microdoppler_gauss_1_64x64_perceptual.yaml
+or by the trainer on first use (perceptual.cache: True).
+"""
+import os
+import json
+import hashlib
+import argparse
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset, Subset, DataLoader
+
+from util import _make_loader, ResumableSampler, to_input
+
+
+CACHE_VERSION = 2 # Bumped whenever the key description changes
+
+
+def base_dataset(dataset):
+    while isinstance(dataset, Subset):
+        dataset = dataset.dataset
+    return dataset
+
+
+def dataset_transform(dataset):
+    dataset = base_dataset(dataset)
+    # Packed datasets (image_cache.py) are described by their key (root, size, split, channels)
+    return getattr(dataset, "transform", None) or getattr(dataset, "key", None)
+
+
+def cache_key(dataset, layers):
+    # The shape of an item gives the channel count (grayscale or RGB runs of the same root)
+    root = getattr(base_dataset(dataset), "root", None)
+    description = json.dumps(dict(
+        version=CACHE_VERSION, transform=repr(dataset_transform(dataset)),
+        root=None if root is None else os.path.abspath(root),
+        shape=list(dataset[0][0].shape), layers=list(layers), num_items=len(dataset)))
+    return hashlib.sha1(description.encode()).hexdigest()
+
+
+class FeatureCache(object):
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.layers = self.meta["layers"]
+        self.features = None # Opened lazily in each DataLoader worker
+
+    def __len__(self):
+        return self.meta["num_items"]
+
+    def __getitem__(self, index):
+        if self.features is None:
+            self.features = [np.load(os.path.join(self.path, layer + ".npy"), mmap_mode="r")
+                for layer in self.layers]
+        return [torch.from_numpy(np.array(feature[index])) for feature in self.features]
+
+    @staticmethod
+    def is_valid(path, key):
+        path_meta = os.path.join(path, "meta.json")
+        if not os.path.exists(path_meta):
+            return False
+        with open(path_meta) as f:
+            return json.load(f)["key"] == key
+
+    @classmethod
+    def build(cls, dataset, perceptual_loss, path, fp16=True, bs=64, n_work=0, device="cpu"):
+        # Features of the dataset items in order; meta.json is written last so that an
+        # interrupted build is never taken as valid
+        os.makedirs(path, exist_ok=True)
+        path_meta = os.path.join(path, "meta.json")
+        if os.path.exists(path_meta):
+            os.remove(path_meta)
+        dtype = np.float16 if fp16 else np.float32
+        loader = DataLoader(dataset, batch_size=bs, shuffle=False, num_workers=n_work)
+        perceptual_loss = perceptual_loss.to(device).eval()
+        stores = None
+        start = 0
+        with torch.no_grad():
+            for batch in loader:
+                x = to_input(batch[0], device)
+                features = perceptual_loss.extract_features(x)
+                if stores is None:
+                    stores = [np.lib.format.open_memmap(os.path.join(path, layer + ".npy"), mode="w+",
+                        dtype=dtype, shape=(len(dataset),) + tuple(feature.shape[1:]))
+                        for layer, feature in zip(perceptual_loss.layers, features)]
+                for store, feature in zip(stores, features):
+                    store[start:start+x.shape[0]] = feature.cpu().numpy().astype(dtype)
+                start += x.shape[0]
+        for store in stores:
+            store.flush()
+        del stores
+        with open(path_meta, "w") as f:
+            json.dump(dict(key=cache_key(dataset, perceptual_loss.layers), layers=list(perceptual_loss.layers),
+                num_items=len(dataset), fp16=fp16), f)
+        return cls(path)
+
+
+class FeatureCacheDataset(Dataset):
+    """Items of a dataset followed by the list of cached target features of the item."""
+    def __init__(self, dataset, cache):
+        assert len(dataset) == len(cache), "Feature cache does not match the dataset"
+        self.dataset = dataset
+        self.cache = cache
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        return tuple(self.dataset[index]) + (self.cache[index],)
+
+
+def get_feature_cache(dataset, perceptual_loss, path, fp16=True, n_work=0, device="cpu"):
+    # Cache of the dataset, (re)built if missing or built for another transform/layer list
+    key = cache_key(dataset, perceptual_loss.layers)
+    if FeatureCache.is_valid(path, key):
+        return FeatureCache(path)
+    print("Building perceptual feature cache: {}".format(path))
+    return FeatureCache.build(dataset, perceptual_loss, path, fp16, n_work=n_work, device=device)
+
+
+def feature_cache_path(cfgs):
+    if cfgs.perceptual.cache_path != "":
+        return cfgs.perceptual.cache_path
+    return os.path.join(cfgs.path, "perceptual_cache")
+
+
+def wrap_loader(loader, cache):
+    shuffle = isinstance(loader.sampler, ResumableSampler) and loader.sampler.shuffle
+    return _make_loader(FeatureCacheDataset(loader.dataset, cache), loader.batch_size,
+        shuffle, loader.num_workers, loader.pin_memory)
+
+
+def arg_parse():
+    parser = argparse.ArgumentParser(description="feature_cache.py")
+    parser.add_argument("-c", "--config_file", default="", help="config file")
+    parser.add_argument("--device", default="", help="cuda or cpu (default: cuda if available)")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    from main import load_config
+    from util import get_loader, image_cache_path
+    from perceptual_loss import MicroDopplerPerceptualLoss
+    args = arg_parse()
+    cfgs, flgs = load_config(argparse.Namespace(
+        config_file=args.config_file, seed=0, save=False, dbg=False, device=args.device, threads=0))
+    target_size = tuple(cfgs.dataset.shape[1:]) if cfgs.dataset.name == "MicroDoppler" else None
+    dataset_path = getattr(cfgs.dataset, 'root_path', cfgs.path_dataset)
+    train_loader, _, _ = get_loader(cfgs.dataset.name, dataset_path, cfgs.train.bs, cfgs.nworker, target_size,
+        image_cache_path(cfgs) if cfgs.dataset.cache else "", cfgs.dataset.in_memory,
+        cfgs.dataset.shards, cfgs.dataset.shuffle_buffer, cfgs.dataset.shape[0])
+    perceptual_loss = MicroDopplerPerceptualLoss(weight_store=cfgs.perceptual.weights).perceptual_loss
+    path = feature_cache_path(cfgs)
+    cache = get_feature_cache(train_loader.dataset, perceptual_loss, path,
+        cfgs.perceptual.cache_fp16, cfgs.nworker, cfgs.device)
+    print("Feature cache of {} items ({}): {}".format(len(cache), ", ".join(cache.layers), path))
@@ -0,0 +1,125 @@
+"""
+Packed uint8 image cache of the MicroDoppler splits.
+
+Each split is decoded and resized once and written to
+<cache_path>/<split>_<C>x<H>x<W>_<root hash>/ as
+    images.npy      N x C x H x W uint8 (memory-mapped when read)
+    labels.npy      N int64
+    manifest.json   root, size, split, channels and the source mtime digest (the cache key)
+                    and the source image paths
+manifest.json is written last, so an interrupted packing is never taken as valid. The 64x64
+and 256x256 caches of a dataset root coexist. Items are zero-copy views of the memory map;
+batches stay uint8 until util.to_input() converts them on the device. The cache is built with
+    python image_cache.py -c microdoppler_gauss_1_64x64.yaml
+or on first use (dataset.cache: True).
+"""
+import os
+import json
+import hashlib
+import argparse
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DataLoader
+from torchvision import transforms
+
+
+def cache_dir(cache_path, root, size, split, num_channels=3):
+    root_hash = hashlib.sha1(os.path.abspath(root).encode()).hexdigest()[:10]
+    return os.path.join(cache_path, "{}_{}x{}x{}_{}".format(split, num_channels, size[0], size[1], root_hash))
+
+
+class PackedImageDataset(Dataset):
+    """(uint8 C x H x W image, label) items of a packed split."""
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "manifest.json")) as f:
+            manifest = json.load(f)
+        self.key = manifest["key"]
+        self.num_items = manifest["num_items"]
+        self.labels = np.load(os.path.join(path, "labels.npy"))
+        self.images = None # Opened lazily in each DataLoader worker
+
+    def __len__(self):
+        return self.num_items
+
+    def __getitem__(self, index):
+        if self.images is None:
+            # Copy-on-write mapping, so that the items are writable views of the pages
+            self.images = np.load(os.path.join(self.path, "images.npy"), mmap_mode="c")
+        return torch.from_numpy(self.images[index]), int(self.labels[index])
+
+    @staticmethod
+    def is_valid(path, key):
+        path_manifest = os.path.join(path, "manifest.json")
+        if not os.path.exists(path_manifest):
+            return False
+        with open(path_manifest) as f:
+            return json.load(f)["key"] == key
+
+    @classmethod
+    def pack(cls, dataset, path, key, n_work=0):
+        # dataset yields (uint8 C x H x W tensor, label) in order
+        os.makedirs(path, exist_ok=True)
+        path_manifest = os.path.join(path, "manifest.json")
+        if os.path.exists(path_manifest):
+            os.remove(path_manifest)
+        loader = DataLoader(dataset, batch_size=64, shuffle=False, num_workers=n_work)
+        images = None
+        labels = np.zeros(len(dataset), dtype=np.int64)
+        start = 0
+        for x, y in loader:
+            if images is None:
+                images = np.lib.format.open_memmap(os.path.join(path, "images.npy"), mode="w+",
+                    dtype=np.uint8, shape=(len(dataset),) + tuple(x.shape[1:]))
+            images[start:start+x.shape[0]] = x.numpy()
+            labels[start:start+x.shape[0]] = y.numpy()
+            start += x.shape[0]
+        images.flush()
+        del images
+        np.save(os.path.join(path, "labels.npy"), labels)
+        with open(path_manifest, "w") as f:
+            json.dump(dict(key=key, num_items=len(dataset),
+                paths=[os.path.relpath(p, key["root"]) for p in dataset.image_paths]), f)
+        return cls(path)
+
+
+def get_packed_microdoppler(root, split, size, cache_path, n_work=0, num_channels=3):
+    # Packed split, (re)built if missing, built for another root/size/split/channel count or
+    # if a source image was added, removed or rewritten since (dataset manifest mtimes)
+    from custom_dataset import MicroDopplerDataset
+    from util import get_rank, barrier
+    path = cache_dir(cache_path, root, size, split, num_channels)
+    if get_rank() != 0:
+        barrier()
+    if get_rank() == 0:
+        transform = transforms.Compose([transforms.Resize(tuple(size)), transforms.PILToTensor()])
+        dataset = MicroDopplerDataset(root, transform=transform, split=split, num_channels=num_channels)
+        key = dict(root=os.path.abspath(root), size=list(size), split=split, channels=num_channels,
+            sources=dataset.source_digest)
+        if not PackedImageDataset.is_valid(path, key):
+            print("Packing {} split of {} at {}x{}: {}".format(split, root, size[0], size[1], path))
+            PackedImageDataset.pack(dataset, path, key, n_work)
+    if get_rank() == 0:
+        barrier()
+    return PackedImageDataset(path)
+
+
+def arg_parse():
+    parser = argparse.ArgumentParser(description="image_cache.py")
+    parser.add_argument("-c", "--config_file", default="", help="config file")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    from main import load_config
+    from util import image_cache_path, microdoppler_size
+    args = arg_parse()
+    cfgs, flgs = load_config(argparse.Namespace(
+        config_file=args.config_file, seed=0, save=False, dbg=False, device="cpu", threads=0))
+    root = getattr(cfgs.dataset, 'root_path', cfgs.path_dataset)
+    size = microdoppler_size(tuple(cfgs.dataset.shape[1:]))
+    for split in ["train", "val", "test"]:
+        dataset = get_packed_microdoppler(root, split, size, image_cache_path(cfgs), cfgs.nworker,
+            cfgs.dataset.shape[0])
+        print("{}: {} items ({})".format(split, len(dataset), dataset.path))
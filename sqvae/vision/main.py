@@ -1,10 +1,11 @@
 import os
 import argparse
 from configs.defaults import get_cfgs_defaults
+import numpy as np
 import torch
 
 from trainer import GaussianSQVAETrainer, VmfSQVAETrainer
-from util import set_seeds, get_loader
+from util import set_seeds, get_loader, init_distributed, get_rank, image_cache_path
 
 
 def arg_parse():
@@ -16,12 +17,20 @@ def arg_parse():
         "-ts", "--timestamp", default="", help="saved path (random seed + date)")
     parser.add_argument(
         "--save", action="store_true", help="save trained model")
+    parser.add_argument(
+        "--resume", action="store_true", help="continue training from state.pt of the -ts run")
     parser.add_argument(
         "--dbg", action="store_true", help="print losses per epoch")
     parser.add_argument(
         "--gpu", default="0", help="index of gpu to be used")
     parser.add_argument(
         "--seed", type=int, default=0, help="seed number for randomness")
+    parser.add_argument(
+        "--device", default="", help="cuda or cpu (default: cuda if available)")
+    parser.add_argument(
+        "--threads", type=int, default=0, help="number of intra-op CPU threads (0: torch default)")
+    parser.add_argument(
+        "--dist_backend", default="", help="torchrun process group backend (default: nccl on cuda, gloo on cpu)")
     args = parser.parse_args()
     return args
 
@@ -32,10 +41,26 @@ def load_config(args):
     print(config_path)
     cfgs.merge_from_file(config_path)
     cfgs.train.seed = args.seed
-    cfgs.flags.save = args.save
-    cfgs.flags.noprint = not args.dbg
+    if args.device != "":
+        cfgs.device = args.device
+    elif cfgs.device == "":
+        cfgs.device = "cuda" if torch.cuda.is_available() else "cpu"
+    if "LOCAL_RANK" in os.environ:
+        # Launched with torchrun: one process per device, rank 0 saves and prints
+        init_distributed(cfgs.device, getattr(args, "dist_backend", ""))
+        if cfgs.device == "cuda":
+            cfgs.device = "cuda:{}".format(os.environ["LOCAL_RANK"])
+    cfgs.flags.save = args.save and get_rank() == 0
+    cfgs.flags.noprint = not args.dbg or get_rank() != 0
+    if args.threads > 0:
+        cfgs.num_threads = args.threads
     cfgs.path_data = cfgs.path
     cfgs.path = os.path.join(cfgs.path, cfgs.path_specific)
+    # Image channels of the encoder input and decoder output (dataset.shape[0])
+    cfgs.network.num_channels = cfgs.dataset.shape[0]
+    if cfgs.dataset.dim_x != int(np.prod(cfgs.dataset.shape)):
+        raise Exception("dataset.dim_x ({}) does not match dataset.shape {}".format(
+            cfgs.dataset.dim_x, tuple(cfgs.dataset.shape)))
     if cfgs.model.name.lower() == "vmfsqvae":
         cfgs.quantization.dim_dict += 1
     cfgs.flags.var_q = not(cfgs.model.param_var_q=="gaussian_1" or
@@ -50,14 +75,16 @@ if __name__ == "__main__":
     
     ## Experimental setup
     args = arg_parse()
-    if args.gpu != "":
+    if args.gpu != "" and "LOCAL_RANK" not in os.environ:
         os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu
     cfgs, flgs = load_config(args)
     print("[Checkpoint path] "+cfgs.path)
     print(cfgs)
     
     ## Device
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    if cfgs.num_threads > 0:
+        torch.set_num_threads(cfgs.num_threads)
+    print("[Device] {} ({} threads)".format(cfgs.device, torch.get_num_threads()))
     set_seeds(args.seed)
 
     ## Data loader
@@ -70,7 +97,9 @@ if __name__ == "__main__":
     # 使用配置文件中的数据集路径
     dataset_path = getattr(cfgs.dataset, 'root_path', cfgs.path_dataset)
     train_loader, val_loader, test_loader = get_loader(
-        cfgs.dataset.name, dataset_path, cfgs.train.bs, cfgs.nworker, target_size)
+        cfgs.dataset.name, dataset_path, cfgs.train.bs, cfgs.nworker, target_size,
+        image_cache_path(cfgs) if cfgs.dataset.cache else "", cfgs.dataset.in_memory,
+        cfgs.dataset.shards, cfgs.dataset.shuffle_buffer, cfgs.dataset.shape[0])
     print("Complete dataload")
 
     ## Trainer
@@ -83,9 +112,12 @@ if __name__ == "__main__":
         raise Exception("Undefined model.")
 
     ## Main
-    if args.timestamp == "":
+    if args.resume:
+        assert args.timestamp != "", "--resume requires -ts"
+        trainer.main_loop(timestamp=args.timestamp, resume=True)
+    elif args.timestamp == "":
         trainer.main_loop()
-    if flgs.save:
+    if args.save:
         trainer.load(args.timestamp)
         print("Best models were loaded!!")
         res_test = trainer.test()
@@ -4,14 +4,18 @@ import torch.nn.functional as F
 from torch import nn
 
 from quantizer import GaussianVectorQuantizer, VmfVectorQuantizer
+from codebook_index import build_index, load_index
 import networks.mnist as net_mnist
 import networks.fashion_mnist as net_fashionmnist
 import networks.cifar10 as net_cifar10
 import networks.celeba as net_celeba
 import networks.celebamask_hq as net_celebamask_hq
 import networks.net_microdoppler as net_microdoppler
+import networks.fakedata as net_fakedata
 from third_party.ive import ive
+from bessel import log_ive
 from perceptual_loss import MicroDopplerPerceptualLoss
+from step_profiler import StepProfiler
 
 
 def weights_init(m):
@@ -47,21 +51,67 @@ class SQVAE(nn.Module):
         self.log_param_q_scalar = nn.Parameter(torch.tensor(cfgs.model.log_param_q_init))
         if self.param_var_q == "vmf":
             self.quantizer = VmfVectorQuantizer(
-                self.size_dict, self.dim_dict, cfgs.quantization.temperature.init)
+                self.size_dict, self.dim_dict, cfgs.quantization.temperature.init,
+                chunk_size=cfgs.quantization.chunk_size, fused=cfgs.quantization.fused,
+                topk=cfgs.quantization.topk)
         else:
             self.quantizer = GaussianVectorQuantizer(
-                self.size_dict, self.dim_dict, cfgs.quantization.temperature.init, self.param_var_q)
+                self.size_dict, self.dim_dict, cfgs.quantization.temperature.init, self.param_var_q,
+                chunk_size=cfgs.quantization.chunk_size, fused=cfgs.quantization.fused,
+                topk=cfgs.quantization.topk)
+        self.profiler = StepProfiler() # Replaced by the trainer's profiler (disabled by default)
         
     
-    def forward(self, x, flg_train=False, flg_quant_det=True):
+    def forward(self, x, flg_train=False, flg_quant_det=True, target_feats=None):
         # Encoding
+        with self.profiler.phase("encoder"):
+            z_from_encoder = self._encode(x)
+        
+        # Quantization
+        with self.profiler.phase("quantizer"):
+            z_quantized, loss_latent, perplexity = self.quantizer(
+                z_from_encoder, self.param_q, self.codebook, flg_train, flg_quant_det)
+        latents = dict(z_from_encoder=z_from_encoder, z_to_decoder=z_quantized)
+
+        # Decoding
+        with self.profiler.phase("decoder"):
+            x_reconst = self.decoder(z_quantized)
+
+        # Loss
+        with self.profiler.phase("loss"):
+            loss = self._calc_loss(x_reconst, x, loss_latent, target_feats)
+        loss["perplexity"] = perplexity
+        
+        return x_reconst, latents, loss
+
+    def forward_both(self, x):
+        # Evaluation with stochastic and deterministic quantization from one encoder pass;
+        # returns ((x_reconst_stoch, x_reconst_det), None, (loss_stoch, loss_det))
+        z_from_encoder = self._encode(x)
+        quantized = self.quantizer.quantize_both(z_from_encoder, self.param_q, self.codebook)
+        z_quantized = [z for z, _, _ in quantized]
+        if self.training:
+            # BatchNorm batch statistics must not mix the two quantizations
+            x_reconst = [self.decoder(z) for z in z_quantized]
+        else:
+            x_reconst = torch.chunk(self.decoder(torch.cat(z_quantized, dim=0)), 2, dim=0)
+        losses = []
+        for x_reconst_sub, (_, loss_latent, perplexity) in zip(x_reconst, quantized):
+            loss = self._calc_loss(x_reconst_sub, x, loss_latent)
+            loss["perplexity"] = perplexity
+            losses.append(loss)
+
+        return tuple(x_reconst), None, tuple(losses)
+
+    def _encode(self, x):
+        # Encoder output; sets self.param_q for the quantizer
         if self.param_var_q == "vmf":
             z_from_encoder = F.normalize(self.encoder(x), p=2.0, dim=1)
-            self.param_q = (self.log_param_q_scalar.exp() + torch.tensor([1.0], device="cuda"))
+            self.param_q = (self.log_param_q_scalar.exp() + torch.tensor([1.0], device=x.device))
         else:
             if self.param_var_q == "gaussian_1":
                 z_from_encoder = self.encoder(x)
-                log_var_q = torch.tensor([0.0], device="cuda")
+                log_var_q = torch.tensor([0.0], device=x.device)
             else:
                 z_from_encoder, log_var = self.encoder(x)
                 if self.param_var_q == "gaussian_2":
@@ -73,23 +123,48 @@ class SQVAE(nn.Module):
                 else:
                     raise Exception("Undefined param_var_q")
             self.param_q = (log_var_q.exp() + self.log_param_q_scalar.exp())
-        
-        # Quantization
-        z_quantized, loss_latent, perplexity = self.quantizer(
-            z_from_encoder, self.param_q, self.codebook, flg_train, flg_quant_det)
-        latents = dict(z_from_encoder=z_from_encoder, z_to_decoder=z_quantized)
+        return z_from_encoder
 
-        # Decoding
-        x_reconst = self.decoder(z_quantized)
+    def quantize_indices(self, x, dtype=None):
+        # Deterministic code indices (bs, width, height) of x as int16 (int32 for > 32768 codes)
+        z_from_encoder = self._encode(x)
+        return self.quantizer.quantize_indices(z_from_encoder, self.param_q, self.codebook, dtype)
 
-        # Loss
-        loss = self._calc_loss(x_reconst, x, loss_latent)
-        loss["perplexity"] = perplexity
-        
-        return x_reconst, latents, loss
+    def lookup_codes(self, indices):
+        # Quantized latents (bs, dim_dict, width, height) to be fed to the decoder
+        return self.quantizer.lookup(indices, self.codebook)
+
+    ## Inference (no loss, perplexity or latents)
+
+    @torch.inference_mode()
+    def encode(self, x):
+        return self.quantize_indices(x)
+
+    @torch.inference_mode()
+    def decode(self, indices):
+        return self.decoder(self.lookup_codes(indices))
+
+    @torch.inference_mode()
+    def reconstruct(self, x):
+        # Same output as forward(x, False, True)[0]
+        return self.decode(self.encode(x))
     
     def _calc_loss(self):
         raise NotImplementedError()
+
+    def build_codebook_index(self, kind="exact", **kwargs):
+        # Search backend for deterministic quantization, built from the current codebook
+        codebook = self.codebook.detach()
+        if self.param_var_q == "vmf":
+            codebook = F.normalize(codebook, p=2.0, dim=1)
+        index = build_index(codebook, kind, **kwargs)
+        self.quantizer.set_index(index)
+        return index
+
+    def load_codebook_index(self, path):
+        index = load_index(path, self.codebook.device)
+        self.quantizer.set_index(index)
+        return index
     
 
 class GaussianSQVAE(SQVAE):
@@ -103,16 +178,17 @@ class GaussianSQVAE(SQVAE):
         self.use_perceptual_loss = getattr(flgs, 'perceptual_loss', False)
         if self.use_perceptual_loss:
             self.perceptual_loss_fn = MicroDopplerPerceptualLoss(
-                perceptual_weight=getattr(flgs, 'perceptual_weight', 0.05)
+                perceptual_weight=getattr(flgs, 'perceptual_weight', 0.05),
+                weight_store=cfgs.perceptual.weights
             )
     
-    def _calc_loss(self, x_reconst, x, loss_latent):
+    def _calc_loss(self, x_reconst, x, loss_latent, target_feats=None):
         bs = x.shape[0]
 
         # 基础重建损失
         if self.use_perceptual_loss:
             # 使用感知损失
-            combined_loss, mse, perc_loss = self.perceptual_loss_fn(x_reconst, x)
+            combined_loss, mse, perc_loss = self.perceptual_loss_fn(x_reconst, x, target_feats)
             # 感知损失版本：直接使用combined_loss，不再应用arelbo变换
             loss_reconst = combined_loss
         else:
@@ -143,33 +219,36 @@ class VmfSQVAE(SQVAE):
         self.log_kappa_inv = nn.Parameter(torch.tensor([cfgs.model.log_kappa_inv]))
         self.__m = np.ceil(cfgs.network.num_class / 2)
         self.n_interval = cfgs.network.num_class - 1
-
-    def _calc_loss(self, x_reconst, x, loss_latent):
-        x_shape = x.shape
-        # Reconstruction loss
-        x = x.view(-1, 1)
-        x_reconst_viewed = (x_reconst.permute(0, 2, 3, 1).contiguous()
-                            .view(-1, int(self.__m * 2)) )
-        x_reconst_normed = F.normalize(x_reconst_viewed, p=2.0, dim=-1)
-        x_one_hot = (F.one_hot(x.to(torch.int).long(), num_classes = int(self.__m * 2))
-                    .type_as(x))[:,0,:]
-        x_reconst_selected = (x_one_hot * x_reconst_normed).sum(-1).view(x_shape)
+        self.ive_backend = cfgs.model.ive_backend
+
+    def _calc_loss(self, x_reconst, x, loss_latent, target_feats=None):
+        # Reconstruction loss: the normalized decoder output (bs, 2m, H, W) is gathered
+        # at the label channel of each pixel
+        x_label = x.long().unsqueeze(1)
+        x_reconst_normed = F.normalize(x_reconst, p=2.0, dim=1)
+        x_reconst_selected = torch.gather(x_reconst_normed, 1, x_label).squeeze(1)
         kappa_inv = self.log_kappa_inv.exp().add(1e-9)
         loss_reconst = (- 1./kappa_inv * x_reconst_selected.sum((1,2)).mean()
                         - self.dim_x * self._log_normalization(kappa_inv))
         # Entire loss
         loss_all = loss_reconst + loss_latent
-        idx_estimated = torch.argmax(x_reconst_normed, dim=-1, keepdim=True)
-        acc = torch.isclose(x.to(int), idx_estimated).sum() / idx_estimated.numel()
+        idx_estimated = torch.argmax(x_reconst_normed, dim=1, keepdim=True)
+        acc = (idx_estimated == x_label).sum() / idx_estimated.numel()
         loss = dict(all=loss_all, acc=acc)
 
         return loss
 
     def _log_normalization(self, kappa_inv):
+        if self.ive_backend == "torch":
+            log_bessel = log_ive(self.__m - 1, 1./kappa_inv)
+        elif self.ive_backend == "scipy":
+            log_bessel = torch.log(ive(self.__m - 1, 1./kappa_inv))
+        else:
+            raise Exception("Undefined ive_backend: {}".format(self.ive_backend))
         coeff = (
             - (self.__m - 1) * kappa_inv.log()
             - 1./kappa_inv 
-            - torch.log(ive(self.__m - 1, 1./kappa_inv))
+            - log_bessel
         )
 
         return coeff
@@ -10,13 +10,14 @@ class EncoderVqResnet256(nn.Module):
     def __init__(self, dim_z, cfgs, flg_bn=True, flg_var_q=False):
         super(EncoderVqResnet256, self).__init__()
         self.flg_variance = flg_var_q
+        num_channels = getattr(cfgs, "num_channels", 3) # 图像通道数 (dataset.shape[0])
 
         # 原版下采样方式：使用4×4卷积 + stride=2
         # 256×256 → 32×32 需要3次下采样 (256→128→64→32)
         
         layers_conv = []
-        # 第一层：3 → dim_z//4, 256→128
-        layers_conv.append(nn.Conv2d(3, dim_z // 4, 4, stride=2, padding=1))
+        # 第一层：num_channels → dim_z//4, 256→128
+        layers_conv.append(nn.Conv2d(num_channels, dim_z // 4, 4, stride=2, padding=1))
         if flg_bn:
             layers_conv.append(nn.BatchNorm2d(dim_z // 4))
         layers_conv.append(nn.ReLU())
@@ -63,6 +64,7 @@ class DecoderVqResnet256(nn.Module):
     """256×256解码器，遵循原项目风格"""
     def __init__(self, dim_z, cfgs, flg_bn=True):
         super(DecoderVqResnet256, self).__init__()
+        num_channels = getattr(cfgs, "num_channels", 3)
         
         # ResBlocks - 完全原版
         num_rb = cfgs.num_rb
@@ -93,8 +95,8 @@ class DecoderVqResnet256(nn.Module):
             layers_convt.append(nn.BatchNorm2d(dim_z // 4))
         layers_convt.append(nn.ReLU())
         
-        # 第四层：dim_z//4 → 3, 128→256
-        layers_convt.append(nn.ConvTranspose2d(dim_z // 4, 3, 4, stride=2, padding=1))
+        # 第四层：dim_z//4 → num_channels, 128→256
+        layers_convt.append(nn.ConvTranspose2d(dim_z // 4, num_channels, 4, stride=2, padding=1))
         layers_convt.append(nn.Sigmoid())
         
         self.convt = nn.Sequential(*layers_convt)
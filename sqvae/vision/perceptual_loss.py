@@ -3,22 +3,19 @@ import torch.nn as nn
 import torchvision.models as models
 import torch.nn.functional as F
 
+from vgg_store import load_trunk
+
 
 class PerceptualLoss(nn.Module):
     """
     感知损失模块
     使用预训练的VGG网络提取特征，计算感知损失
+    所有层的特征由同一个截断的VGG主干一次前向得到
     """
-    def __init__(self, layers=['relu1_2', 'relu2_2', 'relu3_3', 'relu4_3'], weights=[1.0, 1.0, 1.0, 1.0]):
+    def __init__(self, layers=['relu1_2', 'relu2_2', 'relu3_3', 'relu4_3'], weights=[1.0, 1.0, 1.0, 1.0],
+                 pretrained=True, weight_store=""):
         super(PerceptualLoss, self).__init__()
         
-        # 加载预训练的VGG16
-        vgg = models.vgg16(pretrained=True).features
-        
-        # 冻结VGG参数
-        for param in vgg.parameters():
-            param.requires_grad = False
-            
         # 定义特征提取层
         self.layer_name_mapping = {
             'relu1_2': 3,   # conv1_2 -> relu1_2
@@ -30,42 +27,84 @@ class PerceptualLoss(nn.Module):
         self.layers = layers
         self.weights = weights
         
-        # 构建特征提取器
-        self.feature_extractors = nn.ModuleDict()
-        for layer in layers:
-            layer_idx = self.layer_name_mapping[layer]
-            self.feature_extractors[layer] = nn.Sequential(*list(vgg.children())[:layer_idx+1])
+        # 截断到最深的层，中间层的输出作为特征（taps）
+        self.taps = [self.layer_name_mapping[layer] for layer in layers]
+        num_layers = max(self.taps) + 1
+        if weight_store != "":
+            # 从本地权重库（vgg_store.py）加载截断的主干，无需下载完整的VGG16
+            modules = load_trunk(weight_store, num_layers)
+        else:
+            # 加载预训练的VGG16
+            modules = list(models.vgg16(pretrained=pretrained).features.children())[:num_layers]
+        self.trunk = nn.Sequential(*modules)
+
+        # 冻结VGG参数
+        for param in self.trunk.parameters():
+            param.requires_grad = False
+
+        # ImageNet均值和标准差
+        self.register_buffer("mean", torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1), persistent=False)
+        self.register_buffer("std", torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1), persistent=False)
     
-    def forward(self, pred, target):
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # 兼容旧的checkpoint：每层一个VGG前缀 feature_extractors.<layer>.<i>.* -> trunk.<i>.*
+        old_prefix = prefix + "feature_extractors."
+        for key in [key for key in state_dict if key.startswith(old_prefix)]:
+            value = state_dict.pop(key)
+            name = key[len(old_prefix):].split(".", 1)[1]
+            state_dict.setdefault(prefix + "trunk." + name, value)
+        super(PerceptualLoss, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def extract_features(self, x):
+        """
+        一次前向返回self.layers中每一层的特征
+        """
+        # 确保输入是3通道 (单通道输入广播为3通道，不复制数据)
+        if x.size(1) == 1:
+            x = x.expand(-1, 3, -1, -1)
+
+        # VGG需要ImageNet标准化
+        x = self.normalize_imagenet(x)
+
+        features = {}
+        for i, module in enumerate(self.trunk):
+            x = module(x)
+            if i in self.taps:
+                features[i] = x
+        return [features[i] for i in self.taps]
+
+    def forward(self, pred, target, target_feats=None):
         """
         计算感知损失
         
         Args:
             pred: 预测图像 [B, C, H, W]
             target: 目标图像 [B, C, H, W]
+            target_feats: 预先计算的目标特征（feature_cache.py），为None时由target计算
         
         Returns:
             perceptual_loss: 感知损失值
         """
-        # 确保输入是3通道
-        if pred.size(1) == 1:
-            pred = pred.repeat(1, 3, 1, 1)
-        if target.size(1) == 1:
-            target = target.repeat(1, 3, 1, 1)
-            
-        # VGG需要ImageNet标准化
-        pred = self.normalize_imagenet(pred)
-        target = self.normalize_imagenet(target)
+        if target_feats is not None:
+            pred_features = self.extract_features(pred)
+            target_features = [feature.type_as(pred) for feature in target_feats]
+        elif torch.is_grad_enabled() and pred.requires_grad:
+            # 训练时目标分支不需要梯度，单独在no_grad下计算
+            pred_features = self.extract_features(pred)
+            with torch.no_grad():
+                target_features = self.extract_features(target)
+        else:
+            # 推理时pred和target拼成一个batch
+            bs = pred.shape[0]
+            features = self.extract_features(torch.cat([pred, target], 0))
+            pred_features = [feature[:bs] for feature in features]
+            target_features = [feature[bs:] for feature in features]
         
         total_loss = 0.0
         
         for i, layer in enumerate(self.layers):
-            # 提取特征
-            pred_features = self.feature_extractors[layer](pred)
-            target_features = self.feature_extractors[layer](target)
-            
             # 计算L2损失
-            layer_loss = F.mse_loss(pred_features, target_features)
+            layer_loss = F.mse_loss(pred_features[i], target_features[i])
             total_loss += self.weights[i] * layer_loss
             
         return total_loss
@@ -74,12 +113,8 @@ class PerceptualLoss(nn.Module):
         """
         ImageNet标准化
         """
-        # ImageNet均值和标准差
-        mean = torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1).to(x.device)
-        std = torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1).to(x.device)
-        
         # 假设输入已经在[0,1]范围内
-        x = (x - mean) / std
+        x = (x - self.mean) / self.std
         return x
 
 
@@ -126,7 +161,7 @@ class MicroDopplerPerceptualLoss(nn.Module):
     专门为微多普勒时频图设计的感知损失
     使用较浅的网络层，更适合时频图特征
     """
-    def __init__(self, perceptual_weight=0.05):
+    def __init__(self, perceptual_weight=0.05, weight_store=""):
         super(MicroDopplerPerceptualLoss, self).__init__()
         
         self.perceptual_weight = perceptual_weight
@@ -134,10 +169,11 @@ class MicroDopplerPerceptualLoss(nn.Module):
         # 使用较浅的VGG层，更适合时频图
         self.perceptual_loss = PerceptualLoss(
             layers=['relu1_2', 'relu2_2'], 
-            weights=[1.0, 0.5]
+            weights=[1.0, 0.5],
+            weight_store=weight_store
         )
         
-    def forward(self, pred, target):
+    def forward(self, pred, target, target_feats=None):
         """
         微多普勒专用组合损失
         """
@@ -147,7 +183,7 @@ class MicroDopplerPerceptualLoss(nn.Module):
         mse_loss = F.mse_loss(pred, target, reduction="sum") / bs
 
         # 感知损失（权重较小，避免过度影响）
-        perc_loss = self.perceptual_loss(pred, target)
+        perc_loss = self.perceptual_loss(pred, target, target_feats)
 
         # 组合损失
         total_loss = mse_loss + self.perceptual_weight * perc_loss
@@ -2,161 +2,500 @@ import torch
 import torch.nn.functional as F
 from torch import nn
 from torch.distributions import Categorical
+from torch.utils.checkpoint import checkpoint
 
 
-def sample_gumbel(shape, eps=1e-10):
-    U = torch.rand(shape, device="cuda")
+def sample_gumbel(shape, eps=1e-10, device=None):
+    U = torch.rand(shape, device=device)
     return -torch.log(-torch.log(U + eps) + eps)
 
 
 def gumbel_softmax_sample(logits, temperature):
-    g = sample_gumbel(logits.size())
+    g = sample_gumbel(logits.size(), device=logits.device)
     y = logits + g
     return F.softmax(y / temperature, dim=-1)
 
 
-def calc_distance(z_continuous, codebook, dim_dict):
+def calc_distance(z_continuous, codebook, dim_dict, codebook_sq=None, codebook_t=None):
+    # codebook_sq (squared norms) and codebook_t (transposed codebook) may be precomputed
     z_continuous_flat = z_continuous.view(-1, dim_dict)
-    distances = (torch.sum(z_continuous_flat**2, dim=1, keepdim=True) 
-                + torch.sum(codebook**2, dim=1)
-                - 2 * torch.matmul(z_continuous_flat, codebook.t()))
+    if codebook_sq is None:
+        codebook_sq = torch.sum(codebook**2, dim=1)
+    if codebook_t is None:
+        codebook_t = codebook.t()
+    distances = (torch.sum(z_continuous_flat**2, dim=1, keepdim=True)
+                + codebook_sq
+                - 2 * torch.matmul(z_continuous_flat, codebook_t))
 
     return distances
 
 
+def calc_weighted_distance(z_continuous, codebook, weight, codebook_t=None, codebook_sq_t=None):
+    # sum_d w_d * (z_d - c_d)^2 with per-dimension weights, expanded into matmuls
+    # so that only (N, size_dict) tensors are materialized
+    if codebook_t is None:
+        codebook_t = codebook.t()
+    if codebook_sq_t is None:
+        codebook_sq_t = (codebook**2).t()
+    distances = (torch.sum(weight * z_continuous**2, dim=1, keepdim=True)
+                - 2 * torch.matmul(weight * z_continuous, codebook_t)
+                + torch.matmul(weight, codebook_sq_t))
+
+    return distances
+
+
+def calc_weighted_distance_broadcast(z_continuous, codebook, weight):
+    # Reference implementation of calc_weighted_distance (materializes N x dim_dict x size_dict)
+    distances = torch.sum(
+        weight.unsqueeze(2) * ((z_continuous.unsqueeze(2) - codebook.t().unsqueeze(0)) ** 2), dim=1)
+
+    return distances
+
+
+def code_dtype(size_dict):
+    # Smallest integer type that holds the code indices
+    return torch.int16 if size_dict <= torch.iinfo(torch.int16).max + 1 else torch.int32
+
+
+def get_rng_state(device):
+    if device.type == "cuda":
+        return torch.cuda.get_rng_state(device)
+    return torch.get_rng_state()
+
+
+def set_rng_state(state, device):
+    if device.type == "cuda":
+        torch.cuda.set_rng_state(state, device)
+    else:
+        torch.set_rng_state(state)
+
+
+class FusedStochasticQuantize(torch.autograd.Function):
+    """
+    Gumbel-softmax quantization for training that saves only the latents, the weight,
+    the codebook and the RNG state. The (N, size_dict) logits, probabilities and Gumbel
+    noise are recomputed in backward instead of being kept alive for the whole step.
+    Returns the quantized latents, sum(p*log(p)) and the summed probability mass.
+    """
+    @staticmethod
+    def forward(ctx, z_flat, weight, codebook, calc_logit, temperature):
+        ctx.calc_logit = calc_logit
+        ctx.temperature = temperature
+        ctx.rng_state = get_rng_state(z_flat.device)
+        ctx.save_for_backward(z_flat, weight, codebook)
+
+        logit = calc_logit(z_flat, codebook, weight)
+        probabilities = torch.softmax(logit, dim=-1)
+        log_probabilities = torch.log_softmax(logit, dim=-1)
+        encodings = gumbel_softmax_sample(logit, temperature)
+        z_quantized = torch.mm(encodings, codebook)
+        neg_entropy = torch.sum(probabilities * log_probabilities)
+        prob_mass = torch.sum(probabilities, dim=0)
+        ctx.mark_non_differentiable(prob_mass)
+
+        return z_quantized, neg_entropy, prob_mass
+
+    @staticmethod
+    def backward(ctx, grad_z_quantized, grad_neg_entropy, grad_prob_mass):
+        z_flat, weight, codebook = ctx.saved_tensors
+        device = z_flat.device
+        inputs = [t.detach().requires_grad_(flg) for t, flg in zip(
+            (z_flat, weight, codebook), ctx.needs_input_grad[:3])]
+
+        # Recompute the logits with autograd; the softmax terms are differentiated by hand
+        with torch.enable_grad():
+            logit = ctx.calc_logit(inputs[0], inputs[2], inputs[1])
+        with torch.no_grad():
+            logit_detached = logit.detach()
+            with torch.random.fork_rng(devices=[device] if device.type == "cuda" else []):
+                set_rng_state(ctx.rng_state, device)
+                encodings = gumbel_softmax_sample(logit_detached, ctx.temperature)
+            # z_quantized = encodings @ codebook, encodings = softmax((logit + g) / temperature)
+            grad_encodings = torch.mm(grad_z_quantized, codebook.t())
+            grad_logit = encodings * (
+                grad_encodings - torch.sum(encodings * grad_encodings, dim=-1, keepdim=True)
+                ) / ctx.temperature
+            del grad_encodings
+            # neg_entropy = sum(p * log(p)), p = softmax(logit)
+            probabilities = torch.softmax(logit_detached, dim=-1)
+            log_probabilities = torch.log_softmax(logit_detached, dim=-1)
+            grad_logit += grad_neg_entropy * probabilities * (
+                log_probabilities
+                - torch.sum(probabilities * log_probabilities, dim=-1, keepdim=True))
+            del probabilities, log_probabilities
+            grad_codebook_direct = torch.mm(encodings.t(), grad_z_quantized)
+            del encodings
+
+        grads = [None, None, None]
+        idx_needs_grad = [i for i, t in enumerate(inputs) if t.requires_grad]
+        if len(idx_needs_grad) > 0:
+            grads_logit = torch.autograd.grad(
+                logit, [inputs[i] for i in idx_needs_grad], grad_logit)
+            for i, grad in zip(idx_needs_grad, grads_logit):
+                grads[i] = grad
+        if ctx.needs_input_grad[2]:
+            grads[2] = grad_codebook_direct if grads[2] is None else grads[2] + grad_codebook_direct
+
+        return grads[0], grads[1], grads[2], None, None
+
+
 
 class VectorQuantizer(nn.Module):
-    def __init__(self, size_dict, dim_dict, temperature=0.5):
+    def __init__(self, size_dict, dim_dict, temperature=0.5, chunk_size=0, fused=False, topk=0):
         super(VectorQuantizer, self).__init__()
         self.size_dict = size_dict
         self.dim_dict = dim_dict
         self.temperature = temperature
-    
+        self.chunk_size = chunk_size # Number of latent positions per tile (0: no tiling)
+        self.fused = fused # Use FusedStochasticQuantize in training
+        self.topk = topk # Sample among the topk nearest codes only (0: all codes)
+        self.index = None # Search backend for deterministic quantization (see codebook_index.py)
+        self._codebook_cache = {} # device -> (codebook version key, codebook, derived tensors)
+        self._codebook_terms = (None, {}) # Derived tensors of the codebook being quantized
+
     def forward(self, z_from_encoder, param_q, codebook, flg_train, flg_quant_det=False):
         return self._quantize(z_from_encoder, param_q, codebook,
                                 flg_train=flg_train, flg_quant_det=flg_quant_det)
-    
+
     def _quantize(self):
         raise NotImplementedError()
-    
+
     def set_temperature(self, value):
         self.temperature = value
-    
+
     def _calc_distance_bw_enc_codes(self):
         raise NotImplementedError()
-    
+
     def _calc_distance_bw_enc_dec(self):
         raise NotImplementedError()
 
+    def set_index(self, index):
+        self.index = index
 
-class GaussianVectorQuantizer(VectorQuantizer):
-    def __init__(self, size_dict, dim_dict, temperature=0.5, param_var_q="gaussian_1"):
-        super(GaussianVectorQuantizer, self).__init__(size_dict, dim_dict, temperature)
-        self.param_var_q = param_var_q
-    
-    def _quantize(self, z_from_encoder, var_q, codebook, flg_train=True, flg_quant_det=False):
+    def _update_codebook_cache(self, codebook):
+        # Tensors derived from the codebook are reused while the codebook is unchanged,
+        # which is tracked through its version counter (bumped by optimizer steps and
+        # load_state_dict). The cache is bypassed when gradients are required, and for
+        # any codebook other than a leaf Parameter: the replicas of nn.DataParallel hold
+        # fresh copies (version 0, possibly at a reused address) and share this dict.
+        if torch.is_grad_enabled() and codebook.requires_grad:
+            return {}
+        if not isinstance(codebook, nn.Parameter):
+            return {}
+        key = (id(codebook), codebook._version, tuple(codebook.shape), codebook.dtype)
+        entry = self._codebook_cache.get(codebook.device)
+        if entry is None or entry[0] != key or entry[1] is not codebook:
+            with torch.no_grad():
+                entry = (key, codebook, self._derive_codebook_terms(codebook.detach()))
+            self._codebook_cache[codebook.device] = entry
+        return entry[2]
+
+    def _derive_codebook_terms(self, codebook):
+        raise NotImplementedError()
+
+    def _get_codebook_terms(self, codebook):
+        codebook_cached, terms = self._codebook_terms
+        return terms if codebook_cached is codebook else {}
+
+    def _search_weight(self, weight):
+        # Weight that changes the nearest code (None if it is constant per position)
+        return None
+
+    def _prepare(self, z_from_encoder, param_q, codebook):
+        raise NotImplementedError()
+
+    def _prepare_codebook(self, codebook):
+        raise NotImplementedError()
+
+    def quantize_indices(self, z_from_encoder, param_q, codebook, dtype=None):
+        # Nearest code of each latent position as a (bs, width, height) integer tensor.
+        # Only the distances are computed, not the softmax terms of the quantization.
         bs, dim_z, width, height = z_from_encoder.shape
-        z_from_encoder_permuted = z_from_encoder.permute(0, 2, 3, 1).contiguous()
-        precision_q = 1. / torch.clamp(var_q, min=1e-10)
+        z_flat, weight, codebook = self._prepare(z_from_encoder, param_q, codebook)
+        indices = self._search(z_flat, weight, codebook)
+        if dtype is None:
+            dtype = code_dtype(self.size_dict)
+        return indices.to(dtype).view(bs, width, height)
+
+    def lookup(self, indices, codebook):
+        # Latents (bs, dim_dict, width, height) of the given code indices
+        codebook = self._prepare_codebook(codebook)
+        z_quantized = F.embedding(indices.long(), codebook)
+        return z_quantized.permute(0, 3, 1, 2).contiguous()
+
+    def quantize_both(self, z_from_encoder, param_q, codebook):
+        # Evaluation: stochastic and deterministic quantization derived from the same logits.
+        # Returns a (z_to_decoder, loss, perplexity) tuple for each.
+        z_flat, weight, codebook = self._prepare(z_from_encoder, param_q, codebook)
+        chunk_size = self.chunk_size if self.chunk_size > 0 else z_flat.shape[0]
+        tiles_stoch = []
+        tiles_det = []
+        for start in range(0, z_flat.shape[0], chunk_size):
+            z_tile = z_flat[start:start+chunk_size]
+            weight_tile = weight if weight.shape[0] == 1 else weight[start:start+chunk_size]
+            logit = self._calc_logit(z_tile, codebook, weight_tile)
+            probabilities = torch.softmax(logit, dim=-1)
+            neg_entropy = torch.sum(probabilities * torch.log_softmax(logit, dim=-1))
 
-        logit = -self._calc_distance_bw_enc_codes(z_from_encoder_permuted, codebook, 0.5 * precision_q)
+            if self.index is not None:
+                indices = self.index.search(z_tile, self._search_weight(weight_tile))
+            else:
+                indices = torch.argmax(logit, dim=1)
+            tiles_det.append((F.embedding(indices, codebook), neg_entropy,
+                torch.bincount(indices, minlength=self.size_dict).type_as(codebook)))
+
+            if self.topk > 0:
+                tiles_stoch.append(self._quantize_tile_topk(logit, codebook, False))
+            else:
+                indices = Categorical(probabilities).sample()
+                tiles_stoch.append((F.embedding(indices, codebook), neg_entropy, torch.sum(probabilities, dim=0)))
+
+        outputs = []
+        for tiles in [tiles_stoch, tiles_det]:
+            z_quantized_flat = torch.cat([tile[0] for tile in tiles], dim=0)
+            neg_entropy = sum(tile[1] for tile in tiles)
+            prob_mass = sum(tile[2] for tile in tiles)
+            outputs.append(self._complete(z_from_encoder, param_q, z_quantized_flat, neg_entropy, prob_mass))
+        return outputs
+
+    def _search(self, z_flat, weight, codebook):
+        if self.index is not None:
+            return self.index.search(z_flat, self._search_weight(weight))
+        chunk_size = self.chunk_size if self.chunk_size > 0 else z_flat.shape[0]
+        indices = []
+        for start in range(0, z_flat.shape[0], chunk_size):
+            weight_tile = weight if weight.shape[0] == 1 else weight[start:start+chunk_size]
+            logit = self._calc_logit(z_flat[start:start+chunk_size], codebook, weight_tile)
+            indices.append(torch.argmax(logit, dim=1))
+        return torch.cat(indices, dim=0)
+
+    def _quantize_flat(self, z_flat, weight, codebook, flg_train, flg_quant_det):
+        # Quantize (N, dim_dict) latents, optionally in tiles of chunk_size positions.
+        # Returns the quantized latents, the sum of p*log(p) over all positions and
+        # the probability mass assigned to each code summed over all positions.
+        num_positions = z_flat.shape[0]
+        if self.chunk_size <= 0 or num_positions <= self.chunk_size:
+            return self._quantize_tile(z_flat, weight, codebook, flg_train, flg_quant_det)
+
+        # In training, each tile is recomputed in backward so that only one tile of
+        # (chunk_size x size_dict) activations is alive at a time
+        # (unnecessary with the fused op, which already recomputes them)
+        flg_recompute = (torch.is_grad_enabled() and not (self.fused and flg_train)
+                        and (z_flat.requires_grad or codebook.requires_grad))
+        z_quantized = []
+        neg_entropy = 0.
+        prob_mass = 0.
+        for start in range(0, num_positions, self.chunk_size):
+            end = min(start + self.chunk_size, num_positions)
+            weight_tile = weight if weight.shape[0] == 1 else weight[start:end]
+            args = (z_flat[start:end], weight_tile, codebook, flg_train, flg_quant_det)
+            if flg_recompute:
+                outputs = checkpoint(self._quantize_tile, *args)
+            else:
+                outputs = self._quantize_tile(*args)
+            z_quantized.append(outputs[0])
+            neg_entropy = neg_entropy + outputs[1]
+            prob_mass = prob_mass + outputs[2]
+
+        return torch.cat(z_quantized, dim=0), neg_entropy, prob_mass
+
+    def _quantize_tile(self, z_flat, weight, codebook, flg_train, flg_quant_det):
+        if flg_train and self.fused and self.topk <= 0 and torch.is_grad_enabled():
+            return FusedStochasticQuantize.apply(
+                z_flat, weight, codebook, self._calc_logit, self.temperature)
+
+        logit = self._calc_logit(z_flat, codebook, weight)
+        if self.topk > 0 and (flg_train or not flg_quant_det):
+            return self._quantize_tile_topk(logit, codebook, flg_train)
         probabilities = torch.softmax(logit, dim=-1)
         log_probabilities = torch.log_softmax(logit, dim=-1)
-        
+
         # Quantization
         if flg_train:
             encodings = gumbel_softmax_sample(logit, self.temperature)
-            z_quantized = torch.mm(encodings, codebook).view(bs, width, height, dim_z)
-            avg_probs = torch.mean(probabilities.detach(), dim=0)
+            z_quantized = torch.mm(encodings, codebook)
+            prob_mass = torch.sum(probabilities.detach(), dim=0)
         else:
             if flg_quant_det:
-                indices = torch.argmax(logit, dim=1).unsqueeze(1)
-                encodings_hard = torch.zeros(indices.shape[0], self.size_dict, device="cuda")
-                encodings_hard.scatter_(1, indices, 1)
-                avg_probs = torch.mean(encodings_hard, dim=0)
+                if self.index is not None:
+                    indices = self.index.search(z_flat, self._search_weight(weight))
+                else:
+                    indices = torch.argmax(logit, dim=1)
+                prob_mass = torch.bincount(indices, minlength=self.size_dict).type_as(codebook)
             else:
                 dist = Categorical(probabilities)
-                indices = dist.sample().view(bs, width, height)
-                encodings_hard = F.one_hot(indices, num_classes=self.size_dict).type_as(codebook)
-                avg_probs = torch.mean(probabilities, dim=0)
-            z_quantized = torch.matmul(encodings_hard, codebook).view(bs, width, height, dim_z)
-        z_to_decoder = z_quantized.permute(0, 3, 1, 2).contiguous()
-        
-        # Latent loss
-        kld_discrete = torch.sum(probabilities * log_probabilities, dim=(0,1)) / bs
-        kld_continuous = self._calc_distance_bw_enc_dec(z_from_encoder, z_to_decoder, 0.5 * precision_q).mean()
+                indices = dist.sample()
+                prob_mass = torch.sum(probabilities, dim=0)
+            # Selecting the codes by gather instead of a one-hot matmul
+            z_quantized = F.embedding(indices, codebook)
+        neg_entropy = torch.sum(probabilities * log_probabilities)
+
+        return z_quantized, neg_entropy, prob_mass
+
+    def _quantize_tile_topk(self, logit, codebook, flg_train):
+        # The categorical distribution is truncated to the topk nearest codes of each
+        # position and renormalized over them
+        logit_topk, indices_topk = torch.topk(logit, min(self.topk, self.size_dict), dim=-1)
+        probabilities = torch.softmax(logit_topk, dim=-1)
+        log_probabilities = torch.log_softmax(logit_topk, dim=-1)
+
+        # Quantization by gathering the selected codes instead of a dense matmul
+        if flg_train:
+            encodings = gumbel_softmax_sample(logit_topk, self.temperature)
+            codes_topk = F.embedding(indices_topk, codebook)
+            z_quantized = torch.bmm(encodings.unsqueeze(1), codes_topk).squeeze(1)
+            probabilities_mass = probabilities.detach()
+        else:
+            dist = Categorical(probabilities)
+            indices = torch.gather(indices_topk, 1, dist.sample().unsqueeze(1)).squeeze(1)
+            z_quantized = F.embedding(indices, codebook)
+            probabilities_mass = probabilities
+        prob_mass = torch.zeros(self.size_dict, dtype=probabilities.dtype, device=logit.device)
+        prob_mass.index_add_(0, indices_topk.reshape(-1), probabilities_mass.reshape(-1))
+        neg_entropy = torch.sum(probabilities * log_probabilities)
+
+        return z_quantized, neg_entropy, prob_mass
+
+    def _calc_logit(self, z_flat, codebook, weight):
+        return -self._calc_distance_bw_enc_codes(z_flat, codebook, weight)
+
+    def _complete(self, z_from_encoder, param_q, z_quantized_flat, neg_entropy, prob_mass):
+        # Decoder input, latent loss (discrete + continuous KL) and perplexity
+        z_to_decoder, kld_discrete, perplexity = self._latent_loss(
+            z_quantized_flat, neg_entropy, prob_mass, z_from_encoder.shape)
+        kld_continuous = self._calc_distance_bw_enc_dec(
+            z_from_encoder, z_to_decoder, self._latent_weight(param_q)).mean()
         loss = kld_discrete + kld_continuous
-        perplexity = torch.exp(-torch.sum(avg_probs * torch.log(avg_probs + 1e-7)))
 
         return z_to_decoder, loss, perplexity
 
-    def _calc_distance_bw_enc_codes(self, z_from_encoder, codebook, weight):        
+    def _latent_weight(self, param_q):
+        raise NotImplementedError()
+
+    def _latent_loss(self, z_quantized_flat, neg_entropy, prob_mass, shape):
+        bs, dim_z, width, height = shape
+        z_quantized = z_quantized_flat.view(bs, width, height, dim_z)
+        z_to_decoder = z_quantized.permute(0, 3, 1, 2).contiguous()
+        kld_discrete = neg_entropy / bs
+        avg_probs = prob_mass / z_quantized_flat.shape[0]
+        perplexity = torch.exp(-torch.sum(avg_probs * torch.log(avg_probs + 1e-7)))
+
+        return z_to_decoder, kld_discrete, perplexity
+
+
+class GaussianVectorQuantizer(VectorQuantizer):
+    def __init__(self, size_dict, dim_dict, temperature=0.5, param_var_q="gaussian_1",
+                 chunk_size=0, fused=False, topk=0):
+        super(GaussianVectorQuantizer, self).__init__(
+            size_dict, dim_dict, temperature, chunk_size, fused, topk)
+        self.param_var_q = param_var_q
+
+    def _quantize(self, z_from_encoder, var_q, codebook, flg_train=True, flg_quant_det=False):
+        z_from_encoder_flat, weight_flat, codebook = self._prepare(z_from_encoder, var_q, codebook)
+
+        # Quantization
+        z_quantized_flat, neg_entropy, prob_mass = self._quantize_flat(
+            z_from_encoder_flat, weight_flat, codebook, flg_train, flg_quant_det)
+
+        # Latent loss
+        return self._complete(z_from_encoder, var_q, z_quantized_flat, neg_entropy, prob_mass)
+
+    def _latent_weight(self, var_q):
+        return 0.5 / torch.clamp(var_q, min=1e-10)
+
+    def _prepare(self, z_from_encoder, var_q, codebook):
+        # Flattened latents, the weight aligned with them and the codebook to quantize with
+        z_from_encoder_permuted = z_from_encoder.permute(0, 2, 3, 1).contiguous()
+        z_from_encoder_flat = z_from_encoder_permuted.view(-1, self.dim_dict)
+        precision_q = 1. / torch.clamp(var_q, min=1e-10)
+        weight_flat = self._flatten_weight(0.5 * precision_q, z_from_encoder.shape)
+        return z_from_encoder_flat, weight_flat, self._prepare_codebook(codebook)
+
+    def _prepare_codebook(self, codebook):
+        self._codebook_terms = (codebook, self._update_codebook_cache(codebook))
+        return codebook
+
+    def _flatten_weight(self, weight, shape):
+        # Align the weight with the flattened (bs * width * height, dim_dict) latents
+        bs, dim_z, width, height = shape
         if self.param_var_q == "gaussian_1":
-            distances = weight * calc_distance(z_from_encoder, codebook, self.dim_dict)
+            weight = weight.view(1, 1)
         elif self.param_var_q == "gaussian_2":
-            weight = weight.tile(1, 1, 8, 8).view(-1,1)
-            distances = weight * calc_distance(z_from_encoder, codebook, self.dim_dict)
+            weight = weight.expand(bs, 1, width, height).reshape(-1, 1)
         elif self.param_var_q == "gaussian_3":
-            weight = weight.view(-1,1)
-            distances = weight * calc_distance(z_from_encoder, codebook, self.dim_dict)
+            weight = weight.reshape(-1, 1)
         elif self.param_var_q == "gaussian_4":
-            z_from_encoder_flat = z_from_encoder.view(-1, self.dim_dict).unsqueeze(2)
-            codebook = codebook.t().unsqueeze(0)
-            weight = weight.permute(0, 2, 3, 1).contiguous().view(-1, self.dim_dict).unsqueeze(2)
-            distances = torch.sum(weight * ((z_from_encoder_flat - codebook) ** 2), dim=1)
+            weight = weight.permute(0, 2, 3, 1).reshape(-1, self.dim_dict)
+
+        return weight
+
+    def _search_weight(self, weight):
+        return weight if self.param_var_q == "gaussian_4" else None
+
+    def _derive_codebook_terms(self, codebook):
+        terms = dict(sq=torch.sum(codebook**2, dim=1), t=codebook.t().contiguous())
+        if self.param_var_q == "gaussian_4":
+            terms["sq_t"] = (codebook**2).t().contiguous()
+        return terms
+
+    def _calc_distance_bw_enc_codes(self, z_from_encoder, codebook, weight):
+        terms = self._get_codebook_terms(codebook)
+        if self.param_var_q == "gaussian_4":
+            z_from_encoder_flat = z_from_encoder.view(-1, self.dim_dict)
+            distances = calc_weighted_distance(z_from_encoder_flat, codebook, weight,
+                terms.get("t"), terms.get("sq_t"))
+        else:
+            distances = weight * calc_distance(z_from_encoder, codebook, self.dim_dict,
+                terms.get("sq"), terms.get("t"))
 
         return distances
-        
+
     def _calc_distance_bw_enc_dec(self, x1, x2, weight):
         return torch.sum((x1-x2)**2 * weight, dim=(1,2,3))
-    
+
 
 
 class VmfVectorQuantizer(VectorQuantizer):
-    def __init__(self, size_dict, dim_dict, temperature=0.5):
-        super(VmfVectorQuantizer, self).__init__(size_dict, dim_dict, temperature)
-    
+    def __init__(self, size_dict, dim_dict, temperature=0.5, chunk_size=0, fused=False, topk=0):
+        super(VmfVectorQuantizer, self).__init__(
+            size_dict, dim_dict, temperature, chunk_size, fused, topk)
+
     def _quantize(self, z_from_encoder, kappa_q, codebook, flg_train=True, flg_quant_det=False):
-        bs, dim_z, width, height = z_from_encoder.shape
-        z_from_encoder_permuted = z_from_encoder.permute(0, 2, 3, 1).contiguous()
-        codebook_norm = F.normalize(codebook, p=2.0, dim=1)
+        z_from_encoder_flat, kappa_q, codebook_norm = self._prepare(z_from_encoder, kappa_q, codebook)
 
-        logit = -self._calc_distance_bw_enc_codes(z_from_encoder_permuted, codebook_norm, kappa_q)
-        probabilities = torch.softmax(logit, dim=-1)
-        log_probabilities = torch.log_softmax(logit, dim=-1)
-        
         # Quantization
-        if flg_train:
-            encodings = gumbel_softmax_sample(logit, self.temperature)
-            z_quantized = torch.mm(encodings, codebook_norm).view(bs, width, height, dim_z)
-            avg_probs = torch.mean(probabilities.detach(), dim=0)
-        else:
-            if flg_quant_det:
-                indices = torch.argmax(logit, dim=1).unsqueeze(1)
-                encodings_hard = torch.zeros(indices.shape[0], self.size_dict, device="cuda")
-                encodings_hard.scatter_(1, indices, 1)
-                avg_probs = torch.mean(encodings_hard, dim=0)
-            else:
-                dist = Categorical(probabilities)
-                indices = dist.sample().view(bs, width, height)
-                encodings_hard = F.one_hot(indices, num_classes=self.size_dict).type_as(codebook)
-                avg_probs = torch.mean(probabilities, dim=0)
-            z_quantized = torch.matmul(encodings_hard, codebook_norm).view(bs, width, height, dim_z)
-        z_to_decoder = z_quantized.permute(0, 3, 1, 2).contiguous()
+        z_quantized_flat, neg_entropy, prob_mass = self._quantize_flat(
+            z_from_encoder_flat, kappa_q, codebook_norm, flg_train, flg_quant_det)
 
         # Latent loss
-        kld_discrete = torch.sum(probabilities * log_probabilities, dim=(0,1)) / bs
-        kld_continuous = self._calc_distance_bw_enc_dec(z_from_encoder, z_to_decoder, kappa_q).mean()        
-        loss = kld_discrete + kld_continuous
-        perplexity = torch.exp(-torch.sum(avg_probs * torch.log(avg_probs + 1e-7)))
+        return self._complete(z_from_encoder, kappa_q, z_quantized_flat, neg_entropy, prob_mass)
+
+    def _latent_weight(self, kappa_q):
+        return kappa_q
+
+    def _prepare(self, z_from_encoder, kappa_q, codebook):
+        z_from_encoder_permuted = z_from_encoder.permute(0, 2, 3, 1).contiguous()
+        z_from_encoder_flat = z_from_encoder_permuted.view(-1, self.dim_dict)
+        return z_from_encoder_flat, kappa_q, self._prepare_codebook(codebook)
+
+    def _prepare_codebook(self, codebook):
+        terms = self._update_codebook_cache(codebook)
+        codebook_norm = terms["normalized"] if terms else F.normalize(codebook, p=2.0, dim=1)
+        self._codebook_terms = (codebook_norm, terms)
+        return codebook_norm
+
+    def _derive_codebook_terms(self, codebook):
+        codebook_norm = F.normalize(codebook, p=2.0, dim=1)
+        return dict(normalized=codebook_norm, t=codebook_norm.t().contiguous())
 
-        return z_to_decoder, loss, perplexity
- 
     def _calc_distance_bw_enc_codes(self, z_from_encoder, codebook, kappa_q):
         z_from_encoder_flat = z_from_encoder.view(-1, self.dim_dict)
-        distances = -kappa_q * torch.matmul(z_from_encoder_flat, codebook.t())
+        codebook_t = self._get_codebook_terms(codebook).get("t")
+        if codebook_t is None:
+            codebook_t = codebook.t()
+        distances = -kappa_q * torch.matmul(z_from_encoder_flat, codebook_t)
 
         return distances
-    
+
     def _calc_distance_bw_enc_dec(self, x1, x2, weight):
         return torch.sum(x1 * (x1-x2) * weight, dim=(1,2,3))
@@ -0,0 +1,206 @@
+"""
+Streaming dataset of MicroDoppler samples packed into sequential tar shards.
+
+Each split is converted once from the ID_* folder layout (resized to the training
+resolution) with
+    python shard_dataset.py --root /kaggle/input/dataset -o shards_64 --size 64
+which writes <out>/<split>-<i>.tar shards of samples_per_shard samples, each stored as
+<key>.npy (uint8 C x H x W) and <key>.cls (label), and <out>/<split>.json listing the
+shards, their sample counts, the resolution and the number of channels.
+
+ShardDataset reads the shards sequentially. With shuffle, the shard order is permuted
+every epoch (set_epoch) and the samples pass through an in-memory shuffle buffer. The shards
+are divided among the (rank, DataLoader worker) slots; a shuffled (training) split needs at
+least one shard per slot. Under torchrun every training slot then yields the same number of
+samples, so that all ranks run the same number of steps; samples beyond the smallest slot
+are dropped for that epoch (at most about one shard per slot, since only the last shard of
+a split is short). Evaluation splits are read in full: with fewer shards than slots, every
+slot reads all the shards and keeps every num_slots-th sample.
+"""
+import io
+import os
+import json
+import random
+import tarfile
+import argparse
+
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+
+
+def read_index(path, split):
+    with open(os.path.join(path, split + ".json")) as f:
+        return json.load(f)
+
+
+class ShardDataset(IterableDataset):
+    """(uint8 C x H x W image, label) samples of the tar shards of a split."""
+    def __init__(self, path, split, shuffle=False, buffer_size=1000, seed=None, num_workers=0):
+        self.path = path
+        self.split = split
+        self.index = read_index(path, split)
+        self.shards = [shard["name"] for shard in self.index["shards"]]
+        self.counts = [shard["num_samples"] for shard in self.index["shards"]]
+        self.key = dict(shards=os.path.abspath(path), size=self.index["size"], split=split)
+        self.shuffle = shuffle
+        self.buffer_size = buffer_size
+        self.seed = torch.initial_seed() if seed is None else seed
+        self.num_workers = num_workers # Of the DataLoader, for __len__
+        self.epoch = 0
+        from util import get_rank, get_world_size
+        self.rank = get_rank()
+        self.world_size = get_world_size()
+        if shuffle:
+            self._slots(max(num_workers, 1)) # Fails early without a shard for every slot
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        # Samples of this process in the current epoch
+        num_workers = max(self.num_workers, 1)
+        sizes = self._slot_sizes(num_workers)
+        return sum(sizes[self.rank * num_workers:(self.rank + 1) * num_workers])
+
+    def num_batches(self, batch_size):
+        # Batches of this process: every DataLoader worker ends with its own partial batch
+        num_workers = max(self.num_workers, 1)
+        sizes = self._slot_sizes(num_workers)[self.rank * num_workers:(self.rank + 1) * num_workers]
+        return sum((size + batch_size - 1) // batch_size for size in sizes)
+
+    def _slots(self, num_workers):
+        # Shard indices of each (rank, worker) slot for this epoch
+        order = list(range(len(self.shards)))
+        if self.shuffle:
+            random.Random(self.seed + self.epoch).shuffle(order)
+        num_slots = self.world_size * num_workers
+        slots = [order[slot::num_slots] for slot in range(num_slots)]
+        if self.shuffle and len(self.shards) < num_slots:
+            raise Exception("{} has {} {} shards for {} slots ({} processes x {} DataLoader workers); "
+                "write smaller shards (--samples_per_shard) or use fewer workers".format(
+                self.path, len(self.shards), self.split, num_slots, self.world_size, num_workers))
+        return slots
+
+    def _sample_slots(self, num_workers):
+        # Evaluation splits with fewer shards than slots are divided by samples
+        return not self.shuffle and len(self.shards) < self.world_size * num_workers
+
+    def _slot_sizes(self, num_workers):
+        # Samples yielded by each slot in this epoch
+        num_slots = self.world_size * num_workers
+        if self._sample_slots(num_workers):
+            total = sum(self.counts)
+            return [len(range(slot, total, num_slots)) for slot in range(num_slots)]
+        sizes = [sum(self.counts[i] for i in shards) for shards in self._slots(num_workers)]
+        if self.shuffle and self.world_size > 1:
+            sizes = [min(sizes)] * num_slots
+        return sizes
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        slot = self.rank * num_workers + worker_id
+        if self._sample_slots(num_workers):
+            for sample in self._samples(range(len(self.shards)), slot, self.world_size * num_workers):
+                yield sample
+            return
+        limit = self._slot_sizes(num_workers)[slot]
+        samples = self._samples(self._slots(num_workers)[slot])
+        if self.shuffle:
+            samples = self._shuffle_buffer(samples, random.Random((self.seed + self.epoch) * 1000003 + slot))
+        for i, sample in enumerate(samples):
+            if i >= limit:
+                break
+            yield sample
+
+    def _samples(self, shards, offset=0, stride=1):
+        # Samples of the shards; only every stride-th one from offset is decoded
+        i = 0
+        for shard in shards:
+            with tarfile.open(os.path.join(self.path, self.shards[shard]), "r|") as tar:
+                image = None
+                for member in tar:
+                    selected = i % stride == offset
+                    if member.name.endswith(".npy"):
+                        if selected:
+                            image = np.load(io.BytesIO(tar.extractfile(member).read()))
+                    elif member.name.endswith(".cls"):
+                        if selected:
+                            yield torch.from_numpy(image), int(tar.extractfile(member).read())
+                        image = None
+                        i += 1
+
+    def _shuffle_buffer(self, samples, rng):
+        buffer = []
+        for sample in samples:
+            if len(buffer) < self.buffer_size:
+                buffer.append(sample)
+                continue
+            i = rng.randrange(len(buffer))
+            buffer[i], sample = sample, buffer[i]
+            yield sample
+        rng.shuffle(buffer)
+        for sample in buffer:
+            yield sample
+
+
+def _add_bytes(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info, io.BytesIO(data))
+
+
+def write_shards(dataset, path, split, samples_per_shard=1000, n_work=0):
+    # dataset yields (uint8 C x H x W tensor, label) items in order
+    from torch.utils.data import DataLoader
+    os.makedirs(path, exist_ok=True)
+    loader = DataLoader(dataset, batch_size=None, shuffle=False, num_workers=n_work)
+    shards = []
+    tar = None
+    channels, size = None, None
+    for i, (image, label) in enumerate(loader):
+        if i % samples_per_shard == 0:
+            if tar is not None:
+                tar.close()
+            shards.append(dict(name="{}-{:06d}.tar".format(split, len(shards)), num_samples=0))
+            tar = tarfile.open(os.path.join(path, shards[-1]["name"]), "w")
+        buffer = io.BytesIO()
+        np.save(buffer, image.numpy())
+        _add_bytes(tar, "{:08d}.npy".format(i), buffer.getvalue())
+        _add_bytes(tar, "{:08d}.cls".format(i), str(int(label)).encode())
+        shards[-1]["num_samples"] += 1
+        channels, size = image.shape[0], list(image.shape[1:])
+    if tar is not None:
+        tar.close()
+    with open(os.path.join(path, split + ".json"), "w") as f:
+        json.dump(dict(size=size, channels=channels, shards=shards), f)
+    return shards
+
+
+def convert_microdoppler(root, path, size, samples_per_shard=1000, n_work=0, num_channels=3):
+    # Shards of the train/val/test splits of an ID_* folder dataset
+    from torchvision import transforms
+    from custom_dataset import MicroDopplerDataset
+    transform = transforms.Compose([transforms.Resize((size, size)), transforms.PILToTensor()])
+    for split in ["train", "val", "test"]:
+        dataset = MicroDopplerDataset(root, transform=transform, split=split, num_channels=num_channels)
+        shards = write_shards(dataset, path, split, samples_per_shard, n_work)
+        print("{}: {} samples in {} shards".format(
+            split, sum(shard["num_samples"] for shard in shards), len(shards)))
+
+
+def arg_parse():
+    parser = argparse.ArgumentParser(description="shard_dataset.py")
+    parser.add_argument("--root", required=True, help="MicroDoppler root with the ID_* folders")
+    parser.add_argument("-o", "--out", required=True, help="output directory")
+    parser.add_argument("--size", type=int, default=64, help="image resolution")
+    parser.add_argument("--channels", type=int, default=3, choices=[1, 3], help="1: grayscale, 3: RGB")
+    parser.add_argument("--samples_per_shard", type=int, default=1000, help="samples per tar shard")
+    parser.add_argument("--nworker", type=int, default=2, help="DataLoader workers for decoding")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = arg_parse()
+    convert_microdoppler(args.root, args.out, args.size, args.samples_per_shard, args.nworker, args.channels)
@@ -0,0 +1,66 @@
+"""
+CPU smoke test: one epoch of configs/smoke_cpu.yaml (synthetic data, no download).
+
+    python smoke_test.py [--threads 2] [--timeout 600]
+
+main.py is run in a subprocess with a copy of the config (train.epoch_max: 1, outputs in a
+temporary directory). The test fails unless main.py exits with 0 and prints finite train
+and validation losses.
+"""
+import os
+import re
+import sys
+import math
+import argparse
+import tempfile
+import subprocess
+
+import yaml
+
+
+LOSS_LINE = re.compile(r"^(\w.*?)\s+Loss: (\S+),")
+
+
+def run_smoke_test(threads=2, timeout=600):
+    root = os.path.dirname(os.path.abspath(__file__))
+    with open(os.path.join(root, "configs", "smoke_cpu.yaml")) as f:
+        config = yaml.safe_load(f)
+    with tempfile.TemporaryDirectory() as tmp:
+        config["path"] = tmp
+        config.setdefault("train", {})["epoch_max"] = 1
+        config_path = os.path.join(tmp, "smoke_cpu.yaml")
+        with open(config_path, "w") as f:
+            yaml.safe_dump(config, f)
+        # main.py joins the config name to configs/, which keeps an absolute path as is
+        cmd = [sys.executable, "main.py", "-c", config_path, "--device", "cpu",
+            "--threads", str(threads), "--dbg"]
+        result = subprocess.run(cmd, cwd=root, capture_output=True, text=True, timeout=timeout)
+    if result.returncode != 0:
+        raise AssertionError("main.py exited with {}:\n{}".format(result.returncode, result.stderr))
+    losses = {}
+    for line in result.stdout.splitlines():
+        match = LOSS_LINE.match(line.strip())
+        if match:
+            losses.setdefault(match.group(1).split()[0], []).append(float(match.group(2)))
+    for mode in ["Train", "Validation"]:
+        if mode not in losses:
+            raise AssertionError("No {} loss in the output:\n{}".format(mode.lower(), result.stdout))
+    for mode, values in losses.items():
+        if not all(math.isfinite(value) for value in values):
+            raise AssertionError("Non-finite {} loss: {}".format(mode.lower(), values))
+    return losses
+
+
+def arg_parse():
+    parser = argparse.ArgumentParser(description="smoke_test.py")
+    parser.add_argument("--threads", type=int, default=2, help="intra-op CPU threads of main.py")
+    parser.add_argument("--timeout", type=int, default=600, help="seconds")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = arg_parse()
+    losses = run_smoke_test(args.threads, args.timeout)
+    for mode, values in losses.items():
+        print("{}: {}".format(mode, ", ".join("{:.4f}".format(value) for value in values)))
+    print("Smoke test passed")
@@ -0,0 +1,143 @@
+"""
+Opt-in per-phase timing of the training steps.
+
+The training loop fetches its batches through StepProfiler.iterate() ("data": time waiting for
+the next batch), wraps the parts of a step in StepProfiler.phase(name) ("forward", "backward",
+"optimizer", and "encoder", "quantizer", "decoder", "loss" inside the model) and calls
+StepProfiler.step_end() after each step ("step": wall time of the whole step). Every `interval`
+steps, one JSON line with the mean milliseconds per step of each phase and the peak memory
+is appended to `path`:
+    {"step": 200, "num_steps": 100, "ms": {"data": 3.1, "forward": 20.4, ...},
+     "peak_memory_mb": 1532.0, "peak_rss_mb": 2870.4}
+The device is synchronized at the boundaries of each phase, so the phases are attributed
+correctly but run slower than without profiling; a disabled profiler does nothing.
+Nested phases are reported separately (e.g. "forward" includes "encoder").
+With trace_dir, torch.profiler records trace_steps steps after trace_start steps into a
+TensorBoard trace.
+"""
+import os
+import json
+import time
+import resource
+import threading
+import contextlib
+
+import torch
+
+
+class StepProfiler(object):
+    def __init__(self, path="", interval=100, device="cpu", trace_dir="",
+                 trace_start=10, trace_steps=5):
+        self.path = path
+        self.interval = interval
+        self.device = torch.device(device)
+        self.enabled = path != "" or trace_dir != ""
+        self.active = False # Only within iterate(), so evaluation passes are not counted
+        self.thread = threading.get_ident() # Ignores the replica threads of nn.DataParallel
+        self.times = {}
+        self.num_steps = 0
+        self.step = 0
+        self.last = time.perf_counter()
+        self.file = None
+        self.trace = None
+        if trace_dir != "":
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.device.type == "cuda":
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.trace = torch.profiler.profile(
+                activities=activities,
+                schedule=torch.profiler.schedule(wait=trace_start, warmup=1, active=trace_steps, repeat=1),
+                on_trace_ready=torch.profiler.tensorboard_trace_handler(trace_dir),
+                record_shapes=True, profile_memory=True)
+            self.trace.start()
+        if self.enabled:
+            self._reset_peak_memory()
+
+    def iterate(self, iterable):
+        if not self.enabled:
+            return iterable
+        return self._iterate(iterable)
+
+    def _iterate(self, iterable):
+        iterator = iter(iterable)
+        self.active = True
+        self.last = time.perf_counter()
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                self._add("data", time.perf_counter() - start)
+                yield item
+        finally:
+            self.active = False
+
+    def phase(self, name):
+        if not self.active or threading.get_ident() != self.thread:
+            return contextlib.nullcontext()
+        return self._phase(name)
+
+    @contextlib.contextmanager
+    def _phase(self, name):
+        self._synchronize()
+        start = time.perf_counter()
+        with torch.profiler.record_function(name):
+            yield
+        self._synchronize()
+        self._add(name, time.perf_counter() - start)
+
+    def step_end(self):
+        if not self.active:
+            return
+        if self.trace is not None:
+            self.trace.step()
+        self._synchronize()
+        now = time.perf_counter()
+        self._add("step", now - self.last)
+        self.last = now
+        self.num_steps += 1
+        self.step += 1
+        if self.num_steps >= self.interval:
+            self._write()
+
+    def close(self):
+        if self.num_steps > 0:
+            self._write()
+        if self.trace is not None:
+            self.trace.stop()
+            self.trace = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def _add(self, name, seconds):
+        self.times[name] = self.times.get(name, 0.) + seconds
+
+    def _synchronize(self):
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+
+    def _reset_peak_memory(self):
+        if self.device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats(self.device)
+
+    def _write(self):
+        record = dict(step=self.step, num_steps=self.num_steps,
+            ms={name: 1000. * value / self.num_steps for name, value in self.times.items()})
+        if self.device.type == "cuda":
+            record["peak_memory_mb"] = torch.cuda.max_memory_allocated(self.device) / 2**20
+        # ru_maxrss is in kB on Linux
+        record["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+        if self.path != "":
+            if self.file is None:
+                dirname = os.path.dirname(self.path)
+                if dirname != "":
+                    os.makedirs(dirname, exist_ok=True)
+                self.file = open(self.path, "a")
+            self.file.write(json.dumps(record) + "\n")
+            self.file.flush()
+        self.times = {}
+        self.num_steps = 0
+        self._reset_peak_memory()
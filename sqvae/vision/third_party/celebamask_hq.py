@@ -4,6 +4,8 @@ from torchvision import transforms
 from PIL import Image
 import os
 
+from dataset_manifest import get_manifest
+
 class CelebAMaskHQ():
     def __init__(self, img_path, label_path, transform_img, transform_label, mode, type_data):
         self.img_path = img_path
@@ -22,7 +24,11 @@ class CelebAMaskHQ():
             self.num_images = len(self.test_dataset)
 
     def preprocess(self):
-        for i in range(len([name for name in os.listdir(self.img_path) if os.path.isfile(os.path.join(self.img_path, name))])):
+        # Number of files from the persisted listing of img_path (dataset_manifest.py)
+        manifest = get_manifest(self.img_path)
+        num_files = len(manifest.scan()["files"])
+        manifest.save()
+        for i in range(num_files):
             img_path = os.path.join(self.img_path, str(i)+'.jpg')
             label_path = os.path.join(self.label_path, str(i)+'.png')
             if self.mode == True:
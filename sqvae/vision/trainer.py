@@ -16,19 +16,20 @@ class GaussianSQVAETrainer(TrainerBase):
         }
         
     def _train(self, epoch):
-        train_loss = []
-        ms_error = []
-        perplexity = []
         self.model.train()
         start_time = time.time()
-        for batch_idx, (x, _) in enumerate(self.train_loader):
+        metrics, batches = self._epoch_batches(epoch)
+        for batch_idx, batch in batches:
             if self.flgs.decay:
-                step = (epoch - 1) * len(self.train_loader) + batch_idx + 1
+                step = (epoch - 1) * self.steps_per_epoch + batch_idx + 1
                 temperature_current = self._set_temperature(
                     step, self.cfgs.quantization.temperature)
-                self.model.module.quantizer.set_temperature(temperature_current)
-            x = x.cuda()
-            _, _, loss = self.model(x, True, False)
+                self.net.quantizer.set_temperature(temperature_current)
+            x = self._to_input(batch[0])
+            # Cached VGG features of x (feature_cache.py)
+            target_feats = [feature.to(self.device) for feature in batch[2]] if len(batch) > 2 else None
+            with self.profiler.phase("forward"):
+                _, _, loss = self.model(x, True, False, target_feats)
             self.optimizer.zero_grad()
 
             # 确保损失是标量（多GPU时可能返回张量）
@@ -36,32 +37,32 @@ class GaussianSQVAETrainer(TrainerBase):
             if loss_all.dim() > 0:
                 loss_all = loss_all.mean()
 
-            loss_all.backward()
-            self.optimizer.step()
+            with self.profiler.phase("backward"):
+                loss_all.backward()
+            with self.profiler.phase("optimizer"):
+                self.optimizer.step()
 
-            train_loss.append(loss_all.detach().cpu().item())
-            ms_error.append(loss["mse"].detach().cpu().item() if loss["mse"].dim() == 0 else loss["mse"].mean().detach().cpu().item())
-            perplexity.append(loss["perplexity"].detach().cpu().item() if loss["perplexity"].dim() == 0 else loss["perplexity"].mean().detach().cpu().item())
+            metrics.update(loss=loss_all, mse=loss["mse"], perplexity=loss["perplexity"])
+            self._step_end(epoch, batch_idx, metrics, start_time)
 
-        result = {}
-        result["loss"] = np.asarray(train_loss).mean(0)
-        result["mse"] = np.array(ms_error).mean(0)
-        result["perplexity"] = np.array(perplexity).mean(0)
+        result = all_reduce_mean(metrics.result(), self.device)
         self.print_loss(result, "train", time.time()-start_time)
                 
         return result    
     
     def _test(self, mode="validation"):
         self.model.eval()
-        _ = self._test_sub(False, mode)
-        result = self._test_sub(True, mode)
+        if self.cfgs.test.skip_stochastic:
+            result = self._test_sub(True, mode)
+        else:
+            _, result = self._test_sub(mode=mode, flg_both=True)
         self.scheduler.step(result["loss"])
         return result
 
-    def _test_sub(self, flg_quant_det, mode="validation"):
-        test_loss = []
-        ms_error = []
-        perplexity = []
+    def _test_sub(self, flg_quant_det=True, mode="validation", flg_both=False):
+        # flg_both returns the stochastic and deterministic results of one pass (forward_both)
+        num_results = 2 if flg_both else 1
+        metrics = [MetricAccumulator(self.device) for _ in range(num_results)]
         if mode == "validation":
             data_loader = self.val_loader
         elif mode == "test":
@@ -69,23 +70,21 @@ class GaussianSQVAETrainer(TrainerBase):
         start_time = time.time()
         with torch.no_grad():
             for x, _ in data_loader:
-                x = x.cuda()
-                _, _, loss = self.model(x, False, flg_quant_det)
-                # 处理多GPU情况下的损失聚合
-                loss_all = loss["all"].mean() if loss["all"].dim() > 0 else loss["all"]
-                loss_mse = loss["mse"].mean() if loss["mse"].dim() > 0 else loss["mse"]
-                loss_perp = loss["perplexity"].mean() if loss["perplexity"].dim() > 0 else loss["perplexity"]
-
-                test_loss.append(loss_all.item())
-                ms_error.append(loss_mse.item())
-                perplexity.append(loss_perp.item())
-        result = {}
-        result["loss"] = np.asarray(test_loss).mean(0)
-        result["mse"] = np.array(ms_error).mean(0)
-        result["perplexity"] = np.array(perplexity).mean(0)
-        self.print_loss(result, mode, time.time()-start_time)
+                x = self._to_input(x)
+                if flg_both:
+                    _, _, loss = self._forward_both(x)
+                else:
+                    _, _, loss = self.model_eval(x, False, flg_quant_det)
+                losses = loss if num_results == 2 else [loss]
+                for metrics_sub, loss in zip(metrics, losses):
+                    metrics_sub.update(loss=loss["all"], mse=loss["mse"], perplexity=loss["perplexity"])
+        results = []
+        for metrics_sub in metrics:
+            result = all_reduce_mean(metrics_sub.result(), self.device)
+            self.print_loss(result, mode, time.time()-start_time)
+            results.append(result)
         
-        return result
+        return results if num_results == 2 else results[0]
     
     def generate_reconstructions(self, filename, nrows=4, ncols=8):
         self._generate_reconstructions_continuous(filename, nrows=nrows, ncols=ncols)
@@ -110,46 +109,49 @@ class VmfSQVAETrainer(TrainerBase):
         }
     
     def _train(self, epoch):
-        train_loss = []
-        acc = []
-        perplexity = []
         self.model.train()
         start_time = time.time()
-        for batch_idx, (x, y) in enumerate(self.train_loader):
+        metrics, batches = self._epoch_batches(epoch)
+        for batch_idx, (x, y) in batches:
             y = self.preprocess(x, y)
             if self.flgs.decay:
-                step = (epoch - 1) * len(self.train_loader) + batch_idx + 1
+                step = (epoch - 1) * self.steps_per_epoch + batch_idx + 1
                 temperature_current = self._set_temperature(
                     step, self.cfgs.quantization.temperature)
-                self.model.module.quantizer.set_temperature(temperature_current)
-            _, _, loss = self.model(y, flg_train=True, flg_quant_det=False)
+                self.net.quantizer.set_temperature(temperature_current)
+            with self.profiler.phase("forward"):
+                _, _, loss = self.model(y, flg_train=True, flg_quant_det=False)
             self.optimizer.zero_grad()
-            loss["all"].backward()
-            self.optimizer.step()
+            with self.profiler.phase("backward"):
+                loss["all"].backward()
+            with self.profiler.phase("optimizer"):
+                self.optimizer.step()
 
-            train_loss.append(loss["all"].item())
-            acc.append(loss["acc"].item())
-            perplexity.append(loss["perplexity"].item())
+            metrics.update(loss=loss["all"], acc=loss["acc"], perplexity=loss["perplexity"])
+            self._step_end(epoch, batch_idx, metrics, start_time)
 
-        result = {}
-        result["loss"] = np.asarray(train_loss).mean(0)
-        result["acc"] = np.array(acc).mean(0)
-        result["perplexity"] = np.array(perplexity).mean(0)
+        result = all_reduce_mean(metrics.result(), self.device)
         self.print_loss(result, "train", time.time()-start_time)
         
         return result
     
     def _test(self, mode="val"):
-        _ = self._test_sub(False)
-        result = self._test_sub(True, mode)
+        if self.cfgs.test.skip_stochastic:
+            result = self._test_sub(True, mode)
+        else:
+            _, result = self._test_sub(mode=mode, flg_both=True)
         self.scheduler.step(result["loss"])
         return result
     
-    def _test_sub(self, flg_quant_det, mode="val"):
-        test_loss = []
-        acc = []
-        perplexity = []
-        self.metric_semseg.reset()
+    def _test_sub(self, flg_quant_det=True, mode="val", flg_both=False):
+        # flg_both returns the stochastic and deterministic results of one pass (forward_both)
+        num_results = 2 if flg_both else 1
+        metrics = [MetricAccumulator(self.device) for _ in range(num_results)]
+        metrics_semseg = [self.metric_semseg]
+        if num_results == 2:
+            metrics_semseg.insert(0, SegmentationMetric(self.cfgs.network.num_class))
+        for metric_semseg in metrics_semseg:
+            metric_semseg.reset()
         if mode == "val":
             data_loader = self.val_loader
         elif mode == "test":
@@ -158,24 +160,37 @@ class VmfSQVAETrainer(TrainerBase):
         with torch.no_grad():
             for x, y in data_loader:
                 y = self.preprocess(x, y)
-                x_reconst, _, loss = self.model(y, flg_quant_det=flg_quant_det)
-                self.metric_semseg.update(x_reconst, y)
-                pixAcc, mIoU, _ = self.metric_semseg.get()
-                test_loss.append(loss["all"].item())
-                acc.append(loss["acc"].item())
-                perplexity.append(loss["perplexity"].item())
-            pixAcc, mIoU, _ = self.metric_semseg.get()
-        result = {}
-        result["loss"] = np.asarray(test_loss).mean(0)
-        result["acc"] = np.array(acc).mean(0)
-        result["miou"] = mIoU
-        result["perplexity"] = np.array(perplexity).mean(0)
-        self.print_loss(result, mode, time.time()-start_time)
-        myprint("%15s"%"PixAcc: {:5.4f} mIoU: {:5.4f}".format(
-            pixAcc, mIoU
-        ), self.flgs.noprint)
+                if flg_both:
+                    x_reconst, _, loss = self._forward_both(y)
+                else:
+                    x_reconst, _, loss = self.model_eval(y, flg_quant_det=flg_quant_det)
+                x_reconsts, losses = (x_reconst, loss) if num_results == 2 else ([x_reconst], [loss])
+                for i in range(num_results):
+                    metrics_semseg[i].update(x_reconsts[i], y)
+                    metrics[i].update(loss=losses[i]["all"], acc=losses[i]["acc"], perplexity=losses[i]["perplexity"])
+        results = []
+        for metrics_sub, metric_semseg in zip(metrics, metrics_semseg):
+            self._all_reduce_semseg(metric_semseg)
+            pixAcc, mIoU, _ = metric_semseg.get()
+            result = all_reduce_mean(metrics_sub.result(), self.device)
+            result["miou"] = mIoU
+            self.print_loss(result, mode, time.time()-start_time)
+            myprint("%15s"%"PixAcc: {:5.4f} mIoU: {:5.4f}".format(
+                pixAcc, mIoU
+            ), self.flgs.noprint)
+            results.append(result)
         
-        return result
+        return results if num_results == 2 else results[0]
+    
+    def _all_reduce_semseg(self, metric):
+        # Pixel and class counts of the segmentation metric summed over the processes
+        if not is_distributed():
+            return
+        counts = torch.tensor([metric.total_correct, metric.total_label], dtype=torch.float64)
+        counts = all_reduce_sum(counts.to(self.device)).cpu()
+        metric.total_correct, metric.total_label = counts.tolist()
+        inter_union = torch.stack([metric.total_inter, metric.total_union]).to(self.device)
+        metric.total_inter, metric.total_union = all_reduce_sum(inter_union).cpu()
     
     def generate_reconstructions(self, filename, nrows=4, ncols=8):
         self._generate_reconstructions_discrete(filename, nrows=nrows, ncols=ncols)
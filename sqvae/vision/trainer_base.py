@@ -1,10 +1,26 @@
+import time
+import math
 import shutil
 import json
 import datetime
 from torch import nn
+from torch.nn.parallel import DistributedDataParallel
 
 from model import GaussianSQVAE, VmfSQVAE
 from util import *
+from feature_cache import get_feature_cache, feature_cache_path, wrap_loader
+from background import CheckpointWriter, ReconstructionRenderer
+from step_profiler import StepProfiler
+
+class ForwardBoth(nn.Module):
+    """forward() calling forward_both() of a model, so that nn.DataParallel can replicate it."""
+    def __init__(self, model):
+        super(ForwardBoth, self).__init__()
+        self.model = model
+
+    def forward(self, x):
+        return self.model.forward_both(x)
+
 
 class TrainerBase(nn.Module):
     def __init__(self, cfgs, flgs, train_loader, val_loader, test_loader):
@@ -14,39 +30,130 @@ class TrainerBase(nn.Module):
         self.train_loader = train_loader
         self.val_loader = val_loader
         self.test_loader = test_loader
-        self.model = eval(
-            "nn.DataParallel({}(cfgs, flgs).cuda())".format(cfgs.model.name))
+        self.device = torch.device(cfgs.device)
+        model = eval("{}(cfgs, flgs)".format(cfgs.model.name)).to(self.device)
+        if is_distributed():
+            # One process per device (torchrun); logvar_x is unused with the perceptual loss
+            self.model = DistributedDataParallel(model,
+                device_ids=[self.device.index] if self.device.type == "cuda" else None,
+                find_unused_parameters=getattr(flgs, "perceptual_loss", False) and not flgs.arelbo)
+        elif self.device.type == "cuda":
+            self.model = nn.DataParallel(model)
+        else:
+            self.model = model
         self.optimizer = torch.optim.Adam(
             self.model.parameters(), lr=cfgs.train.lr, amsgrad=False)
         self.scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(
             self.optimizer, mode="min", factor=0.5, patience=3,
             verbose=True, threshold=0.0001, threshold_mode="rel",
             cooldown=0, min_lr=0, eps=1e-08)
+        if cfgs.perceptual.cache and getattr(flgs, "perceptual_loss", False):
+            self._use_feature_cache()
+        self.checkpoint_writer = CheckpointWriter(cfgs.train.background_io)
+        self.renderer = ReconstructionRenderer(cfgs.train.background_io)
+        self._recon_batch = None
+        self.resume_state = None
+        self.epoch_rng = None # RNG states when the iterator of the current epoch was created
+        self.profiler = StepProfiler()
+        self.best_loss = 1e+20
+        self.last_saved = -1
     
+    def _use_feature_cache(self):
+        # The training batches carry the precomputed VGG features of the images
+        # (built by rank 0 under torchrun)
+        if isinstance(self.train_loader.dataset, torch.utils.data.IterableDataset):
+            raise Exception("perceptual.cache requires a map-style dataset (not dataset.shards)")
+        if get_rank() != 0:
+            barrier()
+        cache = get_feature_cache(self.train_loader.dataset, self.net.perceptual_loss_fn.perceptual_loss,
+            feature_cache_path(self.cfgs), self.cfgs.perceptual.cache_fp16, self.cfgs.nworker, self.device)
+        if get_rank() == 0:
+            barrier()
+        self.train_loader = wrap_loader(self.train_loader, cache)
+
+    @property
+    def net(self):
+        # Model without the data-parallel wrapper
+        if isinstance(self.model, (nn.DataParallel, DistributedDataParallel)):
+            return self.model.module
+        return self.model
+
+    @property
+    def model_eval(self):
+        # Model for evaluation passes, which run without DDP collectives
+        if isinstance(self.model, DistributedDataParallel):
+            return self.model.module
+        return self.model
+
+    def _forward_both(self, x):
+        # SQVAE.forward_both of the evaluation model, split across the GPUs under nn.DataParallel
+        model = self.model_eval
+        if isinstance(model, nn.DataParallel):
+            return nn.DataParallel(ForwardBoth(model.module), model.device_ids)(x)
+        return model.forward_both(x)
+
     def load(self, timestamp=""):
+        self.checkpoint_writer.flush()
         if timestamp != "":
             self.path = os.path.join(self.cfgs.path, timestamp)
-        self.model.load_state_dict(
-            torch.load(os.path.join(self.path, "best.pt")))
+        self.load_model_state(
+            torch.load(os.path.join(self.path, "best.pt"), map_location=self.device))
         self.plots = np.load(
             os.path.join(self.path, "plots.npy"), allow_pickle=True).item()
         print(self.path)
         self.model.eval()
     
 
+    def load_model_state(self, state_dict):
+        # Checkpoints saved with and without nn.DataParallel are interchangeable
+        state_dict = {
+            (key[len("module."):] if key.startswith("module.") else key): value
+            for key, value in state_dict.items()}
+        self.net.load_state_dict(state_dict)
+
+    def state_dict_full(self, epoch, batch, metrics=None):
+        # Everything needed to continue training bit-for-bit before batch `batch` of `epoch`
+        return dict(
+            model=self.net.state_dict(), optimizer=self.optimizer.state_dict(),
+            scheduler=self.scheduler.state_dict(), epoch=epoch, batch=batch,
+            metrics=None if metrics is None else metrics.state_dict(),
+            best_loss=self.best_loss, last_saved=self.last_saved,
+            plots=self.plots, rng=get_rng_states(),
+            epoch_rng=self.epoch_rng if batch > 0 else None)
+
+    def save_state(self, epoch, batch, metrics=None):
+        self.checkpoint_writer.save(self.state_dict_full(epoch, batch, metrics),
+            os.path.join(self.path, "state.pt"))
+
+    def resume(self, path):
+        # Restores state.pt; main_loop then continues at the saved epoch and batch
+        state = torch.load(os.path.join(path, "state.pt"), map_location=self.device)
+        self.load_model_state(state["model"])
+        self.optimizer.load_state_dict(state["optimizer"])
+        self.scheduler.load_state_dict(state["scheduler"])
+        self.best_loss = state["best_loss"]
+        self.last_saved = state["last_saved"]
+        self.plots = state["plots"]
+        self.resume_state = state
+        print("Resuming {} at epoch {}, batch {}".format(path, state["epoch"], state["batch"]))
+        return state["epoch"]
+    
+
     ## Methods for main loop
 
-    def main_loop(self, max_iter=None, timestamp=None):
+    def main_loop(self, max_iter=None, timestamp=None, resume=False):
         if timestamp == None:
             self._make_path()
         else:
             self.path = os.path.join(self.cfgs.path, timestamp)
-        BEST_LOSS = 1e+20
-        LAST_SAVED = -1
+        start_epoch = 1
+        if resume:
+            start_epoch = self.resume(self.path)
+        self._make_profiler()
 
         if max_iter == None:
             max_iter = self.cfgs.train.epoch_max
-        for epoch in range(1, max_iter+1):
+        for epoch in range(start_epoch, max_iter+1):
             myprint("[Epoch={}]".format(epoch), self.flgs.noprint)
             res_train = self._train(epoch)
             if self.flgs.save:
@@ -56,34 +163,106 @@ class TrainerBase(nn.Module):
                 self._writer_val(res_test, epoch)
             
             if self.flgs.save:
-                if res_test["loss"] <= BEST_LOSS:
-                    BEST_LOSS = res_test["loss"]
-                    LAST_SAVED = epoch
+                if res_test["loss"] <= self.best_loss:
+                    self.best_loss = res_test["loss"]
+                    self.last_saved = epoch
                     myprint("----Saving model!", self.flgs.noprint)
-                    torch.save(
+                    self.checkpoint_writer.save(
                         self.model.state_dict(), os.path.join(self.path, "best.pt"))
                     self.generate_reconstructions(
                         os.path.join(self.path, "reconstrucitons_best"))
                 else:
                     myprint("----Not saving model! Last saved: {}"
-                        .format(LAST_SAVED), self.flgs.noprint)
-                torch.save(
+                        .format(self.last_saved), self.flgs.noprint)
+                self.checkpoint_writer.save(
                     self.model.state_dict(), os.path.join(self.path, "current.pt"))
                 self.generate_reconstructions(
                     os.path.join(self.path, "reconstructions_current"))
+                self.save_state(epoch + 1, 0)
+        self.profiler.close()
+        self.checkpoint_writer.flush()
+        self.renderer.flush()
+        barrier()
+
+    def _make_profiler(self):
+        # Per-phase step timings (profile.path, relative to the run directory) and
+        # torch.profiler trace window (profile.trace_dir) of rank 0
+        cfgs = self.cfgs.profile
+        if get_rank() != 0 or (cfgs.path == "" and cfgs.trace_dir == ""):
+            return
+        path = os.path.join(self.path, cfgs.path) if cfgs.path != "" else ""
+        trace_dir = os.path.join(self.path, cfgs.trace_dir) if cfgs.trace_dir != "" else ""
+        self.profiler = StepProfiler(path, cfgs.interval, self.device, trace_dir,
+            cfgs.trace_start, cfgs.trace_steps)
+        self.net.profiler = self.profiler
     
+    def _to_input(self, x):
+        # Float input batch on the device (uint8 batches of packed datasets are converted here)
+        return to_input(x, self.device)
+
     def preprocess(self, x, y):
         if self.cfgs.dataset.name == "CelebAMask_HQ":
             y[:, 0, :, :] = y[:, 0, :, :] * 255.0
-            y = torch.round(y[:, 0, :, :]).cuda()
+            y = torch.round(y[:, 0, :, :]).to(self.device)
         return y
     
     def test(self, mode="test"):
         result = self._test(mode)
-        if mode == "test":
+        if mode == "test" and self.flgs.save:
             self._writer_test(result)
         return result
     
+    @property
+    def steps_per_epoch(self):
+        # Batches of a full epoch (len(train_loader) shrinks while resuming within an epoch)
+        sampler = self.train_loader.sampler
+        if isinstance(sampler, ResumableSampler):
+            return int(math.ceil(sampler.num_samples / self.train_loader.batch_size))
+        if hasattr(self.train_loader.dataset, "num_batches"):
+            return self.train_loader.dataset.num_batches(self.train_loader.batch_size)
+        return len(self.train_loader)
+
+    def _epoch_batches(self, epoch):
+        # Metrics and (batch_idx, batch) iterator of an epoch; when resuming, both continue
+        # where state.pt left off and the RNG states are restored at the same point
+        metrics = MetricAccumulator(self.device)
+        state, self.resume_state = self.resume_state, None
+        start_batch = 0 if state is None else state["batch"]
+        sampler = self.train_loader.sampler
+        dataset = self.train_loader.dataset
+        if isinstance(sampler, ResumableSampler):
+            sampler.set_epoch(epoch, start_batch * self.train_loader.batch_size)
+        elif hasattr(dataset, "set_epoch"):
+            # Streaming datasets (shard_dataset.py) replay the order of the epoch
+            dataset.set_epoch(epoch)
+        if state is not None and start_batch == 0:
+            set_rng_states(state["rng"])
+        elif state is not None and state.get("epoch_rng") is not None:
+            # The iterator draws the DataLoader worker seeds as at the start of the epoch
+            set_rng_states(state["epoch_rng"])
+        self.epoch_rng = get_rng_states()
+        iterator = iter(self.train_loader)
+        if not isinstance(sampler, ResumableSampler):
+            for _ in range(start_batch):
+                next(iterator)
+        if state is not None and start_batch > 0:
+            # Then the RNG states continue from the saved step
+            metrics.load_state_dict(state["metrics"])
+            set_rng_states(state["rng"])
+        return metrics, self.profiler.iterate(enumerate(iterator, start_batch))
+
+    def _step_end(self, epoch, batch_idx, metrics, start_time):
+        # Running means every train.log_interval steps (the only synchronization within an epoch)
+        # and full-state checkpoints every train.checkpoint_interval steps
+        interval = self.cfgs.train.log_interval
+        if interval > 0 and (batch_idx + 1) % interval == 0:
+            self.print_loss(metrics.result(), "train {}/{}".format(batch_idx + 1, self.steps_per_epoch),
+                time.time() - start_time)
+        self.profiler.step_end()
+        interval = self.cfgs.train.checkpoint_interval
+        if self.flgs.save and interval > 0 and (batch_idx + 1) % interval == 0:
+            self.save_state(epoch, batch_idx + 1, metrics)
+
     def _set_temperature(self, step, param):
         temperature = np.max([param.init * np.exp(-param.decay*step), param.min])
         return temperature
@@ -112,8 +291,8 @@ class TrainerBase(nn.Module):
     def generate_reconstructions_paper(self, nrows=1, ncols=10, off_set=0):
         self.model.eval()
         x = next(self.test_loader.__iter__())[0]
-        x = x[off_set:off_set+nrows*ncols].cuda()
-        output = self.model(x, False, True)
+        x = self._to_input(x[off_set:off_set+nrows*ncols])
+        output = self.model_eval(x, False, True)
         x_tilde = output[0]
         images_original = x.cpu().data.numpy()
         images_reconst = x_tilde.cpu().data.numpy()
@@ -122,32 +301,31 @@ class TrainerBase(nn.Module):
         plot_images_paper(images_reconst,
             os.path.join(self.path, "paper_reconst"), nrows=nrows, ncols=ncols)
 
+    def _reconstruction_batch(self, size):
+        # Fixed test batch, loaded once instead of iterating test_loader at every call
+        if self._recon_batch is None:
+            batch = next(iter(self.test_loader))
+            self._recon_batch = [self._to_input(batch[0][:size]), batch[1][:size].to(self.device)]
+        return self._recon_batch
+
     def _generate_reconstructions_continuous(self, filename, nrows=4, ncols=8):
+        # The grid is rendered by self.renderer (in a worker process by default)
         self.model.eval()
-        x = next(self.test_loader.__iter__())[0]
-        x = x[:nrows*ncols].cuda()
-        output = self.model(x, False, True)
-        x_tilde = output[0]
-        x_cat = torch.cat([x, x_tilde], 0)
-        images = x_cat.cpu().data.numpy()
-        plot_images(images, filename+".png", nrows=nrows, ncols=ncols)
+        x = self._reconstruction_batch(nrows*ncols)[0]
+        with torch.no_grad():
+            x_tilde = self.model_eval(x, False, True)[0]
+        self.renderer.render("continuous", x.cpu().numpy(), x_tilde.cpu().numpy(),
+            filename, nrows, ncols)
     
     def _generate_reconstructions_discrete(self, filename, nrows=4, ncols=8):
         self.model.eval()
-        x, y = next(self.test_loader.__iter__())
-        x = x[:nrows*ncols].cuda()
-        y = y[:nrows*ncols].cuda()
+        x, y = self._reconstruction_batch(nrows*ncols)
+        y = y.clone()
         y[:, 0, :, :] = y[:, 0, :, :] * 255.0
-        y_long = y
-        y = y[:, 0, :, :]
-        output = self.model(y, False, True)
-        label_tilde = output[0]
-        label_real = idx_to_onehot(y_long)
-        label_batch_predict = generate_label(label_tilde[:,:19,:,:], x.shape[-1])
-        label_batch_real = generate_label(label_real, x.shape[-1])
-        x_cat = torch.cat([label_batch_real, label_batch_predict], 0)
-        images = x_cat.cpu().data.numpy()
-        plot_images(images, filename+".png", nrows=nrows, ncols=ncols)
+        with torch.no_grad():
+            label_tilde = self.model_eval(y[:, 0, :, :], False, True)[0]
+        self.renderer.render("discrete", label_tilde.cpu(), y.cpu(), x.shape[-1],
+            filename, nrows, ncols)
 
 
     ## Saving
@@ -171,6 +349,7 @@ class TrainerBase(nn.Module):
                     os.makedirs(os.path.join(target, dirname))
                 for file in  files[i]:
                     shutil.copyfile(file, os.path.join(target, file))
+        self.path = broadcast_object(self.path)
 
     def _makedir(self, path):
         if not os.path.exists(path):
@@ -1,4 +1,5 @@
 import os
+import math
 import random
 import matplotlib.pyplot as plt
 import matplotlib.gridspec as gridspec
@@ -6,6 +7,7 @@ import numpy as np
 import torch
 from torchvision import datasets, transforms
 from torch.utils.data.dataset import Subset
+import torch.distributed as dist
 
 from third_party.celebamask_hq import Data_Loader
 
@@ -27,7 +29,224 @@ def myprint(statement, noflg=False):
         print(statement)
 
 
-def get_loader(dataset, path_dataset, bs=64, n_work=2, target_size=None):
+class MetricAccumulator(object):
+    """
+    Running sums of scalar metrics kept on the device. Steps only queue additions; the
+    means are copied to the host (a single synchronization) by result().
+    """
+    def __init__(self, device):
+        self.device = device
+        self.reset()
+
+    def reset(self):
+        self.sums = {}
+        self.count = 0
+
+    def update(self, **metrics):
+        for key, value in metrics.items():
+            if torch.is_tensor(value):
+                # Per-replica values under nn.DataParallel are averaged
+                value = value.detach().mean().double()
+            self.sums[key] = self.sums.get(key, 0.) + value
+        self.count += 1
+
+    def result(self):
+        keys = list(self.sums)
+        values = torch.stack([
+            torch.as_tensor(self.sums[key], dtype=torch.float64, device=self.device) for key in keys])
+        return {key: value / self.count for key, value in zip(keys, values.cpu().tolist())}
+
+    def state_dict(self):
+        return dict(sums=self.sums, count=self.count)
+
+    def load_state_dict(self, state):
+        self.sums = {key: value.to(self.device) if torch.is_tensor(value) else value
+            for key, value in state["sums"].items()}
+        self.count = state["count"]
+
+
+def get_rng_states():
+    states = dict(python=random.getstate(), numpy=np.random.get_state(), torch=torch.get_rng_state())
+    if torch.cuda.is_available():
+        states["cuda"] = torch.cuda.get_rng_state_all()
+    return states
+
+
+def set_rng_states(states):
+    # The states may have been loaded onto the training device (map_location)
+    random.setstate(states["python"])
+    np.random.set_state(states["numpy"])
+    torch.set_rng_state(states["torch"].cpu())
+    if "cuda" in states and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([state.cpu() for state in states["cuda"]])
+
+
+## Distributed training (torchrun)
+
+def init_distributed(device, backend=""):
+    # Process group from the environment set by torchrun; nccl on GPUs, gloo on CPU
+    if backend == "":
+        backend = "nccl" if device.startswith("cuda") else "gloo"
+    if device.startswith("cuda"):
+        torch.cuda.set_device(int(os.environ["LOCAL_RANK"]))
+    dist.init_process_group(backend=backend)
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def all_reduce_sum(tensor):
+    if is_distributed():
+        tensor = tensor.clone()
+        dist.all_reduce(tensor)
+    return tensor
+
+
+def all_reduce_mean(result, device):
+    # Mean over the processes of a dict of scalar metrics
+    if not is_distributed():
+        return result
+    keys = list(result)
+    values = torch.tensor([float(result[key]) for key in keys], dtype=torch.float64, device=device)
+    values = all_reduce_sum(values) / get_world_size()
+    return {key: value for key, value in zip(keys, values.tolist())}
+
+
+def broadcast_object(obj):
+    # Object of rank 0 on every process
+    if is_distributed():
+        objects = [obj]
+        dist.broadcast_object_list(objects, src=0)
+        obj = objects[0]
+    return obj
+
+
+class ResumableSampler(torch.utils.data.Sampler):
+    """
+    Order of an epoch drawn from (seed, epoch) only, so that it can be regenerated when training
+    is resumed, starting at a given position of the epoch. Under torchrun each process takes its
+    own shard of the order (padded to equal length, as DistributedSampler).
+    """
+    def __init__(self, dataset, shuffle=True, seed=None):
+        self.num_items = len(dataset)
+        self.shuffle = shuffle
+        self.seed = torch.initial_seed() if seed is None else seed
+        self.num_replicas = get_world_size()
+        self.rank = get_rank()
+        self.num_samples = int(math.ceil(self.num_items / self.num_replicas))
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch, start=0):
+        # start: number of samples of this process already consumed in the epoch
+        self.epoch = epoch
+        self.start = start
+
+    def __iter__(self):
+        if self.shuffle:
+            generator = torch.Generator()
+            generator.manual_seed(self.seed + self.epoch)
+            indices = torch.randperm(self.num_items, generator=generator).tolist()
+        else:
+            indices = list(range(self.num_items))
+        total_size = self.num_samples * self.num_replicas
+        while len(indices) < total_size:
+            indices += indices[:total_size - len(indices)]
+        indices = indices[self.rank:total_size:self.num_replicas]
+        return iter(indices[self.start:])
+
+    def __len__(self):
+        return self.num_samples - self.start
+
+
+class TensorLoader(object):
+    """
+    In-memory loader of a small dataset held as one uint8 N x C x H x W tensor. Each batch is
+    one index_select of the images and labels in the order of a ResumableSampler (or in
+    sequence); batches stay uint8 until to_input(). No worker processes are used.
+    """
+    def __init__(self, images, labels, bs, shuffle):
+        self.dataset = torch.utils.data.TensorDataset(images, labels)
+        self.images = images
+        self.labels = labels
+        self.batch_size = bs
+        self.num_workers = 0
+        self.pin_memory = False
+        self.sampler = ResumableSampler(self.dataset, shuffle=shuffle) if shuffle or is_distributed() else None
+
+    def __len__(self):
+        num_samples = len(self.dataset) if self.sampler is None else len(self.sampler)
+        return int(math.ceil(num_samples / self.batch_size))
+
+    def __iter__(self):
+        if self.sampler is None:
+            for start in range(0, len(self.dataset), self.batch_size):
+                yield self.images[start:start+self.batch_size], self.labels[start:start+self.batch_size]
+            return
+        indices = torch.tensor(list(self.sampler), dtype=torch.long)
+        for batch_indices in torch.split(indices, self.batch_size):
+            yield self.images.index_select(0, batch_indices), self.labels.index_select(0, batch_indices)
+
+
+def tensor_loader(dataset, bs, shuffle, indices=None):
+    # TensorLoader of a torchvision MNIST/FashionMNIST (N x H x W) or CIFAR10 (N x H x W x C)
+    # dataset, optionally restricted to a range of indices
+    images = torch.as_tensor(dataset.data)
+    images = images.unsqueeze(1) if images.dim() == 3 else images.permute(0, 3, 1, 2)
+    labels = torch.as_tensor(dataset.targets, dtype=torch.long)
+    if indices is not None:
+        images, labels = images[indices], labels[indices]
+    return TensorLoader(images.contiguous(), labels, bs, shuffle)
+
+
+def to_input(x, device):
+    # Batch on the device as float in [0, 1]; uint8 batches (image_cache.py) are converted
+    # after the copy
+    x = x.to(device, non_blocking=True)
+    if x.dtype == torch.uint8:
+        x = x.float().div_(255.)
+    return x
+
+
+def image_cache_path(cfgs):
+    if cfgs.dataset.cache_path != "":
+        return cfgs.dataset.cache_path
+    return os.path.join(cfgs.path_data, "image_cache")
+
+
+def microdoppler_size(target_size):
+    # Resolution of the MicroDoppler images: 64x64, otherwise 256x256
+    return (64, 64) if tuple(target_size) == (64, 64) else (256, 256)
+
+
+def _make_loader(dataset, bs, shuffle, n_work, pin_memory=False):
+    # Shuffled loaders use a ResumableSampler; under torchrun, each process iterates over
+    # its own shard of the dataset
+    sampler = None
+    if shuffle or is_distributed():
+        sampler = ResumableSampler(dataset, shuffle=shuffle)
+    return torch.utils.data.DataLoader(
+        dataset, batch_size=bs, sampler=sampler,
+        num_workers=n_work, pin_memory=pin_memory
+    )
+
+
+def get_loader(dataset, path_dataset, bs=64, n_work=2, target_size=None, cache_path="", in_memory=False,
+               shard_path="", shuffle_buffer=1000, num_channels=3):
     if dataset == "MNIST" or  dataset == "FashionMNIST":
         preproc_transform = transforms.Compose([
             transforms.ToTensor(),
@@ -40,30 +259,27 @@ def get_loader(dataset, path_dataset, bs=64, n_work=2, target_size=None):
                 os.path.join(path_dataset, "{}/".format(dataset)),
                 train=True, download=True, transform=preproc_transform
         )
+        test_dataset = eval("datasets."+dataset)(
+            os.path.join(path_dataset, "{}/".format(dataset)),
+            train=False, download=True, transform=preproc_transform
+        )
+        if in_memory:
+            return (tensor_loader(trainval_dataset, bs, True, slice(0, train_size)),
+                tensor_loader(trainval_dataset, bs, False, slice(train_size, all_size)),
+                tensor_loader(test_dataset, bs, False))
         train_dataset = Subset(trainval_dataset, subset1_indices)
         val_dataset   = Subset(trainval_dataset, subset2_indices)
-        train_loader = torch.utils.data.DataLoader(
-            train_dataset, batch_size=bs, shuffle=True,
-            num_workers=n_work, pin_memory=False
-        )
-        val_loader = torch.utils.data.DataLoader(
-            val_dataset, batch_size=bs, shuffle=False,
-            num_workers=n_work, pin_memory=False
-        )
-        test_loader = torch.utils.data.DataLoader(
-            eval("datasets."+dataset)(
-                os.path.join(path_dataset, "{}/".format(dataset)),
-                train=False, download=True, transform=preproc_transform
-            ), batch_size=bs, shuffle=False,
-            num_workers=n_work, pin_memory=False
-        )
+        train_loader = _make_loader(train_dataset, bs, True, n_work)
+        val_loader = _make_loader(val_dataset, bs, False, n_work)
+        test_loader = _make_loader(test_dataset, bs, False, n_work)
     elif dataset == "CelebA":
         # 检查是否是MicroDoppler数据（通过路径判断）
         if "kaggle" in path_dataset and "dataset" in path_dataset:
             # 使用MicroDoppler数据但CelebA网络架构
             if target_size is None:
                 target_size = (64, 64)  # CelebA默认64×64
-            train_loader, val_loader, test_loader = get_loader_microdoppler(path_dataset, bs, n_work, target_size)
+            train_loader, val_loader, test_loader = get_loader_microdoppler(
+                path_dataset, bs, n_work, target_size, cache_path, shard_path, shuffle_buffer, num_channels)
         else:
             # 原始CelebA数据
             preproc_transform = transforms.Compose([
@@ -77,15 +293,9 @@ def get_loader(dataset, path_dataset, bs=64, n_work=2, target_size=None):
                 transform=preproc_transform, target_transform=None, download=True)
             dset_test = datasets.CelebA(os.path.join(path_dataset, "CelebA/"), split="test", target_type="attr",
                 transform=preproc_transform, target_transform=None, download=True)
-            train_loader = torch.utils.data.DataLoader(dset_train,
-                batch_size=bs, shuffle=True, num_workers=n_work, pin_memory=False
-            )
-            val_loader = torch.utils.data.DataLoader(dset_valid,
-                batch_size=bs, shuffle=False, num_workers=n_work, pin_memory=False
-            )
-            test_loader = torch.utils.data.DataLoader(dset_test,
-                batch_size=bs, shuffle=False, num_workers=n_work, pin_memory=False
-            )
+            train_loader = _make_loader(dset_train, bs, True, n_work)
+            val_loader = _make_loader(dset_valid, bs, False, n_work)
+            test_loader = _make_loader(dset_test, bs, False, n_work)
     elif dataset == "CIFAR10":
         preproc_transform = transforms.Compose([
             transforms.ToTensor(),
@@ -98,32 +308,42 @@ def get_loader(dataset, path_dataset, bs=64, n_work=2, target_size=None):
                 os.path.join(path_dataset, "{}/".format(dataset)), train=True, download=True,
                 transform=preproc_transform
         )
+        test_dataset = datasets.CIFAR10(
+            os.path.join(path_dataset, "{}/".format(dataset)), train=False, download=True,
+            transform=preproc_transform
+        )
+        if in_memory:
+            return (tensor_loader(trainval_dataset, bs, True, slice(0, train_size)),
+                tensor_loader(trainval_dataset, bs, False, slice(train_size, all_size)),
+                tensor_loader(test_dataset, bs, False))
         train_dataset = Subset(trainval_dataset, subset1_indices)
         val_dataset   = Subset(trainval_dataset, subset2_indices)
-        train_loader = torch.utils.data.DataLoader(
-            train_dataset, batch_size=bs, shuffle=True,
-            num_workers=n_work, pin_memory=False
-        )
-        val_loader = torch.utils.data.DataLoader(
-            val_dataset, batch_size=bs, shuffle=False,
-            num_workers=n_work, pin_memory=False
-        )
-        test_loader = torch.utils.data.DataLoader(
-            datasets.CIFAR10(
-                os.path.join(path_dataset, "{}/".format(dataset)), train=False, download=True,
-                transform=preproc_transform
-            ), batch_size=bs, shuffle=False,
-            num_workers=n_work, pin_memory=False
-        )
+        train_loader = _make_loader(train_dataset, bs, True, n_work)
+        val_loader = _make_loader(val_dataset, bs, False, n_work)
+        test_loader = _make_loader(test_dataset, bs, False, n_work)
     elif dataset =="CelebAMask_HQ":
         train_dataset, val_dataset, test_dataset = get_loader_celeba_mask_hq(path_dataset, bs, imsize=64)
-        train_loader = train_dataset.loader()
-        val_loader = val_dataset.loader()
-        test_loader = test_dataset.loader()
+        # Data_Loader.loader() uses 2 workers and shuffles the train/val splits
+        train_loader, val_loader, test_loader = [
+            _make_loader(data_loader.loader().dataset, bs, data_loader.mode, 2)
+            for data_loader in [train_dataset, val_dataset, test_dataset]]
+    elif dataset == "FakeData":
+        # Small synthetic dataset for smoke tests (e.g. configs/smoke_cpu.yaml)
+        preproc_transform = transforms.Compose([
+            transforms.ToTensor(),
+        ])
+        loaders = []
+        for i, size in enumerate([64, 32, 32]):
+            loaders.append(_make_loader(
+                datasets.FakeData(size=size, image_size=(1, 28, 28), num_classes=10,
+                    transform=preproc_transform, random_offset=i * size),
+                bs, i == 0, n_work))
+        train_loader, val_loader, test_loader = loaders
     elif dataset == "MicroDoppler":
         if target_size is None:
             target_size = (256, 256)  # 默认256×256
-        train_loader, val_loader, test_loader = get_loader_microdoppler(path_dataset, bs, n_work, target_size)
+        train_loader, val_loader, test_loader = get_loader_microdoppler(
+            path_dataset, bs, n_work, target_size, cache_path, shard_path, shuffle_buffer, num_channels)
 
     return train_loader, val_loader, test_loader
 
@@ -142,10 +362,37 @@ def get_loader_celeba_mask_hq(path_dataset, bs, imsize, type_data="both", gray=F
     return train_loader, val_loader, test_loader
 
 
-def get_loader_microdoppler(path_dataset, bs, n_work, target_size=(256, 256)):
+def get_loader_microdoppler(path_dataset, bs, n_work, target_size=(256, 256), cache_path="",
+                            shard_path="", shuffle_buffer=1000, num_channels=3):
     """MicroDoppler数据集加载器，支持不同分辨率"""
     from custom_dataset import MicroDopplerDataset
 
+    # tar分片流式读取 (shard_dataset.py)：顺序读取，分片级打乱 + 缓冲区打乱
+    if shard_path != "":
+        from shard_dataset import ShardDataset
+        loaders = []
+        for split in ["train", "val", "test"]:
+            dataset = ShardDataset(shard_path, split, split == "train", shuffle_buffer, num_workers=n_work)
+            shape = [dataset.index.get("channels", 3)] + list(dataset.index["size"])
+            if shape != [num_channels] + list(microdoppler_size(target_size)):
+                raise Exception("{} holds {} images, {} are required".format(
+                    shard_path, shape, [num_channels] + list(microdoppler_size(target_size))))
+            loaders.append(torch.utils.data.DataLoader(dataset, batch_size=bs, num_workers=n_work,
+                pin_memory=torch.cuda.is_available()))
+        return tuple(loaders)
+
+    # 打包的uint8缓存 (image_cache.py)：只解码一次
+    if cache_path != "":
+        from image_cache import get_packed_microdoppler
+        size = microdoppler_size(target_size)
+        train_dataset, val_dataset, test_dataset = [
+            get_packed_microdoppler(path_dataset, split, size, cache_path, n_work, num_channels)
+            for split in ["train", "val", "test"]]
+        pin_memory = torch.cuda.is_available()
+        return (_make_loader(train_dataset, bs, True, n_work, pin_memory),
+            _make_loader(val_dataset, bs, False, n_work, pin_memory),
+            _make_loader(test_dataset, bs, False, n_work, pin_memory))
+
     # 64×64版本：遵循原项目哲学，但适配微多普勒数据
     if target_size == (64, 64):
         preproc_transform = transforms.Compose([
@@ -160,23 +407,14 @@ def get_loader_microdoppler(path_dataset, bs, n_work, target_size=(256, 256)):
         ])
 
     # 创建数据集
-    train_dataset = MicroDopplerDataset(path_dataset, transform=preproc_transform, split='train')
-    val_dataset = MicroDopplerDataset(path_dataset, transform=preproc_transform, split='val')
-    test_dataset = MicroDopplerDataset(path_dataset, transform=preproc_transform, split='test')
+    train_dataset = MicroDopplerDataset(path_dataset, transform=preproc_transform, split='train', num_channels=num_channels)
+    val_dataset = MicroDopplerDataset(path_dataset, transform=preproc_transform, split='val', num_channels=num_channels)
+    test_dataset = MicroDopplerDataset(path_dataset, transform=preproc_transform, split='test', num_channels=num_channels)
 
     # 创建数据加载器
-    train_loader = torch.utils.data.DataLoader(
-        train_dataset, batch_size=bs, shuffle=True,
-        num_workers=n_work, pin_memory=False
-    )
-    val_loader = torch.utils.data.DataLoader(
-        val_dataset, batch_size=bs, shuffle=False,
-        num_workers=n_work, pin_memory=False
-    )
-    test_loader = torch.utils.data.DataLoader(
-        test_dataset, batch_size=bs, shuffle=False,
-        num_workers=n_work, pin_memory=False
-    )
+    train_loader = _make_loader(train_dataset, bs, True, n_work)
+    val_loader = _make_loader(val_dataset, bs, False, n_work)
+    test_loader = _make_loader(test_dataset, bs, False, n_work)
 
     return train_loader, val_loader, test_loader
 
@@ -185,8 +423,8 @@ def logits_to_onehot(prob, n_class=19):
     size = prob.size()
     label_idx = torch.argmin(prob, dim=1, keepdim=True)
     oneHot_size = (size[0], n_class, size[2], size[3])
-    label = torch.cuda.FloatTensor(torch.Size(oneHot_size)).zero_()
-    label = label.scatter_(1, label_idx.data.long().cuda(), 1.0)
+    label = torch.zeros(oneHot_size, device=prob.device)
+    label = label.scatter_(1, label_idx.data.long(), 1.0)
 
     return label
 
@@ -244,8 +482,8 @@ def plot_images_paper(images, filename, nrows=4, ncols=8, flg_norm=False):
 def idx_to_onehot(idx, n_class=19):
     size = idx.size()
     oneHot_size = (size[0], n_class, size[2], size[3])
-    label = torch.cuda.FloatTensor(torch.Size(oneHot_size)).zero_()
-    label = label.scatter_(1, idx.data.long().cuda(), 1.0)
+    label = torch.zeros(oneHot_size, device=idx.device)
+    label = label.scatter_(1, idx.data.long(), 1.0)
 
     return label
 
@@ -254,8 +492,8 @@ def logits_to_onehot(prob, n_class=19):
     size = prob.size()
     label_idx = torch.argmin(prob, dim=1, keepdim=True)
     oneHot_size = (size[0], n_class, size[2], size[3])
-    label = torch.cuda.FloatTensor(torch.Size(oneHot_size)).zero_()
-    label = label.scatter_(1, label_idx.data.long().cuda(), 1.0)
+    label = torch.zeros(oneHot_size, device=prob.device)
+    label = label.scatter_(1, label_idx.data.long(), 1.0)
 
     return label
 
@@ -361,7 +599,7 @@ def label_to_segment(label, nclass=19):
         [255., 153., 51],
         [0., 204., 0]
     ]
-    color_torch = torch.tensor(color_list).cuda()
+    color_torch = torch.tensor(color_list, dtype=label.dtype, device=label.device)
     shape = label.shape
     label_permuted = label.permute(0, 2, 3, 1).contiguous()
     label_reshaped = label_permuted.view(-1, nclass)
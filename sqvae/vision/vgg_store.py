@@ -0,0 +1,87 @@
+"""
+Local weight store for the truncated VGG16 trunk of the perceptual loss.
+
+Only the first num_layers modules of vgg16.features are kept, one .npy file per parameter
+(<i>.weight.npy, <i>.bias.npy) with meta.json. Loading memory-maps the files (copy-on-write),
+so no download and no deserialization of the full 528 MB checkpoint are needed at start-up.
+The store is produced from a torchvision checkpoint (or downloaded weights) with
+    python vgg_store.py -o vgg16_relu2_2 --layer relu2_2 [--checkpoint vgg16-397923af.pth]
+and used with perceptual.weights: "vgg16_relu2_2".
+"""
+import os
+import json
+import argparse
+
+import numpy as np
+import torch
+from torch import nn
+
+
+# Configuration "D" of torchvision.models.vgg16
+VGG16_CFG = [64, 64, "M", 128, 128, "M", 256, 256, 256, "M", 512, 512, 512, "M", 512, 512, 512, "M"]
+
+LAYER_INDICES = {
+    'relu1_2': 3,
+    'relu2_2': 8,
+    'relu3_3': 15,
+    'relu4_3': 22,
+}
+
+
+def make_trunk(num_layers):
+    # Modules of vgg16.features[:num_layers] without initializing the weights
+    modules = []
+    in_channels = 3
+    for v in VGG16_CFG:
+        if v == "M":
+            modules.append(nn.MaxPool2d(kernel_size=2, stride=2))
+        else:
+            modules.append(nn.utils.skip_init(nn.Conv2d, in_channels, v, kernel_size=3, padding=1))
+            modules.append(nn.ReLU(inplace=True))
+            in_channels = v
+    return modules[:num_layers]
+
+
+def export_trunk(state_dict, path, num_layers):
+    # state_dict of a full VGG16 (features.<i>.* keys) or of its features
+    os.makedirs(path, exist_ok=True)
+    for key, value in state_dict.items():
+        name = key[len("features."):] if key.startswith("features.") else key
+        if name.split(".")[0].isdigit() and int(name.split(".")[0]) < num_layers:
+            np.save(os.path.join(path, name + ".npy"), value.detach().cpu().numpy())
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump(dict(arch="vgg16", num_layers=num_layers), f)
+
+
+def load_trunk(path, num_layers):
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+    if meta["num_layers"] < num_layers:
+        raise Exception("{} holds {} VGG layers, {} are required".format(path, meta["num_layers"], num_layers))
+    modules = make_trunk(num_layers)
+    for i, module in enumerate(modules):
+        if isinstance(module, nn.Conv2d):
+            for name in ["weight", "bias"]:
+                value = np.load(os.path.join(path, "{}.{}.npy".format(i, name)), mmap_mode="c")
+                setattr(module, name, nn.Parameter(torch.from_numpy(value), requires_grad=False))
+    return modules
+
+
+def arg_parse():
+    parser = argparse.ArgumentParser(description="vgg_store.py")
+    parser.add_argument("-o", "--out", required=True, help="output directory")
+    parser.add_argument("--layer", default="relu4_3", choices=list(LAYER_INDICES), help="deepest layer to keep")
+    parser.add_argument("--checkpoint", default="", help="torchvision VGG16 checkpoint (default: download)")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = arg_parse()
+    if args.checkpoint != "":
+        state_dict = torch.load(args.checkpoint, map_location="cpu")
+    else:
+        import torchvision.models as models
+        state_dict = models.vgg16(pretrained=True).state_dict()
+    num_layers = LAYER_INDICES[args.layer] + 1
+    export_trunk(state_dict, args.out, num_layers)
+    print("Saved vgg16.features[:{}]: {}".format(num_layers, args.out))